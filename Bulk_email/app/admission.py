@@ -0,0 +1,140 @@
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncIterator, Dict, Optional
+
+from dotenv import load_dotenv
+
+from app.job_store import JobStore
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+class AdmissionRejected(Exception):
+    """A request that would push the send queue over its budget."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[int] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class AdmissionBudget:
+    # Zero leaves a dimension unlimited
+    max_bytes: int = 0
+    max_recipients: int = 0
+    max_jobs: int = 0
+
+
+class AdmissionController:
+    """
+    Bound the work that is queued or in flight before accepting more of it.
+
+    The queue depth comes from the job store, so it covers jobs accepted by earlier
+    processes too, plus reservations held by requests still being handled here: request
+    bodies being received and jobs being written. A request that would exceed the byte
+    budget gets 503, since the server is short of memory rather than the client
+    misbehaving; one that would exceed the recipient or job budget gets 429. Both carry
+    Retry-After. A request larger than a whole budget can never fit and gets 413.
+    """
+
+    def __init__(self, store: JobStore, budget: AdmissionBudget, retry_after: int = 30):
+        self.store = store
+        self.budget = budget
+        self.retry_after = retry_after
+        self.reserved = {'bytes': 0, 'recipients': 0, 'jobs': 0}
+        self.rejections = 0
+        self._lock = asyncio.Lock()
+
+    async def queue_depth(self) -> Dict[str, int]:
+        depth = await asyncio.to_thread(self.store.queue_depth)
+        depth['jobs'] = depth['jobs_queued'] + depth['jobs_running']
+        return depth
+
+    def _check(self, depth: Dict[str, int], request: Dict[str, int]) -> None:
+        limits = (
+            ('bytes', self.budget.max_bytes, 503),
+            ('recipients', self.budget.max_recipients, 429),
+            ('jobs', self.budget.max_jobs, 429),
+        )
+        for name, limit, status_code in limits:
+            wanted = request[name]
+            if not limit or not wanted:
+                continue
+            if wanted > limit:
+                self.rejections += 1
+                raise AdmissionRejected(413, f"Request needs {wanted} {name}, more than the queue budget of {limit}")
+            if depth[name] + self.reserved[name] + wanted > limit:
+                self.rejections += 1
+                logger.warning(f"Admission rejected: {name} budget of {limit} is exhausted")
+                raise AdmissionRejected(
+                    status_code,
+                    f"Send queue is full ({name} budget of {limit} reached), retry later",
+                    self.retry_after,
+                )
+
+    @asynccontextmanager
+    async def reserve(self, size_bytes: int = 0, recipients: int = 0, jobs: int = 0) -> AsyncIterator[None]:
+        """
+        Hold budget for work that is not in the job store yet, or raise AdmissionRejected.
+
+        Release it once the work is stored or abandoned. Reading the queue depth, checking
+        and reserving happen under one lock, so concurrent requests in this process cannot
+        pass the check against the same depth and both take the last of the budget. API
+        processes sharing the job store each hold their own reservations.
+        """
+        request = {'bytes': size_bytes, 'recipients': recipients, 'jobs': jobs}
+        async with self._lock:
+            depth = await self.queue_depth()
+            self._check(depth, request)
+            for name, amount in request.items():
+                self.reserved[name] += amount
+        try:
+            yield
+        finally:
+            # Released under the lock too, so a check never sees the work neither reserved
+            # nor yet in the depth it read
+            async with self._lock:
+                for name, amount in request.items():
+                    self.reserved[name] -= amount
+
+    async def snapshot(self) -> Dict[str, Any]:
+        depth = await self.queue_depth()
+        budget = asdict(self.budget)
+        utilization = {}
+        for name in ('bytes', 'recipients', 'jobs'):
+            limit = budget[f'max_{name}']
+            utilization[name] = round((depth[name] + self.reserved[name]) / limit, 3) if limit else None
+        return {
+            'queue': depth,
+            'reserved': dict(self.reserved),
+            'budget': budget,
+            'utilization': utilization,
+            'rejections': self.rejections,
+        }
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller(store: JobStore) -> AdmissionController:
+    """Return the process-wide controller, with budgets from the ADMISSION_* environment."""
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(
+            store,
+            AdmissionBudget(
+                max_bytes=int(os.getenv("ADMISSION_MAX_BYTES", 512 * 1024 * 1024)),
+                max_recipients=int(os.getenv("ADMISSION_MAX_RECIPIENTS", 1_000_000)),
+                max_jobs=int(os.getenv("ADMISSION_MAX_JOBS", 1000)),
+            ),
+            retry_after=int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", 30)),
+        )
+    return _controller
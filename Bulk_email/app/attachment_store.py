@@ -0,0 +1,141 @@
+import os
+import asyncio
+import base64
+import hashlib
+import json
+import mmap
+import re
+import tempfile
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Optional
+
+from fastapi import UploadFile
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Upload copy size, and base64 input size that is a whole number of 76-character lines
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+ENCODE_CHUNK_SIZE = 57 * 1024
+
+ATTACHMENT_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+@dataclass(frozen=True)
+class StoredAttachment:
+    id: str
+    path: str
+    filename: str
+    mime_type: str
+    size: int
+
+
+class AttachmentStore:
+    """
+    On-disk, content-addressed attachment store.
+
+    Files are named by the SHA-256 of their content and sharded by the first two hex
+    digits, with a JSON sidecar holding the filename and MIME type of the first upload.
+    Identical uploads share one copy on disk.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+    def _path(self, attachment_id: str) -> str:
+        return os.path.join(self.root, attachment_id[:2], attachment_id)
+
+    async def save_upload(self, upload: UploadFile) -> StoredAttachment:
+        """
+        Stream an upload to disk in chunks, hashing as it goes, and return its record.
+
+        Only reading the upload happens on the event loop; hashing, writing and filing
+        the copy run in worker threads, one chunk at a time.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = await asyncio.to_thread(tempfile.mkstemp, dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await asyncio.to_thread(_write_chunk, out, digest, chunk)
+                    size += len(chunk)
+
+            attachment_id = digest.hexdigest()
+            await asyncio.to_thread(
+                self._file, tmp_path, attachment_id,
+                upload.filename or attachment_id, upload.content_type or 'application/octet-stream', size,
+            )
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return await asyncio.to_thread(self.get, attachment_id)
+
+    def _file(self, tmp_path: str, attachment_id: str, filename: str, mime_type: str, size: int) -> None:
+        """Move a finished upload to its content address and write its sidecar once."""
+        path = self._path(attachment_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+        metadata_path = path + '.json'
+        if not os.path.exists(metadata_path):
+            with open(metadata_path, 'w') as f:
+                json.dump({'filename': filename, 'mime_type': mime_type, 'size': size}, f)
+
+    def get(self, attachment_id: str) -> Optional[StoredAttachment]:
+        """Look up a stored attachment by ID, or return None if it is unknown."""
+        if not ATTACHMENT_ID_PATTERN.match(attachment_id):
+            return None
+        path = self._path(attachment_id)
+        try:
+            with open(path + '.json') as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return None
+        if not os.path.exists(path):
+            return None
+        return StoredAttachment(
+            id=attachment_id,
+            path=path,
+            filename=metadata['filename'],
+            mime_type=metadata['mime_type'],
+            size=metadata['size'],
+        )
+
+
+def _write_chunk(out: BinaryIO, digest: Any, chunk: bytes) -> None:
+    digest.update(chunk)
+    out.write(chunk)
+
+
+def encode_file_base64(path: str) -> str:
+    """Base64-encode a file into 76-character MIME lines, reading it through mmap."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return ''.join(
+                base64.encodebytes(mapped[offset:offset + ENCODE_CHUNK_SIZE]).decode('ascii')
+                for offset in range(0, len(mapped), ENCODE_CHUNK_SIZE)
+            )
+
+
+_store: Optional[AttachmentStore] = None
+
+
+def get_attachment_store() -> AttachmentStore:
+    """Return the process-wide store rooted at ATTACHMENT_STORE_PATH."""
+    global _store
+    if _store is None:
+        _store = AttachmentStore(os.getenv("ATTACHMENT_STORE_PATH", "data/attachments"))
+    return _store
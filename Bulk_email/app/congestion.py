@@ -0,0 +1,166 @@
+import asyncio
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Protocol
+
+from aiosmtplib import SMTPRecipientsRefused, SMTPResponseException
+
+from app.rate_limiter import TokenBucket
+from app.smtp_pool import is_connection_error
+
+
+# Basic reply codes that signal the server wants us to slow down
+THROTTLE_CODES = {421, 451}
+# Enhanced status classes (RFC 3463) used for rate limiting and congestion on 4xx replies
+THROTTLE_ENHANCED_PREFIXES = ("4.7.", "4.3.", "4.4.5")
+
+_ENHANCED_STATUS = re.compile(r'\b([245]\.\d{1,3}\.\d{1,3})\b')
+
+
+def enhanced_status(message: str) -> Optional[str]:
+    """Extract an enhanced status code such as ``4.7.28`` from a reply text."""
+    match = _ENHANCED_STATUS.search(message or "")
+    return match.group(1) if match else None
+
+
+def is_throttle_reply(code: Optional[int], message: str = "") -> bool:
+    """Return True if an SMTP reply asks the client to back off."""
+    if code is None:
+        return False
+    if code in THROTTLE_CODES:
+        return True
+    if 400 <= code < 500:
+        status = enhanced_status(message)
+        return bool(status and status.startswith(THROTTLE_ENHANCED_PREFIXES))
+    return False
+
+
+def is_throttle_error(error: BaseException) -> bool:
+    """Return True if a failed transaction should count as a congestion signal."""
+    if isinstance(error, SMTPRecipientsRefused):
+        return any(is_throttle_reply(refusal.code, refusal.message) for refusal in error.recipients)
+    if isinstance(error, SMTPResponseException):
+        return is_throttle_reply(error.code, error.message)
+    # A dropped or refused connection is usually the server shedding load
+    return is_connection_error(error)
+
+
+def backoff_delay(attempt: int, base: float = 5.0, cap: float = 300.0) -> float:
+    """Exponential backoff with equal jitter: half the step is fixed, half is random."""
+    step = min(cap, base * (2 ** attempt))
+    return step / 2 + random.uniform(0, step / 2)
+
+
+class AdaptiveController:
+    """
+    AIMD congestion control for one sending stream.
+
+    The window bounds how many SMTP transactions are in flight and the rate feeds the
+    message token bucket. A throttling reply halves both (multiplicative decrease), at
+    most once per round of transactions; healthy replies grow them back by roughly one
+    transaction and ``rate_step`` messages per second per window (additive increase),
+    up to the configured maximums. A maximum rate of zero leaves the rate unlimited and
+    only the window adapts.
+    """
+
+    def __init__(
+        self,
+        max_window: int,
+        max_rate: float,
+        min_window: int = 1,
+        min_rate: float = 0.1,
+        decrease_factor: float = 0.5,
+        rate_step: Optional[float] = None,
+    ):
+        self.max_window = max(1, max_window)
+        self.max_rate = max_rate
+        self.min_window = max(1, min(min_window, self.max_window))
+        self.min_rate = min(min_rate, max_rate) if max_rate > 0 else 0
+        self.decrease_factor = decrease_factor
+        self.rate_step = rate_step if rate_step is not None else max(max_rate / 10, self.min_rate)
+
+        self.window = float(self.max_window)
+        self.bucket = TokenBucket(max_rate)
+        self.throttle_events = 0
+        self.healthy_replies = 0
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._changed = asyncio.Condition()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[float]:
+        """Hold one in-flight slot for a transaction; yields its start time."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._in_flight < int(self.window))
+            self._in_flight += 1
+        try:
+            yield time.monotonic()
+        finally:
+            async with self._changed:
+                self._in_flight -= 1
+                self._changed.notify_all()
+
+    async def pace(self, tokens: float = 1) -> None:
+        await self.bucket.acquire(tokens)
+
+    def on_success(self) -> None:
+        self.healthy_replies += 1
+        self.window = min(self.max_window, self.window + 1 / self.window)
+        if self.max_rate > 0:
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + self.rate_step / self.window)
+
+    def on_throttle(self, started_at: float) -> None:
+        """Back off, ignoring signals from transactions started before the last decrease."""
+        self.throttle_events += 1
+        if started_at < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self.window = max(self.min_window, self.window * self.decrease_factor)
+        if self.max_rate > 0:
+            self.bucket.rate = max(self.min_rate, self.bucket.rate * self.decrease_factor)
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'window': round(self.window, 2),
+            'max_window': self.max_window,
+            'in_flight': self._in_flight,
+            'rate_per_second': round(self.rate, 3) if self.max_rate > 0 else None,
+            'max_rate_per_second': self.max_rate if self.max_rate > 0 else None,
+            'throttle_events': self.throttle_events,
+            'healthy_replies': self.healthy_replies,
+        }
+
+
+class Snapshotable(Protocol):
+    def snapshot(self) -> Dict[str, Any]: ...
+
+
+# Congestion state of the sends currently running in this process, by campaign
+_active: Dict[str, Snapshotable] = {}
+
+
+def register_controller(campaign_id: str, controller: Snapshotable) -> None:
+    _active[campaign_id] = controller
+
+
+def unregister_controller(campaign_id: str) -> None:
+    _active.pop(campaign_id, None)
+
+
+def get_controller(campaign_id: str) -> Optional[Snapshotable]:
+    return _active.get(campaign_id)
+
+
+def controller_snapshots() -> Dict[str, Dict[str, Any]]:
+    """Current window and rate of every running send, for operators."""
+    return {campaign_id: controller.snapshot() for campaign_id, controller in _active.items()}
@@ -0,0 +1,112 @@
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional
+
+from aiosmtplib import SMTPAuthenticationError, SMTPRecipientsRefused, SMTPResponse, SMTPResponseException
+
+
+# Per-recipient outcomes
+SENT = "sent"
+FAILED = "failed"  # transient errors that outlasted every retry
+REJECTED = "rejected"  # permanent 5xx refusal of the RCPT, never retried
+
+# Replies about the sending account rather than the recipients
+AUTH_CODES = {530, 534, 535}
+
+
+class Recipient(NamedTuple):
+    """An address to deliver to, with its row position when it comes from the job store."""
+    address: str
+    position: Optional[int] = None
+
+
+@dataclass
+class RecipientResult:
+    address: str
+    status: str
+    code: Optional[int] = None
+    message: str = ""
+    position: Optional[int] = None
+
+    @property
+    def response(self) -> str:
+        return f"{self.code} {self.message}".strip() if self.code else self.message
+
+
+def is_permanent(code: Optional[int]) -> bool:
+    """5xx replies are permanent; 4xx replies and errors without a code are worth retrying."""
+    return code is not None and 500 <= code < 600
+
+
+def is_auth_error(error: BaseException) -> bool:
+    """Return True if the server refused the credentials, which no retry will fix."""
+    if isinstance(error, SMTPAuthenticationError):
+        return True
+    return isinstance(error, SMTPResponseException) and error.code in AUTH_CODES
+
+
+def refused_from_error(error: SMTPRecipientsRefused) -> Dict[str, SMTPResponse]:
+    """Turn the exception raised when every RCPT was refused into a refused-recipients dict."""
+    return {
+        refusal.recipient: SMTPResponse(refusal.code, refusal.message)
+        for refusal in error.recipients
+    }
+
+
+class BatchDelivery:
+    """
+    Track the outcome of each recipient of one batch across retries.
+
+    ``pending`` holds the recipients that still need an attempt. Accepted recipients and
+    permanent refusals are settled immediately, so a retry only goes to the recipients
+    that failed transiently. Results are kept per recipient rather than per address, so
+    an address a job lists twice, say in To and CC, keeps a result for each of its rows.
+    """
+
+    def __init__(self, recipients: List[Recipient]):
+        self.pending = list(recipients)
+        self.results: Dict[Recipient, RecipientResult] = {}
+
+    @property
+    def pending_addresses(self) -> List[str]:
+        return [recipient.address for recipient in self.pending]
+
+    def _settle(self, recipient: Recipient, status: str, code: Optional[int], message: str) -> None:
+        self.results[recipient] = RecipientResult(recipient.address, status, code, message, recipient.position)
+
+    def accept(self, refused: Dict[str, SMTPResponse], response: str) -> None:
+        """Apply the outcome of a transaction the server accepted for at least one recipient."""
+        retry = []
+        for recipient in self.pending:
+            refusal = refused.get(recipient.address)
+            if refusal is None:
+                self._settle(recipient, SENT, 250, response)
+            elif is_permanent(refusal.code):
+                self._settle(recipient, REJECTED, refusal.code, refusal.message)
+            else:
+                retry.append(recipient)
+                self._settle(recipient, FAILED, refusal.code, refusal.message)
+        self.pending = retry
+
+    def fail(self, error: Exception) -> None:
+        """
+        Apply an error that failed the whole transaction.
+
+        Only a refused RCPT says anything about a recipient. Any other failure, even a 5xx
+        from the connection, AUTH or DATA, is about the server or the message, so every
+        pending recipient stays pending as failed for now.
+        """
+        if isinstance(error, SMTPRecipientsRefused):
+            self.accept(refused_from_error(error), "")
+            return
+        code = error.code if isinstance(error, SMTPResponseException) else None
+        message = error.message if isinstance(error, SMTPResponseException) else str(error)
+        for recipient in self.pending:
+            self._settle(recipient, FAILED, code, message)
+
+    def settled(self) -> List[RecipientResult]:
+        """Outcomes of the recipients that need no further attempt."""
+        pending = set(self.pending)
+        return [result for recipient, result in self.results.items() if recipient not in pending]
+
+    def outcomes(self) -> List[RecipientResult]:
+        return list(self.results.values())
@@ -0,0 +1,122 @@
+import os
+import json
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional
+
+from app.congestion import AdaptiveController
+from app.delivery import Recipient
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOMAIN = "default"
+
+
+@dataclass(frozen=True)
+class DomainLimits:
+    max_concurrent: int
+    messages_per_second: float = 0  # zero leaves the domain to the global rate only
+
+
+def recipient_domain(address: str) -> str:
+    return address.rpartition('@')[2].lower()
+
+
+def load_domain_limits() -> Dict[str, DomainLimits]:
+    """
+    Read per-domain limits from SEND_DOMAIN_LIMITS (inline JSON) or SEND_DOMAIN_LIMITS_FILE.
+
+    The JSON maps a domain, or ``default`` for every other domain, to an object with
+    ``max_concurrent`` and ``messages_per_second``, for example
+    ``{"gmail.com": {"max_concurrent": 2, "messages_per_second": 1}}``.
+    """
+    raw = os.getenv("SEND_DOMAIN_LIMITS")
+    path = os.getenv("SEND_DOMAIN_LIMITS_FILE")
+    if not raw and path:
+        with open(path) as f:
+            raw = f.read()
+    if not raw:
+        return {}
+    return {
+        domain.lower(): DomainLimits(
+            max_concurrent=int(limits.get('max_concurrent', 1)),
+            messages_per_second=float(limits.get('messages_per_second', 0)),
+        )
+        for domain, limits in json.loads(raw).items()
+    }
+
+
+async def iter_domain_batches(
+    recipients: AsyncIterator[Recipient],
+    batch_size: int,
+    max_buffered: int,
+) -> AsyncIterator[List[Recipient]]:
+    """
+    Group a recipient stream into single-domain batches.
+
+    Each domain fills its own batch and is emitted when full. To keep memory bounded on
+    long streams, the largest partial batch is flushed once more than ``max_buffered``
+    recipients are waiting; everything left is flushed when the stream ends.
+    """
+    buffers: Dict[str, List[Recipient]] = {}
+    buffered = 0
+    async for recipient in recipients:
+        domain = recipient_domain(recipient.address)
+        batch = buffers.setdefault(domain, [])
+        batch.append(recipient)
+        buffered += 1
+        if len(batch) >= batch_size:
+            buffered -= len(batch)
+            del buffers[domain]
+            yield batch
+        elif buffered > max_buffered:
+            largest = max(buffers, key=lambda d: len(buffers[d]))
+            batch = buffers.pop(largest)
+            buffered -= len(batch)
+            yield batch
+    for batch in buffers.values():
+        yield batch
+
+
+class DomainScheduler:
+    """
+    Global and per-domain congestion control for one campaign.
+
+    The global controller bounds total in-flight transactions and the overall message
+    rate. Every destination domain gets its own AdaptiveController seeded from its
+    configured limits, so a domain that throttles backs off on its own while the other
+    domains keep draining at full speed.
+    """
+
+    def __init__(
+        self,
+        controller: AdaptiveController,
+        limits: Optional[Dict[str, DomainLimits]] = None,
+    ):
+        self.controller = controller
+        self.limits = limits or {}
+        self._domains: Dict[str, AdaptiveController] = {}
+
+    def limits_for(self, domain: str) -> DomainLimits:
+        limits = self.limits.get(domain) or self.limits.get(DEFAULT_DOMAIN)
+        if limits is None:
+            limits = DomainLimits(max_concurrent=self.controller.max_window)
+        return limits
+
+    def domain(self, domain: str) -> AdaptiveController:
+        controller = self._domains.get(domain)
+        if controller is None:
+            limits = self.limits_for(domain)
+            controller = AdaptiveController(
+                max_window=limits.max_concurrent,
+                max_rate=limits.messages_per_second,
+            )
+            self._domains[domain] = controller
+        return controller
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            'global': self.controller.snapshot(),
+            'domains': {domain: controller.snapshot() for domain, controller in self._domains.items()},
+        }
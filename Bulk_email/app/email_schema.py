@@ -7,11 +7,15 @@ class EmailAttachment(BaseModel):
     content: bytes
     mime_type: str
 
-class EmailRequest(BaseModel):
+class CampaignRequest(BaseModel):
+    """Campaign content without recipients, used when recipients are streamed separately."""
     subject: str = Field(..., min_length=1, max_length=200)
     body: str = Field(..., min_length=1)
-    recipients: List[EmailStr]
     attachments: Optional[List[EmailAttachment]] = None
+    attachment_ids: Optional[List[str]] = None  # IDs returned by /upload-attachments/
     embedded_links: Optional[List[str]] = None
     cc: Optional[List[EmailStr]] = None
-    bcc: Optional[List[EmailStr]] = None
\ No newline at end of file
+    bcc: Optional[List[EmailStr]] = None
+
+class EmailRequest(CampaignRequest):
+    recipients: List[EmailStr]
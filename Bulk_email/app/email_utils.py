@@ -1,14 +1,34 @@
 import os
 import asyncio
 import logging
-import base64
-from typing import List, Optional
+import time
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Union
 from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from email.mime.image import MIMEImage
-from aiosmtplib import send
+from aiosmtplib import SMTPRecipientsRefused, send
+from app.attachment_store import get_attachment_store
+from app.congestion import (
+    AdaptiveController,
+    backoff_delay,
+    is_throttle_error,
+    is_throttle_reply,
+    register_controller,
+    unregister_controller,
+)
+from app.domain_scheduler import DomainScheduler, iter_domain_batches, load_domain_limits, recipient_domain
+from app.delivery import SENT, FAILED, REJECTED, BatchDelivery, Recipient, RecipientResult, is_auth_error
 from app.email_schema import EmailAttachment
+from app.metrics import (
+    BATCH_SIZE,
+    BATCH_WAIT_SECONDS,
+    BATCHES_IN_FLIGHT,
+    MIME_BUILD_SECONDS,
+    RECIPIENTS,
+    RECIPIENTS_RETRIED,
+)
+from app.mime_builder import MessagePrototype
+from app.pacing_store import PacingStore, SharedTokenBucket
+from app.transport import Transport, get_transport
+from app.rate_limiter import TokenBucket
 from dotenv import load_dotenv
 
 
@@ -18,56 +38,6 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-def create_multipart_message(
-    subject: str,
-    body: str,
-    sender: str,
-    recipients: List[str],
-    attachments: Optional[List[EmailAttachment]] = None,
-    embedded_links: Optional[List[str]] = None,
-    cc: Optional[List[str]] = None,
-    bcc: Optional[List[str]] = None
-) -> MIMEMultipart:
-    """
-    Create a multipart email message with advanced features.
-    """
-    message = MIMEMultipart()
-    message['From'] = sender
-    message['To'] = ', '.join(recipients)
-
-    # Add CC and BCC if provided
-    if cc:
-        message['Cc'] = ', '.join(cc)
-    if bcc:
-        message['Bcc'] = ', '.join(bcc)
-
-    message['Subject'] = subject
-
-    # Add body
-    body_with_links = body
-    if embedded_links:
-        body_with_links += "\n\nAdditional Links:\n" + "\n".join(embedded_links)
-
-    message.attach(MIMEText(body_with_links, 'html'))
-
-    # Add attachments
-    if attachments:
-        for attachment in attachments:
-            decoded_content = base64.b64decode(attachment.content)
-
-            if attachment.mime_type.startswith('image/'):
-                mime_subtype = attachment.mime_type.split('/')[1]  # Extract MIME subtype
-                part = MIMEImage(decoded_content, _subtype=mime_subtype, name=attachment.filename)
-            elif attachment.mime_type.startswith('application/'):
-                part = MIMEApplication(decoded_content, name=attachment.filename)
-            else:
-                part = MIMEApplication(decoded_content, name=attachment.filename)
-
-            part['Content-Disposition'] = f'attachment; filename="{attachment.filename}"'
-            message.attach(part)
-
-    return message
-
 async def send_individual_email(
     recipient: str,
     message: MIMEMultipart,
@@ -92,104 +62,319 @@ async def send_individual_email(
         logger.error(f"Failed to send email to {recipient}: {e}")
         return False
 
+RecipientSource = Union[Iterable[Union[str, Recipient]], AsyncIterable[Union[str, Recipient]]]
+
+
+def _as_recipient(recipient: Union[str, Recipient]) -> Recipient:
+    return recipient if isinstance(recipient, Recipient) else Recipient(recipient)
+
+
+async def _iter_recipients(*sources: Optional[RecipientSource]) -> AsyncIterator[Recipient]:
+    """Chain plain and async recipient sources into one async stream."""
+    for source in sources:
+        if source is None:
+            continue
+        if hasattr(source, '__aiter__'):
+            async for recipient in source:
+                yield _as_recipient(recipient)
+        else:
+            for recipient in source:
+                yield _as_recipient(recipient)
+
 async def send_email(
     subject: str,
     body: str,
-    recipients: List[str],
+    recipients: RecipientSource,
     attachments: Optional[List[EmailAttachment]] = None,
     embedded_links: Optional[List[str]] = None,
-    cc: Optional[List[str]] = None,
-    bcc: Optional[List[str]] = None
-):
+    cc: Optional[List[Union[str, Recipient]]] = None,
+    bcc: Optional[List[Union[str, Recipient]]] = None,
+    attachment_ids: Optional[List[str]] = None,
+    max_concurrent_batches: Optional[int] = None,
+    messages_per_second: Optional[float] = None,
+    recipients_per_minute: Optional[float] = None,
+    on_batch_result: Optional[Callable[[int, List[RecipientResult]], Awaitable[None]]] = None,
+    first_batch_number: int = 1,
+    campaign_id: Optional[str] = None,
+    envelope_mode: Optional[bool] = None,
+    envelope_size: Optional[int] = None,
+    cc_header: Optional[List[str]] = None,
+    transport: Optional[Transport] = None,
+    pacing_store: Optional[PacingStore] = None,
+) -> Dict[str, int]:
     """
-    Send emails concurrently in batches of 10 recipients per thread with rate limiting and retries.
+    Send emails concurrently in batches of recipients with adaptive rate limiting and retries.
+
+    Recipients are grouped by destination domain so each batch envelope targets a single
+    domain. Up to ``max_concurrent_batches`` batches are in flight at once. Pacing comes
+    from two token buckets, one counting SMTP messages per second and one counting
+    recipients per minute; unset arguments fall back to the SEND_* environment variables
+    and a rate of zero disables that limit. An AdaptiveController treats those values as
+    ceilings: it halves the in-flight window and message rate when the server throttles
+    (421/451 or 4.7.x-style enhanced codes) and grows them back while replies are
+    healthy. Each domain also gets its own controller, seeded from SEND_DOMAIN_LIMITS,
+    so a throttling domain backs off without slowing the others. Retries back off
+    exponentially with jitter. While the send runs its congestion state is visible under
+    ``campaign_id`` through app.congestion.controller_snapshots().
+
+    The message is serialized once and each SMTP transaction carries it to a whole batch
+    of RCPT TO recipients. By default batches hold 10 recipients and the To header lists
+    the batch's To recipients. With ``envelope_mode`` (SEND_MODE=envelope) batches hold up
+    to ``envelope_size`` recipients (SEND_ENVELOPE_SIZE, default 50) and every message
+    carries the same neutral ``undisclosed-recipients:;`` To header, so the body crosses
+    the wire once per batch without exposing any recipient. CC addresses are delivered
+    from the envelope and listed in one static Cc header, ``cc_header`` when given; BCC
+    addresses only ever appear in the envelope.
+
+    Messages go out through ``transport``, by default the process-wide one chosen by
+    EMAIL_TRANSPORT, so the same pipeline can relay over SMTP or write to a file or
+    in-memory sink for dry runs and throughput tests.
+
+    Without ``pacing_store`` the rates limit this call alone. Sends that run side by side,
+    such as the shards of the job workers, pass a shared PacingStore instead: the message,
+    recipient and per-domain rates then hold for every send by the SMTP_USER account
+    together, while the adaptive controllers still back each send off on throttling. The
+    in-flight windows stay per send, so concurrent sends may have up to their sum in flight.
+
+    ``attachment_ids`` reference files in the attachment store, which are encoded from
+    disk rather than passed around in memory. ``recipients`` may be an async iterable, in
+    which case batches are dispatched as soon as they fill up while the rest of the
+    stream is still arriving.
+
+    Each recipient is tracked separately: refused RCPTs with a 5xx reply are recorded as
+    rejected and never retried, and retries only go to the recipients that failed
+    transiently. A batch whose transaction itself keeps failing, on connecting, AUTH or
+    DATA, rejects nobody: the send stops with that error and its unsettled recipients
+    are left unreported, so a retried job sends to them again. Authentication failures
+    stop it on the first attempt.
+
+    ``on_batch_result`` is awaited after each batch settles with the batch number and one
+    RecipientResult per settled recipient, so callers can persist progress; recipients
+    passed as Recipient carry their position into the result, which tells apart the rows
+    of an address listed more than once. ``first_batch_number`` lets a resumed job
+    continue its numbering. Returns a summary of batch and recipient counts.
     """
     # Load SMTP credentials dynamically
-    smtp_server = os.getenv("SMTP_SERVER")
-    smtp_port = int(os.getenv("SMTP_PORT", 587))
     smtp_user = os.getenv("SMTP_USER")
-    smtp_password = os.getenv("SMTP_PASSWORD")
+    if transport is None:
+        transport = get_transport()
 
-    # Process recipients in batches of 10
-    batch_size = 10
-    all_recipients = recipients.copy()
-    if cc:
-        all_recipients.extend(cc)
-    if bcc:
-        all_recipients.extend(bcc)
+    if envelope_mode is None:
+        envelope_mode = os.getenv("SEND_MODE", "headers").lower() == "envelope"
+    if envelope_size is None:
+        envelope_size = int(os.getenv("SEND_ENVELOPE_SIZE", 50))
 
-    # Split recipients into batches
-    recipient_batches = [all_recipients[i:i + batch_size] for i in range(0, len(all_recipients), batch_size)]
+    # Header mode keeps batches of 10; envelope mode amortizes DATA over larger batches
+    batch_size = max(1, envelope_size) if envelope_mode else 10
 
     # Rate limiting parameters
     max_retries = 3
-    delay_between_batches = 2  # seconds
-    max_concurrent_batches = 5  # Limit concurrent batches to avoid overwhelming the SMTP server
+    if max_concurrent_batches is None:
+        max_concurrent_batches = int(os.getenv("SEND_MAX_CONCURRENT_BATCHES", 5))
+    if messages_per_second is None:
+        messages_per_second = float(os.getenv("SEND_MESSAGES_PER_SECOND", 2))
+    if recipients_per_minute is None:
+        recipients_per_minute = float(os.getenv("SEND_RECIPIENTS_PER_MINUTE", 0))
+
+    retry_base_delay = float(os.getenv("SEND_RETRY_BASE_SECONDS", 5))
+    retry_max_delay = float(os.getenv("SEND_RETRY_MAX_SECONDS", 300))
+
+    controller = AdaptiveController(max_window=max_concurrent_batches, max_rate=messages_per_second)
+    scheduler = DomainScheduler(controller, load_domain_limits())
+    if pacing_store is not None:
+        account = smtp_user or "default"
+        message_bucket = pacing_store.bucket(f"{account}:messages", messages_per_second)
+        recipient_bucket = SharedTokenBucket.per_minute(
+            pacing_store, f"{account}:recipients", recipients_per_minute, capacity=batch_size
+        )
+    else:
+        # The controller's own bucket already holds a lone send to the message rate
+        message_bucket = TokenBucket(0)
+        recipient_bucket = TokenBucket.per_minute(recipients_per_minute, capacity=batch_size)
 
-    # Limit concurrent tasks
-    semaphore = asyncio.Semaphore(max_concurrent_batches)
+    def domain_bucket(domain: str):
+        if pacing_store is None:
+            return TokenBucket(0)
+        return pacing_store.bucket(f"{account}:domain:{domain}", scheduler.limits_for(domain).messages_per_second)
+
+    stored_attachments = []
+    if attachment_ids:
+        store = get_attachment_store()
+        for attachment_id in attachment_ids:
+            stored = store.get(attachment_id)
+            if stored is None:
+                raise ValueError(f"Unknown attachment ID: {attachment_id}")
+            stored_attachments.append(stored)
+
+    # Decode attachments and serialize the MIME tree once for the whole campaign,
+    # off the event loop since large attachments make this CPU-bound
+    with MIME_BUILD_SECONDS.labels(stage="prototype").time():
+        prototype = await asyncio.to_thread(
+            MessagePrototype,
+            sender=smtp_user,
+            subject=subject,
+            body=body,
+            attachments=attachments,
+            embedded_links=embedded_links,
+            stored_attachments=stored_attachments,
+            cc=cc if cc_header is None else cc_header,
+        )
+    # CC and BCC recipients travel in the envelope but are never named in To
+    hidden = {_as_recipient(recipient) for recipient in (cc or []) + (bcc or [])}
 
     async def send_batch(batch_recipients, batch_number):
-        async with semaphore:
-            for retry in range(max_retries):
-                try:
-                    # Create a new message for this batch
-                    batch_message = MIMEMultipart()
-                    batch_message['From'] = smtp_user
-                    batch_message['To'] = ', '.join(batch_recipients)
-                    batch_message['Subject'] = subject
-
-                    # Add body
-                    body_with_links = body
-                    if embedded_links:
-                        body_with_links += "\n\nAdditional Links:\n" + "\n".join(embedded_links)
-
-                    batch_message.attach(MIMEText(body_with_links, 'html'))
-
-                    # Add attachments
-                    if attachments:
-                        for attachment in attachments:
-                            decoded_content = base64.b64decode(attachment.content)
-
-                            if attachment.mime_type.startswith('image/'):
-                                mime_subtype = attachment.mime_type.split('/')[1]
-                                part = MIMEImage(decoded_content, _subtype=mime_subtype, name=attachment.filename)
-                            elif attachment.mime_type.startswith('application/'):
-                                part = MIMEApplication(decoded_content, name=attachment.filename)
-                            else:
-                                part = MIMEApplication(decoded_content, name=attachment.filename)
-
-                            part['Content-Disposition'] = f'attachment; filename="{attachment.filename}"'
-                            batch_message.attach(part)
-                    
-                    await send(
-                        batch_message,
-                        hostname=smtp_server,
-                        port=smtp_port,
-                        username=smtp_user,
-                        password=smtp_password,
-                        start_tls=True,
-                    )
-                    logger.info(f"Batch {batch_number}: Email sent successfully to {len(batch_recipients)} recipients")
-                    return True
-                except Exception as e:
-                    if retry < max_retries - 1:
-                        wait_time = (retry + 1) * 5  # Exponential backoff
-                        logger.warning(f"Batch {batch_number}: Retry {retry + 1}/{max_retries} after {wait_time} seconds. Error: {e}")
-                        await asyncio.sleep(wait_time)
-                    else:
-                        logger.error(f"Batch {batch_number}: Failed after {max_retries} retries. Error: {e}")
-                        return False
-
-    # Process batches with delays
-    results = []
-    for i, batch in enumerate(recipient_batches):
-        if i > 0:  # Add delay between batches, but not before the first batch
-            await asyncio.sleep(delay_between_batches)
-        result = await send_batch(batch, i + 1)
-        results.append(result)
+        delivery = BatchDelivery(batch_recipients)
+        domain = recipient_domain(batch_recipients[0].address)
+        domain_controller = scheduler.domain(domain)
+        shared_domain_bucket = domain_bucket(domain)
+        BATCH_SIZE.observe(len(batch_recipients))
+        # Set while the last attempt failed as a whole rather than per RCPT
+        transaction_error = None
+        for retry in range(max_retries):
+            # Only the To header differs between batches, and not at all in envelope mode
+            with MIME_BUILD_SECONDS.labels(stage="render").time():
+                if envelope_mode:
+                    batch_message = prototype.render()
+                else:
+                    batch_message = prototype.render([r.address for r in delivery.pending if r not in hidden])
+
+            # Wait for the domain's own slot and rate before taking a global slot,
+            # so a throttled domain never holds capacity other domains could use
+            waiting_since = time.perf_counter()
+            async with domain_controller.slot() as domain_started_at:
+                await domain_controller.pace(1)
+                await shared_domain_bucket.acquire(1)
+                async with controller.slot() as started_at:
+                    try:
+                        # Every attempt, retries included, spends tokens from every bucket
+                        await controller.pace(1)
+                        await message_bucket.acquire(1)
+                        await recipient_bucket.acquire(len(delivery.pending))
+                        BATCH_WAIT_SECONDS.observe(time.perf_counter() - waiting_since)
+
+                        # The SMTP transport reuses an authenticated pooled connection per batch
+                        attempted = len(delivery.pending)
+                        refused, response = await transport.send(prototype.sender, delivery.pending_addresses, batch_message)
+                        delivery.accept(refused, response)
+                        transaction_error = None
+                        # RCPT-level throttling is about the destination domain only
+                        if any(is_throttle_reply(reply.code, reply.message) for reply in refused.values()):
+                            domain_controller.on_throttle(domain_started_at)
+                            logger.warning(f"Batch {batch_number}: {domain} throttled, domain window now {domain_controller.window:.2f}")
+                        else:
+                            domain_controller.on_success()
+                        controller.on_success()
+                        logger.info(
+                            f"Batch {batch_number}: Email sent successfully to "
+                            f"{attempted - len(refused)} recipients, {len(refused)} refused"
+                        )
+                    except Exception as e:
+                        delivery.fail(e)
+                        if not isinstance(e, SMTPRecipientsRefused):
+                            transaction_error = e
+                        if is_auth_error(e):
+                            # Credentials do not start working on a retry
+                            logger.error(f"Batch {batch_number}: SMTP authentication failed. Error: {e}")
+                            break
+                        if isinstance(e, SMTPRecipientsRefused) and is_throttle_error(e):
+                            domain_controller.on_throttle(domain_started_at)
+                            logger.warning(f"Batch {batch_number}: {domain} throttled, domain window now {domain_controller.window:.2f}. Error: {e}")
+                        elif is_throttle_error(e):
+                            controller.on_throttle(started_at)
+                            logger.warning(f"Batch {batch_number}: Throttled by server, window now {controller.window:.2f}. Error: {e}")
+                        else:
+                            logger.warning(f"Batch {batch_number}: Attempt {retry + 1}/{max_retries} failed. Error: {e}")
+
+            if not delivery.pending:
+                break
+            if retry < max_retries - 1:
+                RECIPIENTS_RETRIED.inc(len(delivery.pending))
+                wait_time = backoff_delay(retry, base=retry_base_delay, cap=retry_max_delay)
+                logger.warning(f"Batch {batch_number}: Retrying {len(delivery.pending)} recipients after {wait_time:.1f} seconds")
+                await asyncio.sleep(wait_time)
+            else:
+                logger.error(f"Batch {batch_number}: {len(delivery.pending)} recipients failed after {max_retries} retries")
+
+        # A failure of the connection, AUTH or DATA says nothing about the recipients: keep
+        # what was settled and fail the send, so the rest stays pending for a retry of the job
+        outcomes = delivery.settled() if transaction_error is not None else delivery.outcomes()
+        for outcome in outcomes:
+            RECIPIENTS.labels(outcome=outcome.status).inc()
+        # Report outside the retry loop so a failing callback never triggers a resend
+        if on_batch_result and outcomes:
+            await on_batch_result(batch_number, outcomes)
+        if transaction_error is not None:
+            raise transaction_error
+        return outcomes
+
+    # Each batch runs as its own task so batches waiting on a slow domain do not
+    # block the others; the outstanding limit bounds memory on large streams
+    worker_count = max(1, max_concurrent_batches)
+    outstanding = asyncio.Semaphore(worker_count * 4)
+    totals = {"successful_batches": 0, "failed_batches": 0, SENT: 0, FAILED: 0, REJECTED: 0}
+    recipient_count = 0
+    tasks = set()
+    failures = []
+
+    def settle(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            failures.append(task.exception())
+
+    async def run_batch(batch, batch_number):
+        BATCHES_IN_FLIGHT.inc()
+        try:
+            outcomes = await send_batch(batch, batch_number)
+        finally:
+            BATCHES_IN_FLIGHT.dec()
+            outstanding.release()
+        # Keep running counts rather than every outcome of a large campaign
+        for outcome in outcomes:
+            totals[outcome.status] += 1
+        if all(outcome.status == SENT for outcome in outcomes):
+            totals["successful_batches"] += 1
+        else:
+            totals["failed_batches"] += 1
+
+    if campaign_id:
+        register_controller(campaign_id, scheduler)
+    try:
+        batches = iter_domain_batches(
+            _iter_recipients(recipients, cc, bcc),
+            batch_size,
+            max_buffered=batch_size * worker_count * 10,
+        )
+        index = 0
+        async for batch in batches:
+            await outstanding.acquire()
+            # Stop feeding new batches once one has failed outright
+            if failures:
+                outstanding.release()
+                break
+            recipient_count += len(batch)
+            task = asyncio.create_task(run_batch(batch, first_batch_number + index))
+            tasks.add(task)
+            task.add_done_callback(settle)
+            index += 1
+        await asyncio.gather(*tasks)
+        if failures:
+            raise failures[0]
+        # Sinks that buffer writes must persist the campaign before it counts as sent
+        await transport.flush()
+    except BaseException:
+        # A failed or cancelled batch stops the whole send; do not leave tasks behind
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        if campaign_id:
+            unregister_controller(campaign_id)
 
     # Log results
-    successful = sum(1 for result in results if result is True)
-    failed = len(recipient_batches) - successful
-    logger.info(f"Email send summary: Successful batches: {successful}, Failed batches: {failed}")
+    logger.info(
+        f"Email send summary: Successful batches: {totals['successful_batches']}, "
+        f"Failed batches: {totals['failed_batches']}, Recipients sent: {totals[SENT]}, "
+        f"failed: {totals[FAILED]}, rejected: {totals[REJECTED]}"
+    )
+    return {"recipients": recipient_count, **totals}
@@ -0,0 +1,502 @@
+import os
+import json
+import math
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.delivery import SENT, REJECTED
+
+
+load_dotenv()
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+PENDING = "pending"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    recipients_total INTEGER NOT NULL,
+    ingest_open INTEGER NOT NULL DEFAULT 0,
+    size_bytes INTEGER NOT NULL DEFAULT 0,
+    shard_size INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+
+CREATE TABLE IF NOT EXISTS job_recipients (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    batch_number INTEGER,
+    response_code INTEGER,
+    response TEXT,
+    updated_at REAL,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS job_recipients_status ON job_recipients (job_id, status);
+
+CREATE TABLE IF NOT EXISTS job_shards (
+    job_id TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    heartbeat_at REAL,
+    error TEXT,
+    PRIMARY KEY (job_id, shard)
+);
+CREATE INDEX IF NOT EXISTS job_shards_status ON job_shards (status, heartbeat_at);
+"""
+
+
+class JobStore:
+    """
+    SQLite-backed queue of send-email jobs.
+
+    Each job keeps its campaign payload and one row per envelope recipient, so progress
+    survives a restart and a resumed job only sends to recipients still marked pending.
+    A short-lived connection is opened per call, which keeps the store safe to use from
+    worker threads and from several processes sharing the same database file.
+
+    Recipients are split into shards of ``shard_size`` consecutive positions. Workers
+    lease one shard at a time and keep the lease alive with heartbeats, so several worker
+    processes can send parts of the same campaign at once, and a shard whose worker died
+    is picked up again once its lease runs out. A job finishes when its last shard does.
+    """
+
+    def __init__(self, path: str, shard_size: int = 1000):
+        self.path = path
+        self.shard_size = shard_size
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._migrate(conn)
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        """Add columns introduced after a database file was first created."""
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'ingest_open' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN ingest_open INTEGER NOT NULL DEFAULT 0")
+        if 'size_bytes' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN size_bytes INTEGER NOT NULL DEFAULT 0")
+        if 'shard_size' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN shard_size INTEGER NOT NULL DEFAULT 0")
+            # Jobs queued before sharding become shards of their own; running ones start over
+            # from their pending recipients like any interrupted job
+            unfinished = conn.execute(
+                "SELECT id, recipients_total FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchall()
+            conn.execute("UPDATE jobs SET shard_size = ?", (self.shard_size,))
+            for job in unfinished:
+                self._add_shards(conn, job['id'], self.shard_size, max(job['recipients_total'], 1))
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(job_recipients)")}
+        if 'response_code' not in columns:
+            conn.execute("ALTER TABLE job_recipients ADD COLUMN response_code INTEGER")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create_job(self, payload: Dict[str, Any], to: List[str], cc: Optional[List[str]] = None,
+                   bcc: Optional[List[str]] = None, ingest_open: bool = False,
+                   attachment_bytes: int = 0) -> str:
+        """
+        Persist a new job with its recipients and return its ID.
+
+        With ``ingest_open`` the job accepts more recipients through append_recipients
+        until close_ingest is called, and the worker waits for them instead of finishing.
+        The job's size, counted against the admission budget, is its serialized payload
+        plus ``attachment_bytes`` of stored attachments it references.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        rows = [(address, 'to') for address in to]
+        rows += [(address, 'cc') for address in cc or []]
+        rows += [(address, 'bcc') for address in bcc or []]
+        payload_json = json.dumps(payload)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, payload, recipients_total, ingest_open, size_bytes, shard_size, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, payload_json, len(rows), int(ingest_open),
+                 len(payload_json) + attachment_bytes, self.shard_size, now),
+            )
+            conn.executemany(
+                "INSERT INTO job_recipients (job_id, position, address, kind, status) VALUES (?, ?, ?, ?, ?)",
+                [(job_id, position, address, kind, PENDING) for position, (address, kind) in enumerate(rows)],
+            )
+            self._add_shards(conn, job_id, self.shard_size, len(rows))
+        return job_id
+
+    @staticmethod
+    def _add_shards(conn: sqlite3.Connection, job_id: str, shard_size: int, recipients_total: int) -> None:
+        """Queue the shards needed to cover ``recipients_total`` positions that do not exist yet."""
+        conn.executemany(
+            "INSERT OR IGNORE INTO job_shards (job_id, shard, status) VALUES (?, ?, ?)",
+            [(job_id, shard, QUEUED) for shard in range(math.ceil(recipients_total / shard_size))],
+        )
+
+    def append_recipients(self, job_id: str, addresses: List[str], kind: str = 'to') -> bool:
+        """Add recipients to a job that is still accepting them; False if it is not."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            job = conn.execute(
+                "SELECT recipients_total, ingest_open, shard_size FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if job is None or not job['ingest_open']:
+                return False
+            start = job['recipients_total']
+            conn.executemany(
+                "INSERT INTO job_recipients (job_id, position, address, kind, status) VALUES (?, ?, ?, ?, ?)",
+                [(job_id, start + offset, address, kind, PENDING) for offset, address in enumerate(addresses)],
+            )
+            conn.execute(
+                "UPDATE jobs SET recipients_total = ? WHERE id = ?", (start + len(addresses), job_id)
+            )
+            self._add_shards(conn, job_id, job['shard_size'], start + len(addresses))
+        return True
+
+    def get_payload(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row['payload']) if row else None
+
+    def close_ingest(self, job_id: str) -> None:
+        """Stop accepting recipients so the workers can finish the job once they are sent."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE jobs SET ingest_open = 0 WHERE id = ?", (job_id,))
+            # Every shard may already be done, or the job may never have received recipients
+            self._finish_if_done(conn, job_id)
+
+    def is_ingest_open(self, job_id: str) -> bool:
+        return self.ingest_state(job_id)[0]
+
+    def ingest_state(self, job_id: str) -> Tuple[bool, int]:
+        """Return whether a job still accepts recipients and how many it has so far."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT ingest_open, recipients_total FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return (bool(row['ingest_open']), row['recipients_total']) if row else (False, 0)
+
+    def claim_next_shard(self, worker: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        """
+        Lease the next shard to ``worker`` and return it with its job's payload.
+
+        Shards of older jobs go first. A running shard whose heartbeat is older than
+        ``lease_seconds`` belonged to a worker that died and is handed out again.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT job_shards.job_id, job_shards.shard, jobs.payload, jobs.shard_size, jobs.created_at "
+                "FROM job_shards JOIN jobs ON jobs.id = job_shards.job_id "
+                "WHERE job_shards.status = ? OR (job_shards.status = ? AND job_shards.heartbeat_at < ?) "
+                "ORDER BY jobs.created_at, job_shards.shard LIMIT 1",
+                (QUEUED, RUNNING, now - lease_seconds),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE job_shards SET status = ?, worker = ?, heartbeat_at = ? WHERE job_id = ? AND shard = ?",
+                (RUNNING, worker, now, row['job_id'], row['shard']),
+            )
+            conn.execute(
+                "UPDATE jobs SET status = ?, started_at = COALESCE(started_at, ?) WHERE id = ? AND status = ?",
+                (RUNNING, now, row['job_id'], QUEUED),
+            )
+        start = row['shard'] * row['shard_size']
+        return {
+            'id': row['job_id'],
+            'shard': row['shard'],
+            'start': start,
+            'end': start + row['shard_size'],
+            'payload': json.loads(row['payload']),
+            'created_at': row['created_at'],
+        }
+
+    def heartbeat(self, worker: str) -> int:
+        """Renew the leases of every shard ``worker`` is running."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE job_shards SET heartbeat_at = ? WHERE worker = ? AND status = ?",
+                (time.time(), worker, RUNNING),
+            )
+            return cursor.rowcount
+
+    def release_shard(self, job_id: str, shard: int, worker: str) -> None:
+        """Hand an unfinished shard back to the queue, keeping what it has already delivered."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE job_shards SET status = ?, worker = NULL, heartbeat_at = NULL "
+                "WHERE job_id = ? AND shard = ? AND worker = ? AND status = ?",
+                (QUEUED, job_id, shard, worker, RUNNING),
+            )
+
+    def finish_shard(self, job_id: str, shard: int, status: str, error: Optional[str] = None) -> Optional[str]:
+        """Record a shard's outcome and return the job's final status if this finished it."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE job_shards SET status = ?, error = ?, heartbeat_at = ? WHERE job_id = ? AND shard = ?",
+                (status, error, time.time(), job_id, shard),
+            )
+            return self._finish_if_done(conn, job_id)
+
+    @staticmethod
+    def _finish_if_done(conn: sqlite3.Connection, job_id: str) -> Optional[str]:
+        job = conn.execute("SELECT status, ingest_open FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None or job['ingest_open'] or job['status'] not in (QUEUED, RUNNING):
+            return None
+        unfinished = conn.execute(
+            "SELECT COUNT(*) FROM job_shards WHERE job_id = ? AND status IN (?, ?)", (job_id, QUEUED, RUNNING)
+        ).fetchone()[0]
+        if unfinished:
+            return None
+        failed = conn.execute(
+            "SELECT error FROM job_shards WHERE job_id = ? AND status = ? ORDER BY shard LIMIT 1", (job_id, FAILED)
+        ).fetchone()
+        status = FAILED if failed else COMPLETED
+        conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+            (status, time.time(), failed['error'] if failed else None, job_id),
+        )
+        return status
+
+    def retry_job(self, job_id: str) -> Optional[int]:
+        """
+        Queue a finished job again for the recipients it has not delivered.
+
+        Recipients that failed transiently go back to pending, alongside those a failed
+        shard never reached, and every shard holding pending recipients is queued again;
+        rejected recipients stay rejected. Returns how many recipients will be sent, or
+        None if the job is unknown or has not finished.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            job = conn.execute("SELECT status, shard_size FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None or job['status'] not in (COMPLETED, FAILED):
+                return None
+            conn.execute(
+                "UPDATE job_recipients SET status = ?, batch_number = NULL, response_code = NULL, response = NULL, "
+                "updated_at = ? WHERE job_id = ? AND status = ?",
+                (PENDING, time.time(), job_id, FAILED),
+            )
+            shards = conn.execute(
+                "SELECT position / ? AS shard, COUNT(*) AS pending FROM job_recipients "
+                "WHERE job_id = ? AND status = ? GROUP BY shard",
+                (job['shard_size'], job_id, PENDING),
+            ).fetchall()
+            if not shards:
+                return 0
+            conn.executemany(
+                "UPDATE job_shards SET status = ?, worker = NULL, heartbeat_at = NULL, error = NULL "
+                "WHERE job_id = ? AND shard = ?",
+                [(QUEUED, job_id, row['shard']) for row in shards],
+            )
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = NULL, error = NULL WHERE id = ?", (QUEUED, job_id)
+            )
+            return sum(row['pending'] for row in shards)
+
+    def queue_depth(self) -> Dict[str, int]:
+        """Count the jobs, undelivered recipients and bytes that are queued or running."""
+        with self._connect() as conn:
+            jobs = {
+                row['status']: row
+                for row in conn.execute(
+                    "SELECT status, COUNT(*) AS jobs, SUM(recipients_total) AS recipients, "
+                    "SUM(size_bytes) AS size_bytes FROM jobs WHERE status IN (?, ?) GROUP BY status",
+                    (QUEUED, RUNNING),
+                )
+            }
+            # Running jobs have already delivered part of their list; count what is left
+            running_pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs JOIN job_recipients ON job_recipients.job_id = jobs.id "
+                "WHERE jobs.status = ? AND job_recipients.status = ?",
+                (RUNNING, PENDING),
+            ).fetchone()[0]
+        queued, running = jobs.get(QUEUED), jobs.get(RUNNING)
+        return {
+            'jobs_queued': queued['jobs'] if queued else 0,
+            'jobs_running': running['jobs'] if running else 0,
+            'recipients': (queued['recipients'] if queued else 0) + running_pending,
+            'bytes': (queued['size_bytes'] if queued else 0) + (running['size_bytes'] if running else 0),
+        }
+
+    def pending_recipients(self, job_id: str, after_position: int = -1, limit: int = 1000,
+                           kind: Optional[str] = None,
+                           before_position: Optional[int] = None) -> List[Tuple[int, str, str]]:
+        """Return up to ``limit`` undelivered recipients after a position as (position, address, kind)."""
+        query = (
+            "SELECT position, address, kind FROM job_recipients "
+            "WHERE job_id = ? AND status = ? AND position > ?"
+        )
+        params: List[Any] = [job_id, PENDING, after_position]
+        if before_position is not None:
+            query += " AND position < ?"
+            params.append(before_position)
+        if kind:
+            query += " AND kind = ?"
+            params.append(kind)
+        query += " ORDER BY position LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            return [(row['position'], row['address'], row['kind']) for row in conn.execute(query, params)]
+
+    def recipients_of_kind(self, job_id: str, kind: str) -> List[str]:
+        """Return the CC or BCC addresses of a job."""
+        with self._connect() as conn:
+            return [
+                row['address'] for row in conn.execute(
+                    "SELECT address FROM job_recipients WHERE job_id = ? AND kind = ? ORDER BY position", (job_id, kind)
+                )
+            ]
+
+    def next_batch_number(self, job_id: str, shard: int = 0, shard_size: Optional[int] = None) -> int:
+        """
+        Return the batch number a shard should continue from.
+
+        A shard never sends more batches than it has recipients, so shard N numbers its
+        batches from N * shard_size + 1 and concurrent shards never share a number.
+        """
+        first = shard * (shard_size or self.shard_size) + 1
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MAX(batch_number) AS last FROM job_recipients "
+                "WHERE job_id = ? AND batch_number >= ? AND batch_number < ?",
+                (job_id, first, first + (shard_size or self.shard_size)),
+            ).fetchone()
+        return (row['last'] or first - 1) + 1
+
+    def record_results(self, job_id: str, batch_number: int, results: List[Tuple[int, str, Optional[int], str]]) -> None:
+        """
+        Store per-recipient outcomes of one batch as (position, status, code, response) tuples.
+
+        Rows are matched by position, not address, so an address that appears more than
+        once in a job only settles the row that was actually sent.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE job_recipients SET status = ?, batch_number = ?, response_code = ?, response = ?, "
+                "updated_at = ? WHERE job_id = ? AND position = ? AND status = ?",
+                [
+                    (status, batch_number, code, response, now, job_id, position, PENDING)
+                    for position, status, code, response in results
+                ],
+            )
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return job status with per-batch progress and throughput, or None if unknown."""
+        with self._connect() as conn:
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = {
+                row['status']: row['count']
+                for row in conn.execute(
+                    "SELECT status, COUNT(*) AS count FROM job_recipients WHERE job_id = ? GROUP BY status",
+                    (job_id,),
+                )
+            }
+            shards = {
+                row['status']: row['count']
+                for row in conn.execute(
+                    "SELECT status, COUNT(*) AS count FROM job_shards WHERE job_id = ? GROUP BY status",
+                    (job_id,),
+                )
+            }
+            batches = [
+                {
+                    'batch_number': row['batch_number'],
+                    'recipients': row['recipients'],
+                    'sent': row['sent'],
+                    'failed': row['failed'],
+                    'rejected': row['rejected'],
+                }
+                for row in conn.execute(
+                    "SELECT batch_number, COUNT(*) AS recipients, "
+                    "SUM(status = ?) AS sent, SUM(status = ?) AS failed, SUM(status = ?) AS rejected "
+                    "FROM job_recipients WHERE job_id = ? AND batch_number IS NOT NULL "
+                    "GROUP BY batch_number ORDER BY batch_number",
+                    (SENT, FAILED, REJECTED, job_id),
+                )
+            ]
+
+        sent = counts.get(SENT, 0)
+        elapsed = None
+        if job['started_at'] is not None:
+            elapsed = (job['finished_at'] or time.time()) - job['started_at']
+        return {
+            'job_id': job['id'],
+            'status': job['status'],
+            'ingest_open': bool(job['ingest_open']),
+            'error': job['error'],
+            'created_at': job['created_at'],
+            'started_at': job['started_at'],
+            'finished_at': job['finished_at'],
+            'recipients': {
+                'total': job['recipients_total'],
+                'sent': sent,
+                'failed': counts.get(FAILED, 0),
+                'rejected': counts.get(REJECTED, 0),
+                'pending': counts.get(PENDING, 0),
+            },
+            'shards': {status: shards.get(status, 0) for status in (QUEUED, RUNNING, COMPLETED, FAILED)},
+            'batches': batches,
+            'throughput_per_second': round(sent / elapsed, 3) if elapsed else None,
+        }
+
+    def list_recipients(self, job_id: str, status: Optional[str] = None, offset: int = 0,
+                        limit: int = 100) -> List[Dict[str, Any]]:
+        """Return per-recipient delivery state for a job, optionally filtered by status."""
+        query = (
+            "SELECT address, kind, status, batch_number, response_code, response, updated_at "
+            "FROM job_recipients WHERE job_id = ?"
+        )
+        params: List[Any] = [job_id]
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY position LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(query, params)]
+
+
+_store: Optional[JobStore] = None
+
+
+def get_job_store() -> JobStore:
+    """Return the process-wide job store located at JOB_DB_PATH, sharded by JOB_SHARD_SIZE."""
+    global _store
+    if _store is None:
+        _store = JobStore(os.getenv("JOB_DB_PATH", "data/jobs.db"), int(os.getenv("JOB_SHARD_SIZE", 1000)))
+    return _store
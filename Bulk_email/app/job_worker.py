@@ -0,0 +1,214 @@
+import os
+import asyncio
+import logging
+import socket
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from app.delivery import Recipient, RecipientResult
+from app.email_schema import EmailAttachment
+from app.email_utils import send_email
+from app.job_store import JobStore, COMPLETED, FAILED
+from app.metrics import QUEUE_WAIT_SECONDS
+from app.pacing_store import get_pacing_store
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorker:
+    """
+    Async worker that drains the persistent job queue.
+
+    It runs either inside the API event loop or, with SEND_WORKER_MODE=external, in the
+    worker processes started by ``python -m app.worker``. Each runner leases one shard
+    of a job at a time and records every batch outcome as it happens, while a heartbeat
+    keeps the leases alive; shards of a worker that stopped heartbeating are picked up
+    by the others. Recipients are read from the store in pages, so jobs whose ingest is
+    still open start sending while more recipients are being appended.
+    """
+
+    def __init__(self, store: JobStore, concurrency: int = 1, poll_interval: float = 5.0,
+                 lease_seconds: float = 120.0, name: Optional[str] = None):
+        self.store = store
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = asyncio.Event()
+        self._recipients_added: Dict[str, Set[asyncio.Event]] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._running: Set[Tuple[str, int]] = set()
+        self._draining = False
+
+    def notify(self, job_id: Optional[str] = None) -> None:
+        """Wake idle runners after a job has been enqueued or has received recipients."""
+        self._wakeup.set()
+        for added in self._recipients_added.get(job_id, ()):
+            added.set()
+
+    async def _pending_stream(self, job_id: str, start: int, end: int, page_size: int = 1000) -> AsyncIterator[Recipient]:
+        """
+        Yield undelivered To recipients of a job between two positions, waiting for more
+        while its ingest is open and the range is not yet filled.
+        """
+        # One event per stream, since several shards of a job may be sending from this process
+        added = asyncio.Event()
+        self._recipients_added.setdefault(job_id, set()).add(added)
+        after_position = start - 1
+        try:
+            while True:
+                added.clear()
+                # Check before reading so recipients appended just before close are not missed
+                ingest_open, total = await asyncio.to_thread(self.store.ingest_state, job_id)
+                rows = await asyncio.to_thread(
+                    self.store.pending_recipients, job_id, after_position, page_size, 'to', end
+                )
+                if rows:
+                    after_position = rows[-1][0]
+                    for position, address, _ in rows:
+                        yield Recipient(address, position)
+                elif not ingest_open or total >= end:
+                    return
+                else:
+                    try:
+                        await asyncio.wait_for(added.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            waiting = self._recipients_added.get(job_id)
+            if waiting is not None:
+                waiting.discard(added)
+                if not waiting:
+                    del self._recipients_added[job_id]
+
+    async def _pending_of_kind(self, job_id: str, kind: str, start: int, end: int) -> List[Recipient]:
+        """Return the undelivered CC or BCC recipients of a job between two positions."""
+        rows = await asyncio.to_thread(self.store.pending_recipients, job_id, start - 1, end - start, kind, end)
+        return [Recipient(address, position) for position, address, _ in rows]
+
+    async def start(self) -> None:
+        self._draining = False
+        self._heartbeat = asyncio.create_task(self._keep_leases())
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+
+    async def stop(self, grace_period: float = 0) -> None:
+        """
+        Stop claiming shards and give running ones ``grace_period`` seconds to finish.
+
+        Shards still running after that are cancelled and handed back to the queue, so
+        another worker resumes them from their pending recipients.
+        """
+        self._draining = True
+        self._wakeup.set()
+        if grace_period and self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=grace_period)
+            if pending:
+                logger.warning(f"Worker {self.name}: {len(self._running)} shard(s) still running, handing them back")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+            self._heartbeat = None
+
+    async def _keep_leases(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 4)
+            try:
+                await asyncio.to_thread(self.store.heartbeat, self.name)
+            except Exception as e:
+                logger.error(f"Worker {self.name}: heartbeat failed: {e}")
+
+    async def _run(self) -> None:
+        while not self._draining:
+            shard = await asyncio.to_thread(self.store.claim_next_shard, self.name, self.lease_seconds)
+            if shard is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.run_shard(shard)
+
+    async def run_shard(self, shard: dict) -> None:
+        job_id, index, payload = shard['id'], shard['shard'], shard['payload']
+        positions = (shard['start'], shard['end'])
+        self._running.add((job_id, index))
+        logger.info(f"Job {job_id}: shard {index} started by {self.name}")
+        QUEUE_WAIT_SECONDS.observe(max(0.0, time.time() - shard['created_at']))
+
+        async def record(batch_number: int, outcomes: List[RecipientResult]):
+            await asyncio.to_thread(
+                self.store.record_results,
+                job_id,
+                batch_number,
+                [(outcome.position, outcome.status, outcome.code, outcome.response) for outcome in outcomes],
+            )
+
+        try:
+            first_batch_number = await asyncio.to_thread(
+                self.store.next_batch_number, job_id, index, shard['end'] - shard['start']
+            )
+            # CC and BCC are fixed when the job is created; only the pending ones in this shard still need a send
+            cc = await self._pending_of_kind(job_id, 'cc', *positions)
+            bcc = await self._pending_of_kind(job_id, 'bcc', *positions)
+            cc_header = payload.get('cc')
+            if cc_header is None:
+                cc_header = await asyncio.to_thread(self.store.recipients_of_kind, job_id, 'cc')
+            attachments = payload.get('attachments')
+            summary = await send_email(
+                subject=payload['subject'],
+                body=payload['body'],
+                recipients=self._pending_stream(job_id, *positions),
+                attachments=[EmailAttachment(**a) for a in attachments] if attachments else None,
+                embedded_links=payload.get('embedded_links'),
+                cc=cc,
+                bcc=bcc,
+                cc_header=cc_header,
+                attachment_ids=payload.get('attachment_ids'),
+                on_batch_result=record,
+                first_batch_number=first_batch_number,
+                campaign_id=f"{job_id}:{index}",
+                # Shards running at once, here or in other workers, share the account's send rates
+                pacing_store=get_pacing_store(),
+            )
+        except asyncio.CancelledError:
+            # Recorded batches stay delivered; the rest of the shard goes back to the queue
+            self.store.release_shard(job_id, index, self.name)
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id}: shard {index} failed: {e}")
+            outcome = await asyncio.to_thread(self.store.finish_shard, job_id, index, FAILED, str(e))
+        else:
+            logger.info(f"Job {job_id}: shard {index} finished {summary}")
+            outcome = await asyncio.to_thread(self.store.finish_shard, job_id, index, COMPLETED)
+        finally:
+            self._running.discard((job_id, index))
+        if outcome:
+            logger.info(f"Job {job_id}: {outcome}")
+
+_worker: Optional[JobWorker] = None
+
+
+def get_job_worker(store: JobStore) -> JobWorker:
+    """
+    Return the process-wide worker, sized by JOB_WORKER_CONCURRENCY shards at a time.
+
+    JOB_WORKER_POLL_SECONDS sets how often an idle worker checks the store for work, and
+    JOB_LEASE_SECONDS how long a shard stays leased to a worker that stopped heartbeating.
+    """
+    global _worker
+    if _worker is None:
+        _worker = JobWorker(
+            store,
+            concurrency=int(os.getenv("JOB_WORKER_CONCURRENCY", 1)),
+            poll_interval=float(os.getenv("JOB_WORKER_POLL_SECONDS", 5)),
+            lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", 120)),
+        )
+    return _worker
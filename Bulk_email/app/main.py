@@ -1,20 +1,44 @@
+import os
+import asyncio
 import base64
 import logging
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, UploadFile, File
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-from typing import List
+from fastapi.responses import JSONResponse, Response
+from typing import AsyncIterator, List, Optional
 
-from app.email_utils import send_email
-from app.email_schema import EmailRequest, EmailAttachment
+from app.admission import AdmissionRejected, get_admission_controller
+from app.attachment_store import get_attachment_store
+from app.congestion import controller_snapshots
+from app.email_schema import CampaignRequest, EmailRequest
+from app.job_store import get_job_store
+from app.job_worker import get_job_worker
+from app.metrics import CONTENT_TYPE, render as render_metrics
+from app.quota import get_quota_store, message_bytes
+from app.recipient_stream import RejectedValues, detect_format, iter_recipient_chunks
+from app.relays import RelayTransport
+from app.transport import close_transport, get_transport
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Advanced Email Sending API")
+# "inline" sends from this process; "external" only enqueues for `python -m app.worker`
+SEND_WORKER_MODE = os.getenv("SEND_WORKER_MODE", "inline").lower()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pick up jobs that were queued or interrupted before the last shutdown
+    worker = get_job_worker(get_job_store())
+    if SEND_WORKER_MODE == "inline":
+        await worker.start()
+    yield
+    await worker.stop()
+    # Flush file sinks and log out of pooled SMTP connections cleanly on shutdown
+    await close_transport()
+
+app = FastAPI(title="Advanced Email Sending API", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -25,73 +49,296 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Rate limiting configuration
-limiter = Limiter(
-    key_func=get_remote_address,
-    default_limits=["50/minute"]  # Increased from 5/minute to 50/minute
-)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+def api_key(request: Request) -> Optional[str]:
+    """
+    The caller's API key, which selects its sending quota.
+
+    Once API keys are configured a request without one of them is refused with 401;
+    until then keys are ignored and only the sender's quota applies.
+    """
+    policy = get_quota_store().policy
+    key = request.headers.get("X-API-Key") or None
+    if not policy.is_known_key(key):
+        raise HTTPException(status_code=401, detail="Missing or unknown API key")
+    return key if policy.api_keys else None
+
+@asynccontextmanager
+async def charged_quota(request: Request, payload: dict, recipients: int) -> AsyncIterator[None]:
+    """
+    Charge recipients, and their message bytes, to the sender's and the caller's quotas
+    (see app.quota) for the work queued in the block, refunding them if the block fails;
+    raises QuotaExceeded, answered like an admission rejection.
+    """
+    key = api_key(request)
+    size = message_bytes(payload, get_attachment_store()) * recipients
+    store = get_quota_store()
+    await asyncio.to_thread(store.charge, key, recipients, size)
+    try:
+        yield
+    except BaseException:
+        await asyncio.to_thread(store.refund, key, recipients, size)
+        raise
+
+# Quota rejections share the admission handler: 429 or 413 with Retry-After
+def admission_rejected_response(request: Request, exc: AdmissionRejected) -> JSONResponse:
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after else None
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail}, headers=headers)
+
+app.add_exception_handler(AdmissionRejected, admission_rejected_response)
+
+# Endpoints whose JSON body is parsed into memory in one piece
+ADMITTED_BODY_PATHS = {"/send-email/", "/campaigns/"}
+
+@app.middleware("http")
+async def reserve_request_body(request: Request, call_next):
+    """
+    Count a request body against the byte budget before it is read and parsed, so a
+    burst of large payloads is turned away instead of being buffered all at once.
+    """
+    content_length = request.headers.get("content-length")
+    if request.method != "POST" or request.url.path not in ADMITTED_BODY_PATHS or not content_length:
+        return await call_next(request)
+    try:
+        async with get_admission_controller(get_job_store()).reserve(size_bytes=int(content_length)):
+            return await call_next(request)
+    except AdmissionRejected as e:
+        return admission_rejected_response(request, e)
+
+def validate_campaign_attachments(campaign: CampaignRequest) -> int:
+    """
+    Reject inline attachments with bad base64 and unknown attachment IDs, and return the
+    total size of the stored attachments the campaign references.
+    """
+    if campaign.attachments:
+        for attachment in campaign.attachments:
+            try:
+                base64.b64decode(attachment.content)  # Validate base64 encoding
+            except Exception:
+                raise HTTPException(status_code=400, detail=f"Invalid base64 content in attachment: {attachment.filename}")
+
+    attachment_bytes = 0
+    if campaign.attachment_ids:
+        attachment_store = get_attachment_store()
+        for attachment_id in campaign.attachment_ids:
+            stored = attachment_store.get(attachment_id)
+            if stored is None:
+                raise HTTPException(status_code=400, detail=f"Unknown attachment ID: {attachment_id}")
+            attachment_bytes += stored.size
+    return attachment_bytes
 
 @app.post("/send-email/")
-@limiter.limit("50/minute")  # Increased from 5/minute to 50/minute
 async def send_email_endpoint(
     request: Request,
-    email_data: EmailRequest,
-    background_tasks: BackgroundTasks
+    email_data: EmailRequest
 ):
     """
-    Endpoint to send emails.
+    Endpoint to send emails. The campaign is persisted as a job and sent by the job worker.
     """
     try:
         if not email_data.recipients:
             raise HTTPException(status_code=400, detail="At least one recipient is required")
 
-        if email_data.attachments:
-            for attachment in email_data.attachments:
-                try:
-                    base64.b64decode(attachment.content)  # Validate base64 encoding
-                except Exception:
-                    raise HTTPException(status_code=400, detail=f"Invalid base64 content in attachment: {attachment.filename}")
-
-        background_tasks.add_task(
-            send_email,
-            subject=email_data.subject,
-            body=email_data.body,
-            recipients=email_data.recipients,
-            attachments=email_data.attachments,
-            embedded_links=email_data.embedded_links,
-            cc=email_data.cc,
-            bcc=email_data.bcc
-        )
+        attachment_bytes = validate_campaign_attachments(email_data)
+
+        store = get_job_store()
+        payload = email_data.model_dump(mode="json", exclude={"recipients", "bcc"})
+        recipient_count = len(email_data.recipients) + len(email_data.cc or []) + len(email_data.bcc or [])
+        async with get_admission_controller(store).reserve(recipients=recipient_count, jobs=1):
+            async with charged_quota(request, payload, recipient_count):
+                job_id = await asyncio.to_thread(
+                    store.create_job,
+                    payload,
+                    email_data.recipients,
+                    email_data.cc,
+                    email_data.bcc,
+                    attachment_bytes=attachment_bytes
+                )
+        get_job_worker(store).notify()
 
         return {
             "message": f"Email is being sent to {len(email_data.recipients)} recipients",
-            "recipients_count": len(email_data.recipients)
+            "recipients_count": len(email_data.recipients),
+            "job_id": job_id
         }
 
+    except (HTTPException, AdmissionRejected):
+        raise
     except Exception as e:
         logger.error(f"Error while sending email: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/campaigns/")
+async def create_campaign(request: Request, campaign: CampaignRequest):
+    """
+    Create a job whose recipients are streamed in through /campaigns/{job_id}/recipients.
+    """
+    attachment_bytes = validate_campaign_attachments(campaign)
+
+    store = get_job_store()
+    payload = campaign.model_dump(mode="json", exclude={"bcc"})
+    recipient_count = len(campaign.cc or []) + len(campaign.bcc or [])
+    async with get_admission_controller(store).reserve(recipients=recipient_count, jobs=1):
+        async with charged_quota(request, payload, recipient_count):
+            job_id = await asyncio.to_thread(
+                store.create_job, payload, [], campaign.cc, campaign.bcc,
+                ingest_open=True, attachment_bytes=attachment_bytes
+            )
+    get_job_worker(store).notify()
+
+    return {
+        "message": "Campaign created; stream recipients to start sending",
+        "job_id": job_id
+    }
+
+@app.post("/campaigns/{job_id}/recipients")
+async def stream_campaign_recipients(request: Request, job_id: str, final: bool = True):
+    """
+    Stream recipients into an open campaign as NDJSON or CSV.
+
+    Addresses are validated and handed to the job worker in small chunks while the body
+    is still being received, so the first batches go out before the upload finishes.
+    Pass ``final=false`` to keep the campaign open for further uploads. Only an upload
+    that reaches the end of its body closes the campaign: one cut short by a client
+    disconnect or an error leaves it open. If the send queue runs out of recipient
+    budget, or the caller out of quota, the upload stops with 429 and the campaign stays
+    open; the response reports how many recipients were accepted so the client can
+    resume from there after Retry-After.
+    """
+    store = get_job_store()
+    if not await asyncio.to_thread(store.is_ingest_open, job_id):
+        raise HTTPException(status_code=409, detail="Campaign is not accepting recipients")
+    payload = await asyncio.to_thread(store.get_payload, job_id)
+
+    worker = get_job_worker(store)
+    admission = get_admission_controller(store)
+    rejected = RejectedValues()
+    accepted = 0
+    try:
+        chunks = iter_recipient_chunks(request.stream(), detect_format(request.headers.get("content-type")), rejected)
+        async for addresses in chunks:
+            async with admission.reserve(recipients=len(addresses)):
+                async with charged_quota(request, payload, len(addresses)):
+                    if not await asyncio.to_thread(store.append_recipients, job_id, addresses):
+                        raise HTTPException(status_code=409, detail="Campaign stopped accepting recipients")
+            accepted += len(addresses)
+            worker.notify(job_id)
+    except AdmissionRejected as e:
+        e.detail = f"{e.detail}; {accepted} recipients accepted before the limit"
+        raise
+
+    if final:
+        await asyncio.to_thread(store.close_ingest, job_id)
+        worker.notify(job_id)
+
+    return {
+        "job_id": job_id,
+        "accepted": accepted,
+        "rejected": rejected.count,
+        "rejected_sample": rejected.sample,
+        "ingest_open": not final
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """
+    Report per-batch and per-recipient progress and throughput of a send job.
+    """
+    job = await asyncio.to_thread(get_job_store().get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # Shards sent by this process; those in worker processes are not visible here
+    throttle = {
+        campaign_id.split(":", 1)[1]: snapshot
+        for campaign_id, snapshot in controller_snapshots().items()
+        if campaign_id.startswith(f"{job_id}:")
+    }
+    job["throttle"] = throttle or None
+    return job
+
+@app.post("/jobs/{job_id}/retry")
+async def retry_job(job_id: str):
+    """
+    Send a finished job again to the recipients it has not delivered: those a failed
+    SMTP connection or login left pending and those that failed transiently.
+    """
+    store = get_job_store()
+    pending = await asyncio.to_thread(store.retry_job, job_id)
+    if pending is None:
+        if await asyncio.to_thread(store.get_payload, job_id) is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        raise HTTPException(status_code=409, detail="Job has not finished")
+    if pending:
+        get_job_worker(store).notify()
+    return {"job_id": job_id, "recipients_pending": pending}
+
+@app.get("/queue")
+async def get_queue_status():
+    """
+    Report the queued and in-flight jobs, recipients and bytes against the admission budget.
+    """
+    return await get_admission_controller(get_job_store()).snapshot()
+
+@app.get("/quota")
+async def get_quota_status(request: Request):
+    """
+    Show what is left of the sender's quota and, with X-API-Key, of the caller's.
+    """
+    return await asyncio.to_thread(get_quota_store().remaining, api_key(request))
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Export send-pipeline counters, histograms and gauges in the Prometheus text format.
+
+    In SEND_WORKER_MODE=external the sending happens in the worker processes, which
+    serve their own metrics when started with --metrics-port.
+    """
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
+
+@app.get("/delivery/throttle")
+async def get_throttle_state():
+    """
+    Show the adaptive concurrency window and send rate of every running job.
+    """
+    return {"jobs": controller_snapshots()}
+
+@app.get("/delivery/relays")
+async def get_relay_state():
+    """
+    Show each SMTP relay's weight, circuit-breaker state and traffic when SMTP_RELAYS is set.
+    """
+    transport = get_transport()
+    if not isinstance(transport, RelayTransport):
+        return {"strategy": None, "relays": {}}
+    return transport.snapshot()
+
+@app.get("/jobs/{job_id}/recipients")
+async def get_job_recipients(job_id: str, status: Optional[str] = None, offset: int = 0, limit: int = 100):
+    """
+    List the delivery state of each recipient of a job, optionally filtered by status.
+    """
+    store = get_job_store()
+    job = await asyncio.to_thread(store.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    recipients = await asyncio.to_thread(store.list_recipients, job_id, status, offset, min(limit, 1000))
+    return {"job_id": job_id, "offset": offset, "recipients": recipients}
+
 @app.post("/upload-attachments/")
 async def upload_attachments(files: List[UploadFile] = File(...)):
     """
-    Endpoint to upload attachments.
+    Endpoint to upload attachments. Files are streamed into the content-addressed
+    attachment store and can then be referenced from EmailRequest.attachment_ids.
     """
+    store = get_attachment_store()
     attachments = []
     for file in files:
-        content = await file.read()
-        encoded_content = base64.b64encode(content).decode('utf-8')
-
-        attachment = EmailAttachment(
-            filename=file.filename,
-            content=encoded_content,
-            mime_type=file.content_type or 'application/octet-stream'
-        )
-        attachments.append(attachment)
+        attachments.append(await store.save_upload(file))
 
     return {
         "message": f"Successfully uploaded {len(attachments)} files",
-        "attachments": [{"filename": a.filename, "mime_type": a.mime_type} for a in attachments]
+        "attachments": [
+            {"id": a.id, "filename": a.filename, "mime_type": a.mime_type, "size": a.size}
+            for a in attachments
+        ]
     }
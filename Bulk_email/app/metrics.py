@@ -0,0 +1,71 @@
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, disable_created_metrics, generate_latest,
+)
+
+
+# Prometheus text exposition format
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Drop the *_created series, which record when each counter and histogram came to be
+disable_created_metrics()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUEUE_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, 14400.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Kept apart from prometheus_client's default registry, so /metrics shows only the send
+# pipeline and not the process collectors
+REGISTRY = CollectorRegistry()
+
+# Send pipeline, in the order a recipient goes through it
+QUEUE_WAIT_SECONDS = Histogram(
+    "bulk_email_queue_wait_seconds",
+    "Time from job creation until a worker starts sending one of its shards.",
+    buckets=QUEUE_BUCKETS, registry=REGISTRY,
+)
+MIME_BUILD_SECONDS = Histogram(
+    "bulk_email_mime_build_seconds",
+    "Time spent building messages: the campaign prototype once, then each batch's render.",
+    ["stage"], buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+BATCH_SIZE = Histogram(
+    "bulk_email_batch_size_recipients", "Envelope recipients per batch.", buckets=SIZE_BUCKETS, registry=REGISTRY,
+)
+BATCH_WAIT_SECONDS = Histogram(
+    "bulk_email_batch_wait_seconds",
+    "Time a batch attempt waits for a concurrency slot and rate-limit tokens before it is sent.",
+    buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+BATCHES_IN_FLIGHT = Gauge(
+    "bulk_email_batches_in_flight", "Batches dispatched and not yet settled, including retries and waits.",
+    registry=REGISTRY,
+)
+SMTP_CONNECT_SECONDS = Histogram(
+    "bulk_email_smtp_connect_seconds", "Time to open an SMTP connection, including EHLO and STARTTLS.",
+    buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+SMTP_LOGIN_SECONDS = Histogram(
+    "bulk_email_smtp_login_seconds", "Time to authenticate an SMTP connection.",
+    buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+SMTP_DATA_SECONDS = Histogram(
+    "bulk_email_smtp_data_seconds", "Time from the DATA command until the server accepts the message.",
+    buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+SMTP_POOL_CONNECTIONS = Gauge(
+    "bulk_email_smtp_pool_connections", "Connections in each relay's SMTP pool by state.", ["relay", "state"],
+    registry=REGISTRY,
+)
+RECIPIENTS = Counter(
+    "bulk_email_recipients_total",
+    "Recipients by final outcome: sent, failed after retries, or rejected by the server with a 5xx.",
+    ["outcome"], registry=REGISTRY,
+)
+RECIPIENTS_RETRIED = Counter(
+    "bulk_email_recipients_retried_total", "Recipients sent again after a transient failure.", registry=REGISTRY,
+)
+
+
+def render() -> bytes:
+    """Render every send-pipeline metric in the Prometheus text format."""
+    return generate_latest(REGISTRY)
@@ -0,0 +1,102 @@
+import base64
+from email import policy
+from email.mime.application import MIMEApplication
+from email.mime.base import MIMEBase
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import List, Optional
+
+from app.attachment_store import StoredAttachment, encode_file_base64
+from app.email_schema import EmailAttachment
+
+
+# Serialize with CRLF line endings so the bytes can go to SMTP as they are
+_WIRE_POLICY = policy.compat32.clone(linesep="\r\n")
+_HEADER_POLICY = policy.SMTP
+
+# To header for envelope-only sends, naming no recipient (RFC 5322 empty group)
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+
+
+def build_attachment_part(attachment: EmailAttachment) -> MIMEApplication:
+    """Decode a base64 attachment and wrap it in the matching MIME part."""
+    decoded_content = base64.b64decode(attachment.content)
+
+    if attachment.mime_type.startswith('image/'):
+        mime_subtype = attachment.mime_type.split('/')[1]  # Extract MIME subtype
+        part = MIMEImage(decoded_content, _subtype=mime_subtype, name=attachment.filename)
+    else:
+        part = MIMEApplication(decoded_content, name=attachment.filename)
+
+    part['Content-Disposition'] = f'attachment; filename="{attachment.filename}"'
+    return part
+
+
+def build_stored_attachment_part(attachment: StoredAttachment) -> MIMEBase:
+    """Wrap a stored attachment in a MIME part, encoding it straight from disk."""
+    maintype, _, subtype = attachment.mime_type.partition('/')
+    if not subtype:
+        maintype, subtype = 'application', 'octet-stream'
+    part = MIMEBase(maintype, subtype, name=attachment.filename)
+    # Hand the generator ready-made base64 so it does not re-encode the payload. The file is
+    # read through mmap in chunks, but the base64 text (4/3 of the file) is built in full and
+    # stays in the prototype's serialized bytes for the whole campaign
+    part.set_payload(encode_file_base64(attachment.path))
+    part['Content-Transfer-Encoding'] = 'base64'
+    part['Content-Disposition'] = f'attachment; filename="{attachment.filename}"'
+    return part
+
+
+class MessagePrototype:
+    """
+    Campaign-level message built once and reused for every batch.
+
+    The body and attachments are decoded, encoded and serialized a single time. Each
+    batch only prepends its own To header line to the cached bytes; the Cc header is
+    static for the campaign and BCC addresses never appear in the headers. Sends that
+    name no To recipients reuse one fully serialized message with a neutral To header.
+    """
+
+    def __init__(
+        self,
+        sender: str,
+        subject: str,
+        body: str,
+        attachments: Optional[List[EmailAttachment]] = None,
+        embedded_links: Optional[List[str]] = None,
+        stored_attachments: Optional[List[StoredAttachment]] = None,
+        cc: Optional[List[str]] = None,
+    ):
+        message = MIMEMultipart()
+        message['From'] = sender
+        if cc:
+            message['Cc'] = ', '.join(cc)
+        message['Subject'] = subject
+
+        # Add body
+        body_with_links = body
+        if embedded_links:
+            body_with_links += "\n\nAdditional Links:\n" + "\n".join(embedded_links)
+
+        message.attach(MIMEText(body_with_links, 'html'))
+
+        # Add attachments
+        for attachment in attachments or []:
+            message.attach(build_attachment_part(attachment))
+        for stored in stored_attachments or []:
+            message.attach(build_stored_attachment_part(stored))
+
+        self.sender = sender
+        self._message_bytes = message.as_bytes(policy=_WIRE_POLICY)
+        self._undisclosed_bytes = _HEADER_POLICY.fold_binary('To', UNDISCLOSED_RECIPIENTS) + self._message_bytes
+
+    @property
+    def size(self) -> int:
+        return len(self._message_bytes)
+
+    def render(self, to: Optional[List[str]] = None) -> bytes:
+        """Return the wire bytes for one send, listing ``to`` in the To header if given."""
+        if not to:
+            return self._undisclosed_bytes
+        return _HEADER_POLICY.fold_binary('To', ', '.join(to)) + self._message_bytes
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pacing_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class PacingStore:
+    """
+    Send-rate token buckets in SQLite, shared by every process that opens the same file.
+
+    Provider limits apply to the sending account as a whole, so shards running at the
+    same time, in one worker or in several worker processes, must draw from the same
+    buckets rather than each pacing itself to the full rate. A bucket holds up to
+    ``capacity`` tokens and refills at ``rate`` per second; rate and capacity are passed
+    with every reservation, so only the level and its timestamp are stored.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def reserve(self, key: str, tokens: float, rate: float, capacity: float) -> float:
+        """
+        Take ``tokens`` from a bucket and return the seconds to wait before using them.
+
+        Reservations queue up: each one leaves the bucket in debt until its turn, so the
+        next caller waits behind it. As with TokenBucket, a request larger than the
+        capacity goes through once the bucket is full and leaves it in debt.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated_at FROM pacing_buckets WHERE key = ?", (key,)).fetchone()
+            level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            wait = max(0.0, min(tokens, capacity) - level) / rate
+            conn.execute(
+                "INSERT INTO pacing_buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, level - tokens, now),
+            )
+        return wait
+
+    def bucket(self, key: str, rate: float, capacity: Optional[float] = None) -> "SharedTokenBucket":
+        return SharedTokenBucket(self, key, rate, capacity)
+
+
+class SharedTokenBucket:
+    """A TokenBucket whose level lives in a PacingStore; a rate of zero or less disables it."""
+
+    def __init__(self, store: PacingStore, key: str, rate: float, capacity: Optional[float] = None):
+        self.store = store
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+
+    @classmethod
+    def per_minute(cls, store: PacingStore, key: str, amount: float,
+                   capacity: Optional[float] = None) -> "SharedTokenBucket":
+        return cls(store, key, amount / 60.0, capacity if capacity is not None else max(amount / 60.0, 1.0))
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """Wait until this reservation's turn among every process sharing the bucket."""
+        if self.unlimited:
+            return
+        wait = await asyncio.to_thread(self.store.reserve, self.key, tokens, self.rate, self.capacity)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_store: Optional[PacingStore] = None
+
+
+def get_pacing_store() -> PacingStore:
+    """Return the process-wide pacing store located at SEND_PACING_DB_PATH."""
+    global _store
+    if _store is None:
+        _store = PacingStore(os.getenv("SEND_PACING_DB_PATH", "data/pacing.db"))
+    return _store
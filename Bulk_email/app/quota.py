@@ -0,0 +1,239 @@
+import os
+import json
+import math
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.admission import AdmissionRejected
+from app.attachment_store import AttachmentStore
+
+
+load_dotenv()
+
+RECIPIENTS = "recipients"
+BYTES = "bytes"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS quota_buckets (
+    scope TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (scope, dimension)
+);
+"""
+
+
+class QuotaExceeded(AdmissionRejected):
+    """A request whose recipients or bytes exceed what its quota has left."""
+
+
+@dataclass(frozen=True)
+class QuotaLimits:
+    # Allowance per quota window; zero leaves a dimension unlimited
+    recipients: int = 0
+    bytes: int = 0
+
+    def limit(self, dimension: str) -> int:
+        return self.recipients if dimension == RECIPIENTS else self.bytes
+
+
+@dataclass(frozen=True)
+class QuotaPolicy:
+    """
+    Which quotas a request is charged against.
+
+    Every request counts against the sending account (SMTP_USER), whose limits mirror
+    the provider's reputation limits. When API keys are configured every request must
+    present one of them and counts against that key as well, with per-key overrides
+    taking precedence over the key default. Keys are never created on the fly, so a
+    caller cannot leave its quota behind by omitting or changing its key.
+    """
+
+    window_seconds: float
+    sender: str
+    sender_limits: QuotaLimits
+    key_limits: QuotaLimits
+    key_overrides: Dict[str, QuotaLimits]
+    api_keys: FrozenSet[str] = frozenset()
+
+    def is_known_key(self, api_key: Optional[str]) -> bool:
+        """Whether requests carrying ``api_key`` are accepted; any are when no key is configured."""
+        return not self.api_keys or api_key in self.api_keys
+
+    def scopes_for(self, api_key: Optional[str]) -> List[Tuple[str, QuotaLimits]]:
+        scopes = [(f"sender:{self.sender}", self.sender_limits)]
+        if api_key:
+            scopes.append((f"key:{api_key}", self.key_overrides.get(api_key, self.key_limits)))
+        return scopes
+
+
+def load_quota_policy() -> QuotaPolicy:
+    """
+    Read quotas from the QUOTA_* environment.
+
+    QUOTA_WINDOW_SECONDS (default 3600) is the window the limits apply to.
+    QUOTA_SENDER_RECIPIENTS and QUOTA_SENDER_BYTES limit the sending account,
+    QUOTA_KEY_RECIPIENTS and QUOTA_KEY_BYTES every API key, and QUOTA_KEYS holds
+    per-key JSON overrides such as ``{"team-a": {"recipients": 5000, "bytes": 0}}``.
+    The accepted API keys are those listed, comma-separated, in API_KEYS plus the keys
+    of QUOTA_KEYS.
+    """
+    overrides = json.loads(os.getenv("QUOTA_KEYS") or "{}")
+    api_keys = {key.strip() for key in os.getenv("API_KEYS", "").split(",") if key.strip()}
+    return QuotaPolicy(
+        window_seconds=float(os.getenv("QUOTA_WINDOW_SECONDS", 3600)),
+        sender=os.getenv("SMTP_USER") or "default",
+        sender_limits=QuotaLimits(
+            recipients=int(os.getenv("QUOTA_SENDER_RECIPIENTS", 0)),
+            bytes=int(os.getenv("QUOTA_SENDER_BYTES", 0)),
+        ),
+        key_limits=QuotaLimits(
+            recipients=int(os.getenv("QUOTA_KEY_RECIPIENTS", 0)),
+            bytes=int(os.getenv("QUOTA_KEY_BYTES", 0)),
+        ),
+        key_overrides={
+            key: QuotaLimits(recipients=int(limits.get(RECIPIENTS, 0)), bytes=int(limits.get(BYTES, 0)))
+            for key, limits in overrides.items()
+        },
+        api_keys=frozenset(api_keys | set(overrides)),
+    )
+
+
+def message_bytes(payload: Dict[str, Any], attachment_store: Optional[AttachmentStore] = None) -> int:
+    """Approximate size of one delivered copy of a campaign: text, inline and stored attachments."""
+    size = len(payload.get('subject') or '') + len(payload.get('body') or '')
+    size += sum(len(link) for link in payload.get('embedded_links') or [])
+    # Inline attachments arrive base64-encoded; count their decoded size
+    size += sum(len(a['content']) * 3 // 4 for a in payload.get('attachments') or [])
+    if attachment_store is not None:
+        for attachment_id in payload.get('attachment_ids') or []:
+            stored = attachment_store.get(attachment_id)
+            if stored is not None:
+                size += stored.size
+    return size
+
+
+class QuotaStore:
+    """
+    Token buckets in SQLite, shared by every process that opens the same file.
+
+    Each (scope, dimension) bucket holds up to one window's allowance and refills
+    continuously at allowance / window. A charge is applied to all of a request's buckets
+    in one IMMEDIATE transaction, so API workers cannot interleave and overspend, and it
+    is all-or-nothing: a rejected request consumes nothing.
+    """
+
+    def __init__(self, path: str, policy: QuotaPolicy):
+        self.path = path
+        self.policy = policy
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _level(self, conn: sqlite3.Connection, scope: str, dimension: str, limit: int, now: float) -> float:
+        row = conn.execute(
+            "SELECT tokens, updated_at FROM quota_buckets WHERE scope = ? AND dimension = ?", (scope, dimension)
+        ).fetchone()
+        if row is None:
+            return float(limit)
+        refill = (now - row['updated_at']) * limit / self.policy.window_seconds
+        return min(float(limit), row['tokens'] + refill)
+
+    def charge(self, api_key: Optional[str], recipients: int, size_bytes: int) -> None:
+        """Take ``recipients`` and ``size_bytes`` from every applicable quota, or raise QuotaExceeded."""
+        costs = {RECIPIENTS: recipients, BYTES: size_bytes}
+        scopes = self.policy.scopes_for(api_key)
+        for scope, limits in scopes:
+            for dimension, cost in costs.items():
+                limit = limits.limit(dimension)
+                if limit and cost > limit:
+                    raise QuotaExceeded(413, f"Request needs {cost} {dimension}, more than the {scope} quota of {limit} per window")
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            updates = []
+            wait, exhausted = 0.0, None
+            for scope, limits in scopes:
+                for dimension, cost in costs.items():
+                    limit = limits.limit(dimension)
+                    if not limit:
+                        continue
+                    level = self._level(conn, scope, dimension, limit, now)
+                    # Time until the bucket has refilled enough for this request
+                    needed = (cost - level) * self.policy.window_seconds / limit
+                    if needed > wait:
+                        wait, exhausted = needed, f"{scope} {dimension}"
+                    updates.append((scope, dimension, level - cost, now))
+            if wait:
+                raise QuotaExceeded(429, f"Sending quota exhausted ({exhausted}), retry later", math.ceil(wait))
+            conn.executemany(
+                "INSERT INTO quota_buckets (scope, dimension, tokens, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (scope, dimension) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                updates,
+            )
+
+    def refund(self, api_key: Optional[str], recipients: int, size_bytes: int) -> None:
+        """Give back a charge for work that was never queued, up to each quota's limit."""
+        costs = {RECIPIENTS: recipients, BYTES: size_bytes}
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            updates = []
+            for scope, limits in self.policy.scopes_for(api_key):
+                for dimension, cost in costs.items():
+                    limit = limits.limit(dimension)
+                    if limit and cost:
+                        level = self._level(conn, scope, dimension, limit, now)
+                        updates.append((scope, dimension, min(float(limit), level + cost), now))
+            conn.executemany(
+                "INSERT INTO quota_buckets (scope, dimension, tokens, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (scope, dimension) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                updates,
+            )
+
+    def remaining(self, api_key: Optional[str]) -> Dict[str, Dict[str, Any]]:
+        """Current allowance left in each quota that applies to ``api_key``."""
+        now = time.time()
+        report = {}
+        with self._connect() as conn:
+            for scope, limits in self.policy.scopes_for(api_key):
+                report[scope] = {
+                    dimension: {
+                        'limit': limits.limit(dimension) or None,
+                        'remaining': int(self._level(conn, scope, dimension, limits.limit(dimension), now))
+                        if limits.limit(dimension) else None,
+                    }
+                    for dimension in (RECIPIENTS, BYTES)
+                }
+        return report
+
+
+_store: Optional[QuotaStore] = None
+
+
+def get_quota_store() -> QuotaStore:
+    """Return the process-wide quota store located at QUOTA_DB_PATH."""
+    global _store
+    if _store is None:
+        _store = QuotaStore(os.getenv("QUOTA_DB_PATH", "data/quotas.db"), load_quota_policy())
+    return _store
@@ -0,0 +1,46 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Asynchronous token bucket.
+
+    Tokens refill continuously at ``rate`` per second up to ``capacity``. A rate of zero
+    or less disables limiting. Requests larger than the capacity are let through once the
+    bucket is full and leave it in debt, so big batches are paced rather than refused.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def per_minute(cls, amount: float, capacity: Optional[float] = None) -> "TokenBucket":
+        return cls(amount / 60.0, capacity if capacity is not None else max(amount / 60.0, 1.0))
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """Wait until ``tokens`` can be taken from the bucket."""
+        if self.unlimited:
+            return
+        # The lock keeps waiters in FIFO order so large requests are not starved
+        async with self._lock:
+            needed = min(tokens, self.capacity)
+            self._refill()
+            while self._tokens < needed:
+                await asyncio.sleep((needed - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
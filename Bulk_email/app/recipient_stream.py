@@ -0,0 +1,115 @@
+import csv
+import codecs
+import json
+from typing import AsyncIterator, List, Optional
+
+from pydantic import EmailStr, TypeAdapter, ValidationError
+
+
+NDJSON = "ndjson"
+CSV = "csv"
+
+# Column names recognised as the address column in a CSV header row
+_ADDRESS_COLUMNS = {"email", "e-mail", "email_address", "address", "recipient"}
+
+_email_adapter = TypeAdapter(EmailStr)
+
+
+def detect_format(content_type: Optional[str]) -> str:
+    """Pick the parser for a request body: NDJSON for JSON types, CSV/plain text otherwise."""
+    if content_type and "json" in content_type.lower():
+        return NDJSON
+    return CSV
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into text lines without waiting for the whole body."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    remainder = ""
+    async for chunk in chunks:
+        remainder += decoder.decode(chunk)
+        *lines, remainder = remainder.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    remainder += decoder.decode(b"", final=True)
+    if remainder:
+        yield remainder.rstrip("\r")
+
+
+async def iter_raw_recipients(chunks: AsyncIterator[bytes], fmt: str) -> AsyncIterator[str]:
+    """
+    Yield unvalidated recipient values from an NDJSON or CSV stream.
+
+    NDJSON lines may be a JSON string or an object with an ``email`` field. CSV rows use
+    the column named in a header row such as ``email``, or the first column when the
+    file has no header, which also covers one-address-per-line files like recipients.txt.
+    """
+    column: Optional[int] = None
+    first_row = True
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        if fmt == NDJSON:
+            try:
+                value = json.loads(line)
+            except json.JSONDecodeError:
+                yield line
+                continue
+            if isinstance(value, dict):
+                value = value.get("email", "")
+            yield str(value)
+            continue
+
+        row = next(csv.reader([line]))
+        if first_row:
+            first_row = False
+            header = [cell.strip().lower() for cell in row]
+            matches = [i for i, cell in enumerate(header) if cell in _ADDRESS_COLUMNS]
+            if matches:
+                column = matches[0]
+                continue
+        index = column or 0
+        yield row[index] if index < len(row) else ""
+
+
+class RejectedValues:
+    """Count of the invalid values in an upload, keeping only the first few as a sample."""
+
+    def __init__(self, sample_size: int = 20):
+        self.count = 0
+        self.sample_size = sample_size
+        self.sample: List[str] = []
+
+    def add(self, value: str) -> None:
+        self.count += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append(value)
+
+
+def validate_recipient(value: str) -> Optional[str]:
+    """Return the address if it is valid, with the same rules as EmailRequest, else None."""
+    try:
+        return str(_email_adapter.validate_python(value.strip()))
+    except ValidationError:
+        return None
+
+
+async def iter_recipient_chunks(
+    chunks: AsyncIterator[bytes],
+    fmt: str,
+    rejected: RejectedValues,
+    chunk_size: int = 500,
+) -> AsyncIterator[List[str]]:
+    """Yield validated addresses in lists of ``chunk_size``, counting invalid values in ``rejected``."""
+    accepted = []
+    async for value in iter_raw_recipients(chunks, fmt):
+        address = validate_recipient(value)
+        if address is None:
+            rejected.add(value)
+            continue
+        accepted.append(address)
+        if len(accepted) >= chunk_size:
+            yield accepted
+            accepted = []
+    if accepted:
+        yield accepted
@@ -0,0 +1,328 @@
+import os
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+from aiosmtplib import SMTPException, SMTPHeloError, SMTPNotSupported, SMTPRecipientsRefused, SMTPResponseException
+from dotenv import load_dotenv
+
+from app.congestion import is_throttle_error
+from app.delivery import is_auth_error
+from prometheus_client import Counter, Gauge
+
+from app.metrics import REGISTRY
+from app.smtp_pool import SMTPConnectionPool, is_connection_error, track_pool
+from app.transport import SendResult, Transport
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+WEIGHTED = "weighted"
+LEAST_OUTSTANDING = "least_outstanding"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+RELAY_UP = Gauge(
+    "bulk_email_relay_up", "1 while a relay's circuit breaker lets traffic through, 0 while it is ejected.", ["relay"],
+    registry=REGISTRY,
+)
+RELAY_OUTSTANDING = Gauge(
+    "bulk_email_relay_outstanding", "Transactions currently in progress on each relay.", ["relay"],
+    registry=REGISTRY,
+)
+RELAY_FAILOVERS = Counter(
+    "bulk_email_relay_failovers_total", "Batches moved to another relay after the chosen one failed.", ["relay"],
+    registry=REGISTRY,
+)
+
+
+class RelayUnavailable(SMTPException):
+    """Every relay is ejected or has already failed this batch."""
+
+
+@dataclass(frozen=True)
+class RelayConfig:
+    name: str
+    hostname: str
+    port: int = 587
+    username: Optional[str] = None
+    password: Optional[str] = None
+    weight: float = 1.0
+    start_tls: bool = True
+    pool_size: int = 5
+
+
+def load_relays() -> List[RelayConfig]:
+    """
+    Read relays from SMTP_RELAYS, a JSON list, or from the file named by SMTP_RELAYS_FILE.
+
+    Each entry takes ``host`` and optionally ``name``, ``port``, ``username``, ``password``
+    (or ``password_env``, the variable holding it), ``weight``, ``start_tls`` and
+    ``pool_size``, for example
+    ``[{"name": "primary", "host": "smtp1.example.com", "weight": 3, "password_env": "RELAY1_PASSWORD"}]``.
+    Without either variable the single relay described by SMTP_SERVER and SMTP_PORT is used.
+    """
+    raw = os.getenv("SMTP_RELAYS")
+    path = os.getenv("SMTP_RELAYS_FILE")
+    if not raw and path:
+        with open(path) as f:
+            raw = f.read()
+    if not raw:
+        return [
+            RelayConfig(
+                name="default",
+                hostname=os.getenv("SMTP_SERVER"),
+                port=int(os.getenv("SMTP_PORT", 587)),
+                username=os.getenv("SMTP_USER"),
+                password=os.getenv("SMTP_PASSWORD"),
+                start_tls=os.getenv("SMTP_START_TLS", "true").lower() == "true",
+                pool_size=int(os.getenv("SMTP_POOL_SIZE", 5)),
+            )
+        ]
+
+    relays = []
+    for index, entry in enumerate(json.loads(raw)):
+        password = entry.get("password")
+        if password is None and entry.get("password_env"):
+            password = os.getenv(entry["password_env"])
+        relays.append(
+            RelayConfig(
+                name=entry.get("name") or f"relay{index}",
+                hostname=entry["host"],
+                port=int(entry.get("port", 587)),
+                username=entry.get("username"),
+                password=password,
+                weight=float(entry.get("weight", 1)),
+                start_tls=bool(entry.get("start_tls", True)),
+                pool_size=int(entry.get("pool_size", os.getenv("SMTP_POOL_SIZE", 5))),
+            )
+        )
+    if not relays:
+        raise ValueError("SMTP_RELAYS lists no relays")
+    return relays
+
+
+class CircuitBreaker:
+    """
+    Eject a relay after ``failure_threshold`` consecutive failures.
+
+    The breaker opens for ``reset_timeout`` seconds, then half-opens to let a single
+    probe through: a success closes it again, a failure reopens it for another timeout.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probing = False
+
+    def allows(self) -> bool:
+        """Whether a request may be sent now; claims the probe while half-open."""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    @property
+    def available(self) -> bool:
+        """Whether ``allows`` could return True, without claiming anything."""
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return self.state == CLOSED or not self._probing
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.trips += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release(self) -> None:
+        """Give back a probe that ended without telling anything about the relay."""
+        self._probing = False
+
+
+class Relay:
+    def __init__(self, config: RelayConfig, breaker: CircuitBreaker):
+        self.config = config
+        self.name = config.name
+        self.weight = max(config.weight, 0.0)
+        self.breaker = breaker
+        self.pool = SMTPConnectionPool(
+            hostname=config.hostname,
+            port=config.port,
+            username=config.username,
+            password=config.password,
+            size=config.pool_size,
+            start_tls=config.start_tls,
+            idle_check_interval=float(os.getenv("SMTP_POOL_IDLE_CHECK_SECONDS", 30)),
+        )
+        self.outstanding = 0
+        self.sent = 0
+        self.failed = 0
+        # Smooth weighted round-robin state
+        self.current_weight = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'host': f"{self.config.hostname}:{self.config.port}",
+            'weight': self.weight,
+            'state': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            'trips': self.breaker.trips,
+            'outstanding': self.outstanding,
+            'sent': self.sent,
+            'failed': self.failed,
+        }
+
+
+def is_relay_failure(error: BaseException) -> bool:
+    """
+    Whether an error says the relay rather than the message is at fault: the connection
+    or its greeting, EHLO or STARTTLS failed, the relay rejected its own credentials,
+    or it throttled or answered MAIL/DATA with a transient 4xx. Refused recipients are
+    about their own domains and stay with the caller.
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        return False
+    if is_connection_error(error) or is_throttle_error(error) or is_auth_error(error):
+        return True
+    if isinstance(error, (SMTPHeloError, SMTPNotSupported)):
+        return True
+    return isinstance(error, SMTPResponseException) and 400 <= error.code < 500
+
+
+class RelayTransport(Transport):
+    """
+    Spread batches over several SMTP relays and fail over between them.
+
+    A relay is picked per batch, either by smooth weighted round-robin or, with the
+    least_outstanding strategy, as the one with the fewest transactions in progress
+    relative to its weight. A relay failure (see is_relay_failure) counts against the
+    relay's circuit breaker and the batch is retried at once on another relay that has
+    not failed it yet; a 5xx or refused recipients are returned to the caller as usual.
+    Each relay logs in with its own credentials, so a relay rejecting them is ejected
+    like any other failing relay; only when every relay has rejected its credentials is
+    the authentication error itself raised. Otherwise, when no relay is left, the batch
+    fails with RelayUnavailable, a transient error the send pipeline retries after its
+    backoff.
+    """
+
+    name = "smtp"
+
+    def __init__(self, relays: Sequence[Relay], strategy: str = WEIGHTED):
+        if not relays:
+            raise ValueError("RelayTransport needs at least one relay")
+        if strategy not in (WEIGHTED, LEAST_OUTSTANDING):
+            raise ValueError(f"Unknown relay strategy: {strategy}")
+        self.relays = list(relays)
+        self.strategy = strategy
+        for relay in self.relays:
+            RELAY_UP.labels(relay=relay.name).set_function(lambda relay=relay: float(relay.breaker.available))
+            RELAY_OUTSTANDING.labels(relay=relay.name).set_function(lambda relay=relay: relay.outstanding)
+            track_pool(relay.pool, relay.name)
+
+    def _pick(self, exclude: List[Relay]) -> Optional[Relay]:
+        candidates = [
+            relay for relay in self.relays
+            if relay not in exclude and relay.weight > 0 and relay.breaker.available
+        ]
+        if not candidates:
+            return None
+        if self.strategy == LEAST_OUTSTANDING:
+            ordered = sorted(candidates, key=lambda relay: (relay.outstanding + 1) / relay.weight)
+        else:
+            total = sum(relay.weight for relay in candidates)
+            for relay in candidates:
+                relay.current_weight += relay.weight
+            best = max(candidates, key=lambda relay: relay.current_weight)
+            best.current_weight -= total
+            ordered = [best] + [relay for relay in candidates if relay is not best]
+        # A half-open relay admits one probe at a time; move on if it is taken
+        for relay in ordered:
+            if relay.breaker.allows():
+                return relay
+        return None
+
+    async def send(self, sender: str, recipients: Sequence[str], message: bytes) -> SendResult:
+        tried: List[Relay] = []
+        last_error: Optional[BaseException] = None
+        auth_failures = 0
+        while True:
+            relay = self._pick(tried)
+            if relay is None:
+                usable = sum(1 for candidate in self.relays if candidate.weight > 0)
+                if last_error is not None and auth_failures == usable:
+                    # No relay accepts its credentials; retrying will not help
+                    raise last_error
+                detail = f"; last error: {last_error}" if last_error else ""
+                raise RelayUnavailable(f"No SMTP relay available ({len(tried)} tried){detail}")
+            if tried:
+                RELAY_FAILOVERS.labels(relay=tried[-1].name).inc()
+                logger.warning(f"Failing over from relay {tried[-1].name} to {relay.name}")
+            tried.append(relay)
+
+            relay.outstanding += 1
+            try:
+                async with relay.pool.connection() as smtp:
+                    result = await smtp.sendmail(sender, list(recipients), message)
+            except Exception as e:
+                if not is_relay_failure(e):
+                    # The relay answered; the problem is the message or its recipients
+                    relay.breaker.record_success()
+                    raise
+                relay.failed += 1
+                relay.breaker.record_failure()
+                if relay.breaker.state == OPEN:
+                    logger.warning(f"Relay {relay.name} ejected after {relay.breaker.failures} failures: {e}")
+                last_error = e
+                auth_failures += is_auth_error(e)
+                continue
+            except BaseException:
+                relay.breaker.release()
+                raise
+            finally:
+                relay.outstanding -= 1
+            relay.sent += 1
+            relay.breaker.record_success()
+            return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {'strategy': self.strategy, 'relays': {relay.name: relay.snapshot() for relay in self.relays}}
+
+    async def close(self) -> None:
+        for relay in self.relays:
+            await relay.pool.close()
+
+
+def create_relay_transport(configs: Optional[List[RelayConfig]] = None) -> RelayTransport:
+    """
+    Build a RelayTransport from ``configs`` or load_relays(), balanced by
+    SMTP_RELAY_STRATEGY (weighted or least_outstanding). A relay is ejected after
+    SMTP_RELAY_FAILURE_THRESHOLD consecutive failures (default 5) for
+    SMTP_RELAY_EJECT_SECONDS (default 30).
+    """
+    threshold = int(os.getenv("SMTP_RELAY_FAILURE_THRESHOLD", 5))
+    eject_seconds = float(os.getenv("SMTP_RELAY_EJECT_SECONDS", 30))
+    relays = [Relay(config, CircuitBreaker(threshold, eject_seconds)) for config in configs or load_relays()]
+    return RelayTransport(relays, strategy=os.getenv("SMTP_RELAY_STRATEGY", WEIGHTED).lower())
@@ -0,0 +1,213 @@
+import os
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Tuple
+
+from aiosmtplib import (
+    SMTP,
+    SMTPException,
+    SMTPResponseException,
+    SMTPServerDisconnected,
+    SMTPTimeoutError,
+)
+from dotenv import load_dotenv
+
+from app.metrics import SMTP_CONNECT_SECONDS, SMTP_DATA_SECONDS, SMTP_LOGIN_SECONDS, SMTP_POOL_CONNECTIONS
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# SMTP reply code a server sends right before it closes the channel
+SERVICE_NOT_AVAILABLE = 421
+
+
+def is_connection_error(error: BaseException) -> bool:
+    """Return True if the error means the SMTP connection can no longer be used."""
+    if isinstance(error, (SMTPServerDisconnected, SMTPTimeoutError, ConnectionError, OSError)):
+        return True
+    if isinstance(error, SMTPResponseException) and error.code == SERVICE_NOT_AVAILABLE:
+        return True
+    return False
+
+
+class TimedSMTP(SMTP):
+    """aiosmtplib client that records how long the server takes to accept each message."""
+
+    async def data(self, *args, **kwargs):
+        with SMTP_DATA_SECONDS.time():
+            return await super().data(*args, **kwargs)
+
+
+class SMTPConnectionPool:
+    """
+    Pool of connected and authenticated aiosmtplib clients.
+
+    Connections are opened lazily up to ``size`` and handed back to the pool after
+    each transaction, so STARTTLS and AUTH happen once per connection instead of once
+    per batch. Idle connections are checked with NOOP before reuse and connections that
+    saw a 421 reply or a dropped socket are discarded and replaced on the next acquire.
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        size: int = 5,
+        start_tls: bool = True,
+        idle_check_interval: float = 30.0,
+        timeout: float = 60.0,
+    ):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.start_tls = start_tls
+        self.idle_check_interval = idle_check_interval
+        self.timeout = timeout
+
+        self._slots = asyncio.Semaphore(size)
+        self._idle: List[Tuple[SMTP, float]] = []
+        self._in_use = 0
+        self._closed = False
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    @property
+    def in_use_count(self) -> int:
+        return self._in_use
+
+    async def _connect(self) -> SMTP:
+        client = TimedSMTP(
+            hostname=self.hostname,
+            port=self.port,
+            start_tls=self.start_tls,
+            timeout=self.timeout,
+        )
+        # connect() performs EHLO and STARTTLS; AUTH is timed on its own
+        with SMTP_CONNECT_SECONDS.time():
+            await client.connect()
+        # Only authenticate when a full set of credentials is configured
+        if self.username and self.password:
+            try:
+                with SMTP_LOGIN_SECONDS.time():
+                    await client.login(self.username, self.password)
+            except BaseException:
+                client.close()
+                raise
+        logger.info(f"Opened SMTP connection to {self.hostname}:{self.port}")
+        return client
+
+    async def _close_client(self, client: SMTP) -> None:
+        try:
+            if client.is_connected:
+                await client.quit()
+        except Exception:
+            client.close()
+
+    async def _checkout(self) -> SMTP:
+        while self._idle:
+            client, last_used = self._idle.pop()
+            if not client.is_connected:
+                continue
+            if time.monotonic() - last_used >= self.idle_check_interval:
+                try:
+                    await client.noop()
+                except (SMTPException, OSError) as e:
+                    logger.info(f"Dropping stale SMTP connection: {e}")
+                    await self._close_client(client)
+                    continue
+            return client
+        return await self._connect()
+
+    async def acquire(self) -> SMTP:
+        """Check out a connected client, opening a new one if none is idle."""
+        if self._closed:
+            raise RuntimeError("SMTP connection pool is closed")
+        await self._slots.acquire()
+        try:
+            client = await self._checkout()
+        except BaseException:
+            self._slots.release()
+            raise
+        self._in_use += 1
+        return client
+
+    async def release(self, client: SMTP, error: Optional[BaseException] = None) -> None:
+        """Return a client to the pool, discarding it if the error left it unusable."""
+        self._in_use -= 1
+        try:
+            if self._closed or not client.is_connected or (error is not None and is_connection_error(error)):
+                await self._close_client(client)
+                return
+            if error is not None:
+                # Leave no half-finished transaction behind for the next user
+                try:
+                    await client.rset()
+                except (SMTPException, OSError):
+                    await self._close_client(client)
+                    return
+            self._idle.append((client, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[SMTP]:
+        client = await self.acquire()
+        try:
+            yield client
+        except BaseException as e:
+            await self.release(client, e)
+            raise
+        else:
+            await self.release(client)
+
+    async def close(self) -> None:
+        """Close every idle connection; checked-out ones are closed when released."""
+        self._closed = True
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(self._close_client(client) for client, _ in idle))
+        logger.info(f"Closed SMTP connection pool for {self.hostname}:{self.port}")
+
+
+_pool: Optional[SMTPConnectionPool] = None
+
+
+def get_smtp_pool() -> SMTPConnectionPool:
+    """Return the process-wide pool, creating it from the SMTP_* environment on first use."""
+    global _pool
+    if _pool is None:
+        _pool = SMTPConnectionPool(
+            hostname=os.getenv("SMTP_SERVER"),
+            port=int(os.getenv("SMTP_PORT", 587)),
+            username=os.getenv("SMTP_USER"),
+            password=os.getenv("SMTP_PASSWORD"),
+            size=int(os.getenv("SMTP_POOL_SIZE", 5)),
+            start_tls=os.getenv("SMTP_START_TLS", "true").lower() == "true",
+            idle_check_interval=float(os.getenv("SMTP_POOL_IDLE_CHECK_SECONDS", 30)),
+        )
+        track_pool(_pool, "default")
+    return _pool
+
+
+def track_pool(pool: SMTPConnectionPool, relay: str) -> None:
+    """Report ``pool``'s idle and in-use connections under the ``relay`` label."""
+    SMTP_POOL_CONNECTIONS.labels(relay=relay, state="idle").set_function(lambda: pool.idle_count)
+    SMTP_POOL_CONNECTIONS.labels(relay=relay, state="in_use").set_function(lambda: pool.in_use_count)
+
+
+async def close_smtp_pool() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
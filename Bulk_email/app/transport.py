@@ -0,0 +1,197 @@
+import os
+import asyncio
+import logging
+import socket
+import time
+from dataclasses import dataclass
+from itertools import count
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from aiosmtplib import SMTPResponse
+from dotenv import load_dotenv
+
+from app.smtp_pool import SMTPConnectionPool, close_smtp_pool, get_smtp_pool
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Same shape as SMTP.sendmail: refused recipients by address, and the server's reply text
+SendResult = Tuple[Dict[str, SMTPResponse], str]
+
+
+class Transport:
+    """
+    Delivers serialized messages to their envelope recipients.
+
+    ``send`` mirrors aiosmtplib's ``sendmail``: it returns the refused recipients and the
+    reply text, and raises the same exceptions on failure, so the sending pipeline does
+    not care whether a message goes to a relay, to disk or to memory. ``flush`` is
+    awaited once a campaign has finished; ``close`` releases the backend at shutdown.
+    """
+
+    name = "transport"
+
+    async def send(self, sender: str, recipients: Sequence[str], message: bytes) -> SendResult:
+        raise NotImplementedError
+
+    async def flush(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+class SMTPTransport(Transport):
+    """Relay messages through pooled, authenticated SMTP connections; the pool outlives it."""
+
+    name = "smtp"
+
+    def __init__(self, pool: SMTPConnectionPool):
+        self.pool = pool
+
+    async def send(self, sender: str, recipients: Sequence[str], message: bytes) -> SendResult:
+        async with self.pool.connection() as smtp:
+            return await smtp.sendmail(sender, list(recipients), message)
+
+
+class FileTransport(Transport):
+    """
+    Write messages to disk instead of sending them, for dry runs and offline staging.
+
+    Messages are written as ``.eml`` files into ``directory`` or, with ``maildir=True``,
+    delivered into a Maildir (written under ``tmp/`` and renamed into ``new/``). Each
+    file starts with Return-Path and X-Envelope-To headers recording the envelope. Writes
+    are buffered and issued ``batch_size`` files at a time from a worker thread, so the
+    event loop never waits on the disk per message; ``flush`` writes what is left.
+    """
+
+    def __init__(self, directory: str, maildir: bool = False, batch_size: int = 100):
+        self.directory = directory
+        self.maildir = maildir
+        self.batch_size = max(1, batch_size)
+        self.name = "maildir" if maildir else "file"
+        self._buffer: List[Tuple[str, bytes]] = []
+        self._sequence = count()
+        self._hostname = socket.gethostname().replace('/', '_').replace(':', '_')
+        self._lock = asyncio.Lock()
+
+        if maildir:
+            for sub in ('tmp', 'new', 'cur'):
+                os.makedirs(os.path.join(directory, sub), exist_ok=True)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    def _filename(self) -> str:
+        # Maildir-style unique name: time, pid and a per-process sequence, then host
+        return f"{time.time_ns()}.{os.getpid()}_{next(self._sequence)}.{self._hostname}"
+
+    def _write_batch(self, batch: List[Tuple[str, bytes]]) -> None:
+        for filename, data in batch:
+            if self.maildir:
+                tmp_path = os.path.join(self.directory, 'tmp', filename)
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, os.path.join(self.directory, 'new', filename))
+            else:
+                with open(os.path.join(self.directory, filename + '.eml'), 'wb') as f:
+                    f.write(data)
+
+    async def send(self, sender: str, recipients: Sequence[str], message: bytes) -> SendResult:
+        envelope_to = ',\r\n '.join(recipients)
+        envelope = f"Return-Path: <{sender}>\r\nX-Envelope-To: {envelope_to}\r\n"
+        self._buffer.append((self._filename(), envelope.encode('utf-8') + message))
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+        return {}, f"queued to {self.name} sink"
+
+    async def flush(self) -> None:
+        async with self._lock:
+            batch, self._buffer = self._buffer, []
+            if batch:
+                await asyncio.to_thread(self._write_batch, batch)
+
+
+@dataclass
+class CapturedMessage:
+    sender: str
+    recipients: List[str]
+    data: bytes
+
+
+class MemoryTransport(Transport):
+    """
+    Accept every message and keep it in memory, for tests and throughput measurements.
+
+    With ``keep_messages=False`` only the counters are updated, so very large runs can be
+    timed without holding every message.
+    """
+
+    name = "memory"
+
+    def __init__(self, keep_messages: bool = True):
+        self.keep_messages = keep_messages
+        self.messages: List[CapturedMessage] = []
+        self.message_count = 0
+        self.recipient_count = 0
+        self.bytes_sent = 0
+
+    async def send(self, sender: str, recipients: Sequence[str], message: bytes) -> SendResult:
+        self.message_count += 1
+        self.recipient_count += len(recipients)
+        self.bytes_sent += len(message)
+        if self.keep_messages:
+            self.messages.append(CapturedMessage(sender, list(recipients), message))
+        return {}, "accepted by memory sink"
+
+    def clear(self) -> None:
+        self.messages.clear()
+        self.message_count = self.recipient_count = self.bytes_sent = 0
+
+
+def create_transport(kind: Optional[str] = None) -> Transport:
+    """
+    Build the transport named by ``kind`` or EMAIL_TRANSPORT: smtp (default), file,
+    maildir or memory. SMTP goes through the SMTP_SERVER pool, or is balanced over
+    several relays when SMTP_RELAYS or SMTP_RELAYS_FILE lists them (see app.relays).
+    File sinks write under EMAIL_TRANSPORT_PATH (default ``data/outbox``) in batches of
+    EMAIL_TRANSPORT_BATCH_SIZE files.
+    """
+    kind = (kind or os.getenv("EMAIL_TRANSPORT", "smtp")).lower()
+    if kind == "smtp":
+        if os.getenv("SMTP_RELAYS") or os.getenv("SMTP_RELAYS_FILE"):
+            # Imported here since app.relays builds on this module's Transport
+            from app.relays import create_relay_transport
+            return create_relay_transport()
+        return SMTPTransport(get_smtp_pool())
+    if kind in ("file", "maildir"):
+        return FileTransport(
+            os.getenv("EMAIL_TRANSPORT_PATH", "data/outbox"),
+            maildir=kind == "maildir",
+            batch_size=int(os.getenv("EMAIL_TRANSPORT_BATCH_SIZE", 100)),
+        )
+    if kind == "memory":
+        return MemoryTransport(keep_messages=os.getenv("EMAIL_TRANSPORT_KEEP_MESSAGES", "true").lower() == "true")
+    raise ValueError(f"Unknown EMAIL_TRANSPORT: {kind}")
+
+
+_transport: Optional[Transport] = None
+
+
+def get_transport() -> Transport:
+    """Return the process-wide transport selected by EMAIL_TRANSPORT."""
+    global _transport
+    if _transport is None:
+        _transport = create_transport()
+        logger.info(f"Using {_transport.name} transport")
+    return _transport
+
+
+async def close_transport() -> None:
+    global _transport
+    if _transport is not None:
+        await _transport.close()
+        _transport = None
+    # The SMTP transport shares the process-wide pool, which is closed here once
+    await close_smtp_pool()
@@ -0,0 +1,150 @@
+"""
+Send workers that run outside the API process.
+
+Start them with ``python -m app.worker`` and set SEND_WORKER_MODE=external on the API, so
+the API only enqueues jobs and the MIME building and SMTP traffic move to other cores.
+Each worker process runs its own event loop, SMTP pool and JobWorker against the shared
+job database, leasing shards of campaigns from it; SMTP connections therefore add up to
+processes x SMTP_POOL_SIZE. Send rates (SEND_MESSAGES_PER_SECOND,
+SEND_RECIPIENTS_PER_MINUTE and the messages_per_second of SEND_DOMAIN_LIMITS) are drawn
+from token buckets in SEND_PACING_DB_PATH, so they hold for all workers together; the
+in-flight limits (SEND_MAX_CONCURRENT_BATCHES, max_concurrent) apply per running shard.
+The parent process restarts workers that die and, on SIGTERM or SIGINT, lets them finish
+or hand back their shards before exiting. With --metrics-port, worker N serves its
+send-pipeline metrics on that port + N.
+"""
+import os
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from prometheus_client import start_http_server
+
+from app.job_store import get_job_store
+from app.job_worker import get_job_worker
+from app.metrics import REGISTRY
+from app.transport import close_transport
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+async def _serve(grace_period: float, metrics_port: Optional[int]) -> None:
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    metrics_server = None
+    if metrics_port:
+        metrics_server, _ = start_http_server(metrics_port, registry=REGISTRY)
+    worker = get_job_worker(get_job_store())
+    await worker.start()
+    logger.info(f"Worker {worker.name}: running {worker.concurrency} shard(s) at a time")
+    await stopping.wait()
+    logger.info(f"Worker {worker.name}: shutting down")
+    await worker.stop(grace_period)
+    await close_transport()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+
+def run_worker(grace_period: float, metrics_port: Optional[int] = None) -> None:
+    """Entry point of one worker process."""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(name)s %(levelname)s %(message)s")
+    asyncio.run(_serve(grace_period, metrics_port))
+
+
+class WorkerPool:
+    """Keep ``processes`` worker processes running until asked to stop."""
+
+    def __init__(self, processes: int, grace_period: float = 30.0, restart_delay: float = 5.0,
+                 metrics_port: Optional[int] = None):
+        self.processes = processes
+        self.grace_period = grace_period
+        # Worker N serves its metrics on metrics_port + N
+        self.metrics_port = metrics_port
+        self.restart_delay = restart_delay
+        # Spawned children start clean instead of inheriting the parent's state
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: List[Optional[multiprocessing.Process]] = [None] * processes
+        self._started_at = [0.0] * processes
+        self._stopping = False
+
+    def _spawn(self, slot: int) -> None:
+        process = self._context.Process(
+            target=run_worker,
+            args=(self.grace_period, self.metrics_port + slot if self.metrics_port else None),
+            name=f"send-worker-{slot}",
+        )
+        process.start()
+        self._workers[slot] = process
+        self._started_at[slot] = time.monotonic()
+
+    def request_stop(self, *_) -> None:
+        self._stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        for slot in range(self.processes):
+            self._spawn(slot)
+        logger.info(f"Started {self.processes} send worker process(es)")
+
+        while not self._stopping:
+            time.sleep(1)
+            for slot, process in enumerate(self._workers):
+                if process is None or process.is_alive() or self._stopping:
+                    continue
+                # Back off a worker that keeps crashing on start-up
+                if time.monotonic() - self._started_at[slot] < self.restart_delay:
+                    continue
+                logger.warning(f"{process.name} exited with code {process.exitcode}, restarting")
+                self._spawn(slot)
+        self.stop()
+
+    def stop(self) -> None:
+        alive = [process for process in self._workers if process is not None and process.is_alive()]
+        logger.info(f"Stopping {len(alive)} send worker process(es)")
+        for process in alive:
+            process.terminate()
+        # Workers wait up to the grace period for their shards, then hand the rest back
+        deadline = time.monotonic() + self.grace_period + 10
+        for process in alive:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time, killing it")
+                process.kill()
+                process.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run send workers that drain the Bulk_email job queue.")
+    parser.add_argument(
+        "--processes", type=int,
+        default=int(os.getenv("SEND_WORKER_PROCESSES", 0)) or os.cpu_count() or 1,
+        help="worker processes to run (SEND_WORKER_PROCESSES, default one per CPU core)",
+    )
+    parser.add_argument(
+        "--grace-period", type=float, default=float(os.getenv("SEND_WORKER_SHUTDOWN_SECONDS", 30)),
+        help="seconds a stopping worker waits for its shards before handing them back",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=int(os.getenv("SEND_WORKER_METRICS_PORT", 0)),
+        help="serve Prometheus metrics from worker N on this port + N (SEND_WORKER_METRICS_PORT)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    WorkerPool(args.processes, args.grace_period, metrics_port=args.metrics_port or None).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
-from flask import Flask, render_template, request, flash, redirect, url_for, jsonify
+from flask import Flask, Response, render_template, request, flash, redirect, url_for, jsonify, get_flashed_messages
 from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, SubmitField, MultipleFileField, SelectField
 from wtforms.validators import DataRequired, Email
 import os
+import shutil
 from bulk_emailer import BulkEmailer
 from text_cleaner import TextCleaner
-from email_template import TemplateManager, EmailTemplate
+from email_template import TemplateManager, EmailTemplate, MissingVariablesError
 from email_validation import EmailAddressValidator
+from merge_jobs import MergeJobManager
+from metrics import CONTENT_TYPE, SEND_METRICS
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 import csv
@@ -25,6 +28,9 @@ for folder in [app.config['UPLOAD_FOLDER'], 'templates']:
 # Initialize template manager
 template_manager = TemplateManager()
 
+# Merges run in the background; their progress is kept under MERGE_JOBS_DIR
+merge_jobs = MergeJobManager(os.getenv('MERGE_JOBS_DIR', 'jobs'))
+
 class EmailForm(FlaskForm):
     sender_email = StringField('Sender Email', validators=[DataRequired(), Email()])
     sender_password = StringField('App Password', validators=[DataRequired()])
@@ -57,6 +63,17 @@ def parse_recipient_line(line: str) -> tuple[str, dict]:
             
     return email, variables
 
+def wants_json() -> bool:
+    """Whether the request came from main.js rather than a plain form post"""
+    return request.accept_mimetypes.best == 'application/json'
+
+def error_response(form, template_form):
+    """Re-render the form with the flashed errors, or return them to main.js as JSON"""
+    if wants_json():
+        errors = [message for _, message in get_flashed_messages(with_categories=True)]
+        return jsonify({'errors': errors}), 400
+    return render_template('index.html', form=form, template_form=template_form)
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     form = EmailForm()
@@ -68,12 +85,13 @@ def index():
     form.template.choices = [('', 'No template - Write custom email')] + [(t, t) for t in templates]
     
     if form.validate_on_submit():
+        upload_dir = None
         try:
             # Clean and validate sender email
             is_valid, error_message = EmailAddressValidator.validate_single_email(form.sender_email.data.strip())
             if not is_valid:
                 flash(f'Invalid sender email: {error_message}', 'error')
-                return render_template('index.html', form=form, template_form=template_form)
+                return error_response(form, template_form)
 
             # Clean all form inputs
             subject = cleaner.clean_text(form.subject.data)
@@ -104,75 +122,73 @@ def index():
                     flash(f'Invalid CC emails: {", ".join(invalid_emails["cc"])}', 'error')
                 if invalid_emails['bcc']:
                     flash(f'Invalid BCC emails: {", ".join(invalid_emails["bcc"])}', 'error')
-                return render_template('index.html', form=form, template_form=template_form)
+                return error_response(form, template_form)
+
+            # Use the selected template, or the custom subject and body as a one-off template
+            template = None
+            if form.template.data:
+                template = template_manager.get_template(form.template.data)
+            if not template:
+                template = EmailTemplate(name='custom', subject=subject, body=body)
 
-            # Save attachments
+            # Check every recipient's variables up front so a missing one stops the run before any mail goes out
+            try:
+                template.check(recipient_variables)
+            except MissingVariablesError as e:
+                for index, names in e.missing.items():
+                    flash(f'Missing variables for {raw_recipients[index]}: {", ".join(names)}', 'error')
+                return error_response(form, template_form)
+
+            # Save attachments in a folder of their own, removed when the job ends
+            job_id = merge_jobs.new_job_id()
+            upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], job_id)
             attachment_paths = []
             if form.attachments.data:
                 for file in form.attachments.data:
                     if file.filename:
+                        os.makedirs(upload_dir, exist_ok=True)
                         filename = cleaner.clean_text(secure_filename(file.filename))
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                        filepath = os.path.join(upload_dir, filename)
                         file.save(filepath)
                         attachment_paths.append(filepath)
-            
-            try:
-                # Initialize bulk emailer
-                emailer = BulkEmailer(
-                    smtp_server="smtp.gmail.com",
-                    smtp_port=587,
+
+            # Initialize bulk emailer in the job's thread
+            # SMTP_RELAYS, when set, spreads the run over several relays instead
+            def create_emailer():
+                return BulkEmailer(
+                    smtp_server=os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
+                    smtp_port=int(os.getenv('SMTP_PORT', 587)),
                     username=sender_email,
                     password=sender_password
                 )
-                
-                # Get template if selected
-                template = None
-                if form.template.data:
-                    template = template_manager.get_template(form.template.data)
-                
-                # Send emails with cleaned and validated data
-                for i, recipient_email in enumerate(valid_emails['to']):
-                    if template:
-                        # Use template with personalization
-                        personalized_subject, personalized_body = template.render(recipient_variables[i])
-                    else:
-                        # Use custom email with personalization
-                        personalized_subject = subject
-                        personalized_body = body
-                        for var_name, value in recipient_variables[i].items():
-                            placeholder = '{' + var_name + '}'
-                            personalized_subject = personalized_subject.replace(placeholder, value)
-                            personalized_body = personalized_body.replace(placeholder, value)
-                    
-                    emailer.send_bulk_emails(
-                        subject=personalized_subject,
-                        body=personalized_body,
-                        recipient_list=[recipient_email],
-                        cc_list=valid_emails.get('cc', []),
-                        bcc_list=valid_emails.get('bcc', []),
-                        attachments=attachment_paths
-                    )
-                
-                flash('Emails sent successfully!', 'success')
-                
-            finally:
-                # Clean up attachment files
-                for path in attachment_paths:
-                    if os.path.exists(path):
-                        os.remove(path)
-            
+
+            # Queue the merge and answer right away; main.js polls the job for progress
+            job = merge_jobs.submit(
+                job_id,
+                create_emailer,
+                template,
+                list(zip(valid_emails['to'], recipient_variables)),
+                upload_dir=upload_dir,
+                cc_list=valid_emails.get('cc', []),
+                bcc_list=valid_emails.get('bcc', []),
+                attachments=attachment_paths
+            )
+            if wants_json():
+                return jsonify({'job_id': job.id, 'progress_url': url_for('job_progress', job_id=job.id)}), 202
+            flash(f'Sending {job.total} emails in the background (job {job.id})', 'success')
             return redirect(url_for('index'))
-            
+
         except Exception as e:
             flash(f'Error sending emails: {str(e)}', 'error')
-            # Clean up any remaining attachments in case of error
-            try:
-                for path in attachment_paths:
-                    if os.path.exists(path):
-                        os.remove(path)
-            except:
-                pass
-    
+            # Clean up any saved attachments in case of error
+            if upload_dir:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+            return error_response(form, template_form)
+
+    if request.method == 'POST' and wants_json():
+        errors = [f'{form[name].label.text}: {error}' for name, messages in form.errors.items() for error in messages]
+        return jsonify({'errors': errors}), 400
+
     return render_template('index.html', form=form, template_form=template_form)
 
 @app.route('/templates', methods=['POST'])
@@ -196,6 +212,13 @@ def save_template():
             flash(f'Error saving template: {str(e)}', 'error')
     return redirect(url_for('index'))
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_progress(job_id):
+    job = merge_jobs.get(job_id)
+    if job:
+        return jsonify(job.progress())
+    return jsonify({'error': 'Job not found'}), 404
+
 @app.route('/templates/<template_name>', methods=['GET'])
 def get_template(template_name):
     template = template_manager.get_template(template_name)
@@ -214,5 +237,10 @@ def delete_template(template_name):
         return jsonify({'message': f'Template "{template_name}" deleted successfully'})
     return jsonify({'error': 'Template not found'}), 404
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Export mail merge send metrics in the Prometheus text format"""
+    return Response(SEND_METRICS.render(), content_type=CONTENT_TYPE)
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
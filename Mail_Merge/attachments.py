@@ -0,0 +1,71 @@
+import base64
+import mimetypes
+import mmap
+import os
+from email.message import EmailMessage, MIMEPart
+from email.policy import default
+from typing import List, Optional
+
+# Raw bytes per base64 chunk; a multiple of 57 so every chunk ends on a full 76-character line
+ENCODE_CHUNK_SIZE = 57 * 1024
+
+
+def encode_file_base64(path: str, mmap_threshold: int) -> str:
+    """Base64-encode a file into 76-character MIME lines
+
+    Files larger than ``mmap_threshold`` bytes are mapped and encoded chunk by chunk,
+    so their raw bytes are never held in memory alongside the encoded text."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ''
+        if size <= mmap_threshold:
+            return base64.encodebytes(f.read()).decode('ascii')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return ''.join(
+                base64.encodebytes(mapped[offset:offset + ENCODE_CHUNK_SIZE]).decode('ascii')
+                for offset in range(0, size, ENCODE_CHUNK_SIZE)
+            )
+
+
+class EncodedAttachment:
+    """A file read, typed and base64-encoded once, then attached to any number of messages
+
+    Every message gets the same MIME part by reference. Serializing a message leaves its
+    parts untouched, so sessions on several threads can share one part safely."""
+
+    def __init__(self, filepath: str, mmap_threshold: Optional[int] = None):
+        if mmap_threshold is None:
+            mmap_threshold = int(os.getenv('ATTACHMENT_MMAP_THRESHOLD', 1024 * 1024))
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+
+        # Guess the content type of the file
+        content_type, encoding = mimetypes.guess_type(filepath)
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+
+        self.part = MIMEPart(policy=default)
+        self.part['Content-Type'] = content_type
+        self.part['Content-Transfer-Encoding'] = 'base64'
+        self.part.add_header('Content-Disposition', 'attachment', filename=self.filename)
+        self.part.set_payload(encode_file_base64(filepath, mmap_threshold))
+
+    def attach(self, message: EmailMessage) -> None:
+        """Add the shared part to a message, turning it into multipart/mixed first"""
+        if message.get_content_type() != 'multipart/mixed':
+            message.make_mixed()
+        message.attach(self.part)
+
+
+def load_attachments(paths: List[str]) -> List[EncodedAttachment]:
+    """Encode every file in ``paths`` once for a run, skipping the ones that cannot be read"""
+    loaded = []
+    for path in paths or []:
+        if not os.path.exists(path):
+            continue
+        try:
+            loaded.append(EncodedAttachment(path))
+        except Exception as e:
+            print(f"Failed to attach file {path}: {str(e)}")
+    return loaded
@@ -1,40 +1,99 @@
-import smtplib
 import os
-import mimetypes
+import smtplib
 from email.message import EmailMessage
-from typing import List, Optional, Tuple, Dict
-import time
+from email.utils import formatdate, make_msgid
+from typing import Callable, List, Optional, Tuple, Dict, Iterable
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from text_cleaner import TextCleaner
 from email_validation import EmailAddressValidator
-import copy
+from email_template import EmailTemplate
+from transport import Transport, create_transport
+from attachments import EncodedAttachment, load_attachments
+from metrics import SEND_METRICS, SendMetrics
+from rate_scheduler import QuotaExceeded, RateScheduler, get_scheduler
+
+# Wrapper for the HTML alternative; the body goes between the two halves
+HTML_HEAD, HTML_TAIL = """
+        <!DOCTYPE html>
+        <html lang="en">
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        </head>
+        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+            {html_content}
+        </body>
+        </html>
+        """.split('{html_content}')
+
+
+class MessageFactory:
+    """Builds the static skeleton of a run's messages once and copies it for each recipient
+
+    The skeleton holds the From, MIME-Version, Cc and List-Unsubscribe headers, parsed a
+    single time; the attachment parts are encoded once and shared by every message.
+    ``build`` copies the skeleton and adds what differs per recipient: To, the
+    personalized subject and body, and a fresh Message-ID and Date."""
+
+    def __init__(self, sender: str, cc_list: Optional[List[str]] = None,
+                 attachments: Optional[List[EncodedAttachment]] = None):
+        self.skeleton = EmailMessage()
+        self.skeleton['From'] = f"Jashwanth Yerra <{sender}>"
+        self.skeleton['MIME-Version'] = '1.0'
+        # Set CC if provided
+        if cc_list:
+            self.skeleton['Cc'] = ', '.join(cc_list)
+        self.skeleton['List-Unsubscribe'] = f'<mailto:{sender}?subject=unsubscribe>'
+        self.attachments = attachments or []
+        self.domain = sender.rpartition('@')[2] or None
+
+    def build(self, recipient: str, subject: str, body: str) -> EmailMessage:
+        # Copy the parsed headers rather than deep-copying the skeleton, which costs more
+        # than building the rest of the message
+        message = EmailMessage()
+        for name, header in self.skeleton.items():
+            message[name] = header
+        message['Subject'] = subject
+        message['To'] = recipient
+
+        # Add essential headers to reduce spam likelihood
+        message['Message-ID'] = make_msgid(domain=self.domain)
+        message['Date'] = formatdate(localtime=True)
+
+        # Set the body with UTF-8 encoding, plus an HTML version with improved formatting
+        message.set_content(body, charset='utf-8')
+        message.add_alternative(HTML_HEAD + body.replace('\n', '<br>') + HTML_TAIL, subtype='html', charset='utf-8')
+
+        # Add attachments if any
+        for attachment in self.attachments:
+            attachment.attach(message)
+        return message
+
 
 class BulkEmailer:
-    def __init__(self, smtp_server: str, smtp_port: int, username: str, password: str):
+    def __init__(self, smtp_server: str, smtp_port: int, username: str, password: str,
+                 transport: Optional[Transport] = None, metrics: Optional[SendMetrics] = None,
+                 scheduler: Optional[RateScheduler] = None, sessions: Optional[int] = None,
+                 transport_factory: Optional[Callable[[], Transport]] = None):
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
         self.username = username
         self.password = password
         self.cleaner = TextCleaner()
         self.email_validator = EmailAddressValidator()
-
-    def _add_attachment(self, message: EmailMessage, filepath: str) -> None:
-        """Add an attachment to the email message"""
-        try:
-            # Guess the content type of the file
-            content_type, encoding = mimetypes.guess_type(filepath)
-            if content_type is None or encoding is not None:
-                content_type = 'application/octet-stream'
-            maintype, subtype = content_type.split('/', 1)
-            
-            with open(filepath, 'rb') as f:
-                message.add_attachment(
-                    f.read(),
-                    maintype=maintype,
-                    subtype=subtype,
-                    filename=os.path.basename(filepath)
-                )
-        except Exception as e:
-            print(f"Failed to attach file {filepath}: {str(e)}")
+        # Defaults to the backend selected by EMAIL_TRANSPORT (SMTP unless configured)
+        self.transport = transport or create_transport(smtp_server, smtp_port, username, password)
+        # Opens the extra sessions of a merge run; without it a given transport runs alone
+        if transport_factory is None and transport is None:
+            transport_factory = lambda: create_transport(smtp_server, smtp_port, username, password)
+        self.transport_factory = transport_factory
+        self.sessions = max(1, sessions or int(os.getenv('SEND_SESSIONS', 1)))
+        # Paces throttled transports; shared by every emailer sending as this account
+        self.scheduler = scheduler or get_scheduler(username)
+        # Hook for send-pipeline measurements; the shared one is served at /metrics
+        self.metrics = metrics or SEND_METRICS
+        self.transport.metrics = self.metrics
 
     def validate_emails(self) -> Tuple[bool, Dict[str, List[str]], List[str]]:
         """Validate all email addresses in the message"""
@@ -44,102 +103,74 @@ class BulkEmailer:
             self.bcc_list
         )
 
+    def _build_message(self, factory: MessageFactory, recipient: str, subject: str, body: str) -> EmailMessage:
+        """Build the message for one primary recipient from the run's factory"""
+        with self.metrics.time('mime_build_seconds'):
+            return factory.build(recipient, subject, body)
+
+    def _deliver(self, transport: Transport, message: EmailMessage, all_recipients: List[str]) -> None:
+        """Hand one message to the transport and record the outcome per recipient"""
+        self.metrics.observe('batch_size_recipients', len(all_recipients))
+        self.metrics.adjust('batches_in_flight', 1)
+        try:
+            refused = transport.send(message, all_recipients) or {}
+        except Exception as e:
+            if isinstance(e, smtplib.SMTPRecipientsRefused):
+                self.metrics.count('recipients_total', len(e.recipients), outcome='rejected')
+            else:
+                self.metrics.count('recipients_total', len(all_recipients), outcome='failed')
+            raise
+        finally:
+            self.metrics.adjust('batches_in_flight', -1)
+        self.metrics.count('recipients_total', len(all_recipients) - len(refused), outcome='sent')
+        if refused:
+            self.metrics.count('recipients_total', len(refused), outcome='rejected')
+
+    def _pacer(self, delay: Optional[float]) -> RateScheduler:
+        """The account's scheduler, or a fixed interval of ``delay`` seconds (0 for none) when given"""
+        if delay is None:
+            return self.scheduler
+        return RateScheduler(rate=1 / delay if delay > 0 else 0)
+
     def send_bulk_emails(self, subject: str, body: str, recipient_list: List[str], 
                         cc_list: Optional[List[str]] = None, 
                         bcc_list: Optional[List[str]] = None,
                         attachments: Optional[List[str]] = None, 
-                        delay: int = 2):
+                        delay: Optional[float] = None):
+        pacer = self._pacer(delay)
         try:
+            # Read and encode each attachment once, and build the static headers once
+            factory = MessageFactory(self.username, cc_list, load_attachments(attachments))
+
             # Clean all text inputs before processing
             subject = self.cleaner.clean_text(subject)
             body = self.cleaner.clean_text(body)
             
-            # Initial validation of all email addresses
-            for email in recipient_list:
-                is_valid, error_msg = EmailAddressValidator.validate_single_email(email)
-                if not is_valid:
-                    raise ValueError(f"Invalid recipient email: {email} - {error_msg}")
-
-            if cc_list:
-                for email in cc_list:
-                    is_valid, error_msg = EmailAddressValidator.validate_single_email(email)
+            # Initial validation of all email addresses, one DNS lookup per domain
+            results = EmailAddressValidator.validate_many(recipient_list + (cc_list or []) + (bcc_list or []))
+            for label, emails in (('recipient', recipient_list), ('CC', cc_list), ('BCC', bcc_list)):
+                for email in emails or []:
+                    is_valid, error_msg = results[email]
                     if not is_valid:
-                        raise ValueError(f"Invalid CC email: {email} - {error_msg}")
+                        raise ValueError(f"Invalid {label} email: {email} - {error_msg}")
 
-            if bcc_list:
-                for email in bcc_list:
-                    is_valid, error_msg = EmailAddressValidator.validate_single_email(email)
-                    if not is_valid:
-                        raise ValueError(f"Invalid BCC email: {email} - {error_msg}")
-
-            # Connect to SMTP server first to test connection
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.username, self.password)
-                
+            # Open the transport first to test the connection
+            with self.transport as transport:
                 # For each primary recipient
                 for recipient in recipient_list:
+                    # Set all recipients for sending
+                    all_recipients = [recipient] + (cc_list or []) + (bcc_list or [])
                     try:
-                        # Create a new message for each recipient
-                        message = EmailMessage()
-                        message['From'] = f"Jashwanth Yerra <{self.username}>"
-                        message['Subject'] = subject
-                        message['To'] = recipient
-                        
-                        # Add essential headers to reduce spam likelihood
-                        message['Message-ID'] = EmailMessage().get('Message-ID')
-                        message['Date'] = EmailMessage().get('Date')
-                        message['MIME-Version'] = '1.0'
-                        
-                        # Set CC if provided
-                        if cc_list and len(cc_list) > 0:
-                            message['Cc'] = ', '.join(cc_list)
-                        
-                        # Set the body with UTF-8 encoding
-                        message.set_content(body, charset='utf-8')
-                        
-                        # Add HTML version of the body with improved formatting
-                        html_body = f"""
-                        <!DOCTYPE html>
-                        <html lang="en">
-                        <head>
-                            <meta charset="UTF-8">
-                            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                        </head>
-                        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-                            {body.replace('\\n', '<br>')}
-                        </body>
-                        </html>
-                        """
-                        message.add_alternative(html_body, subtype='html', charset='utf-8')
-                        
-                        # Add attachments if any
-                        if attachments:
-                            for attachment_path in attachments:
-                                if os.path.exists(attachment_path):
-                                    self._add_attachment(message, attachment_path)
-                        
-                        # Set all recipients for sending
-                        all_recipients = [recipient]
-                        if cc_list:
-                            all_recipients.extend(cc_list)
-                        if bcc_list:
-                            all_recipients.extend(bcc_list)
-                        
-                        # Add List-Unsubscribe header
-                        message['List-Unsubscribe'] = f'<mailto:{self.username}?subject=unsubscribe>'
-                        
+                        message = self._build_message(factory, recipient, subject, body)
+
+                        # Wait for the next send slot; only a real server needs pacing
+                        if transport.throttled:
+                            pacer.wait()
+
                         # Send the message
-                        server.send_message(message, to_addrs=all_recipients)
+                        self._deliver(transport, message, all_recipients)
                         print(f"Successfully sent email to {recipient} with CC/BCC")
-                        
-                        # Dynamic delay based on batch size
-                        batch_size = len(recipient_list)
-                        if batch_size > 10:
-                            time.sleep(delay * 2)  # Increased delay for larger batches
-                        else:
-                            time.sleep(delay)
-                        
+
                     except Exception as e:
                         print(f"Failed to send email to {recipient}: {str(e)}")
                         raise  # Re-raise the exception to be caught by the outer try block
@@ -147,4 +178,117 @@ class BulkEmailer:
         except Exception as e:
             error_msg = str(e)
             print(f"Email sending failed: {error_msg}")
-            raise Exception(f"Email sending failed: {error_msg}")
\ No newline at end of file
+            raise Exception(f"Email sending failed: {error_msg}")
+
+    def send_merge(self, template: EmailTemplate, rows: Iterable[Tuple[str, Dict[str, str]]],
+                   cc_list: Optional[List[str]] = None,
+                   bcc_list: Optional[List[str]] = None,
+                   attachments: Optional[List[str]] = None,
+                   delay: Optional[float] = None,
+                   progress: Optional[Callable[[str, Optional[str]], None]] = None) -> Dict[str, object]:
+        """Render and send one message per (recipient, variables) row over long-lived sessions
+
+        ``rows`` may be any iterable, so a large list can be streamed. Each session is
+        opened once for the whole run and reconnects by itself when the server closes it,
+        e.g. after its per-session message limit. Over SMTP up to ``sessions`` of them
+        pull rows concurrently from a thread pool, all paced by the account's scheduler
+        (or every ``delay`` seconds when given). A row that cannot be sent (invalid
+        address, missing variable, refused recipient) is recorded in ``failed`` and the
+        run goes on; reaching the daily quota stops it, and an error from a transport
+        ends it. ``progress`` is called with each recipient and None once it is sent, or
+        the reason it failed. Returns ``{'sent': count, 'failed': {recipient: reason},
+        'unsent': count, 'stopped': reason or None}``."""
+        # CC and BCC are the same for every message, so they are checked once
+        for label, emails in (('CC', cc_list), ('BCC', bcc_list)):
+            for email in emails or []:
+                is_valid, error_msg = EmailAddressValidator.validate_single_email(email)
+                if not is_valid:
+                    raise ValueError(f"Invalid {label} email: {email} - {error_msg}")
+
+        pacer = self._pacer(delay)
+        # Read and encode each attachment once and build the static headers once;
+        # every session builds its messages from the same factory
+        factory = MessageFactory(self.username, cc_list, load_attachments(attachments))
+        # Clean the template's own text once; per recipient only the values are cleaned
+        clean = self.cleaner.clean_text
+        subject_template = template.compiled_subject.with_literals(clean)
+        body_template = template.compiled_body.with_literals(clean)
+        rows = iter(rows)
+        lock = threading.Lock()
+        stop = threading.Event()
+        result = {'sent': 0, 'failed': {}, 'unsent': 0, 'stopped': None}
+
+        def next_row() -> Optional[Tuple[str, Dict[str, str]]]:
+            with lock:
+                # After the quota runs out, sessions finish the slots they already hold
+                if stop.is_set() or result['stopped']:
+                    return None
+                return next(rows, None)
+
+        def run_session(transport: Transport) -> None:
+            try:
+                with transport:
+                    while True:
+                        row = next_row()
+                        if row is None:
+                            return
+                        recipient, variables = row
+                        is_valid, error_msg = EmailAddressValidator.validate_single_email(recipient)
+                        if not is_valid:
+                            with lock:
+                                result['failed'][recipient] = error_msg
+                            if progress:
+                                progress(recipient, error_msg)
+                            continue
+                        try:
+                            template.check([variables])
+                            values = {name: clean(variables[name]) for name in template.required_variables}
+                            message = self._build_message(factory, recipient, subject_template.render(values),
+                                                          body_template.render(values))
+                            if transport.throttled and not pacer.wait(stop):
+                                with lock:
+                                    result['unsent'] += 1
+                                return
+                            self._deliver(transport, message, [recipient] + (cc_list or []) + (bcc_list or []))
+                        except QuotaExceeded as e:
+                            print(f"Stopping the run: {str(e)}")
+                            with lock:
+                                result['stopped'] = str(e)
+                                result['unsent'] += 1
+                            return
+                        except (ValueError, smtplib.SMTPRecipientsRefused) as e:
+                            print(f"Failed to send email to {recipient}: {str(e)}")
+                            with lock:
+                                result['failed'][recipient] = str(e)
+                            if progress:
+                                progress(recipient, str(e))
+                            continue
+                        with lock:
+                            result['sent'] += 1
+                        if progress:
+                            progress(recipient, None)
+                        print(f"Successfully sent email to {recipient}")
+            except Exception:
+                # Stop the other sessions too; the error is raised from send_merge
+                stop.set()
+                raise
+
+        # Extra sessions only pay off when each send waits on a mail server
+        transports = [self.transport]
+        if self.transport.throttled and self.transport_factory is not None:
+            for _ in range(self.sessions - 1):
+                transport = self.transport_factory()
+                transport.metrics = self.metrics
+                transports.append(transport)
+
+        if len(transports) == 1:
+            run_session(self.transport)
+        else:
+            with ThreadPoolExecutor(max_workers=len(transports)) as pool:
+                futures = [pool.submit(run_session, transport) for transport in transports]
+            for future in futures:
+                future.result()
+
+        # Rows left over after the quota stopped the run
+        result['unsent'] += sum(1 for _ in rows)
+        return result
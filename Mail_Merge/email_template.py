@@ -1,36 +1,97 @@
 import json
 import os
-from typing import Dict, List, Optional
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# {variable_name}; values are inserted as-is, so a value containing {x} is never expanded
+PLACEHOLDER = re.compile(r'\{([^}]+)\}')
+
+
+class MissingVariablesError(ValueError):
+    """Raised before rendering when recipient data lacks variables the template uses"""
+
+    def __init__(self, missing: Dict[int, List[str]]):
+        self.missing = missing
+        details = '; '.join(f"recipient {index + 1}: {', '.join(names)}" for index, names in missing.items())
+        super().__init__(f"Missing template variables ({details})")
+
+
+class CompiledTemplate:
+    """Text split once into literal and placeholder segments
+
+    Rendering copies the segment list, drops each value into its slot and joins once,
+    instead of scanning the whole text for every variable."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.parts: List[str] = []
+        # (index into parts, variable name) for every placeholder
+        self.slots: List[Tuple[int, str]] = []
+        position = 0
+        for match in PLACEHOLDER.finditer(text):
+            self.parts.append(text[position:match.start()])
+            self.slots.append((len(self.parts), match.group(1)))
+            self.parts.append('')
+            position = match.end()
+        self.parts.append(text[position:])
+        self.variables = sorted({name for _, name in self.slots})
+
+    def with_literals(self, transform: Callable[[str], str]) -> 'CompiledTemplate':
+        """A copy with ``transform`` applied once to the literal text, placeholders untouched"""
+        compiled = CompiledTemplate.__new__(CompiledTemplate)
+        compiled.text = self.text
+        slot_indexes = {index for index, _ in self.slots}
+        compiled.parts = [part if i in slot_indexes else transform(part) for i, part in enumerate(self.parts)]
+        compiled.slots = self.slots
+        compiled.variables = self.variables
+        return compiled
+
+    def render(self, data: Dict[str, str]) -> str:
+        parts = self.parts.copy()
+        for index, name in self.slots:
+            parts[index] = data[name]
+        return ''.join(parts)
+
 
 class EmailTemplate:
     def __init__(self, name: str, subject: str, body: str, variables: Optional[List[str]] = None):
         self.name = name
         self.subject = subject
         self.body = body
-        self.variables = variables or self._extract_variables()
+        # Compiled once here, so whether loaded or saved, a template is parsed a single time
+        self.compiled_subject = CompiledTemplate(subject)
+        self.compiled_body = CompiledTemplate(body)
+        self.required_variables = self._extract_variables()
+        self.variables = variables or self.required_variables
 
     def _extract_variables(self) -> List[str]:
         """Extract variables from the template (anything in {curly braces})"""
-        import re
-        variables = set()
-        # Find all {variable_name} in both subject and body
-        pattern = r'\{([^}]+)\}'
-        variables.update(re.findall(pattern, self.subject))
-        variables.update(re.findall(pattern, self.body))
-        return sorted(list(variables))
-
-    def render(self, recipient_data: Dict[str, str]) -> tuple[str, str]:
+        return sorted(set(self.compiled_subject.variables) | set(self.compiled_body.variables))
+
+    def missing_variables(self, recipient_data: Dict[str, str]) -> List[str]:
+        """Variables the template uses that the recipient data does not provide"""
+        return [name for name in self.required_variables if name not in recipient_data]
+
+    def check(self, rows: Iterable[Dict[str, str]]) -> None:
+        """Raise MissingVariablesError listing every row that lacks a variable"""
+        missing = {}
+        for index, row in enumerate(rows):
+            names = self.missing_variables(row)
+            if names:
+                missing[index] = names
+        if missing:
+            raise MissingVariablesError(missing)
+
+    def render(self, recipient_data: Dict[str, str]) -> Tuple[str, str]:
         """Render the template with the given variables"""
-        subject = self.subject
-        body = self.body
-        
-        # Replace each variable in both subject and body
-        for var_name, value in recipient_data.items():
-            placeholder = '{' + var_name + '}'
-            subject = subject.replace(placeholder, value)
-            body = body.replace(placeholder, value)
-            
-        return subject, body
+        self.check([recipient_data])
+        return self.compiled_subject.render(recipient_data), self.compiled_body.render(recipient_data)
+
+    def render_many(self, rows: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+        """Render the template for many recipients, after checking all of them for missing variables"""
+        self.check(rows)
+        subject, body = self.compiled_subject.render, self.compiled_body.render
+        return [(subject(row), body(row)) for row in rows]
 
 class TemplateManager:
     def __init__(self, templates_dir: str = 'templates'):
@@ -1,49 +1,183 @@
 from email_validator import validate_email as validate_email_address, EmailNotValidError
-from typing import List, Dict, Tuple
-import dns.resolver
+from email_validator.deliverability import validate_email_deliverability
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Iterable, Optional, Tuple
+import os
 import re
+import threading
+import time
+
+
+class DomainCache:
+    """Deliverability of email domains, cached per domain for a TTL
+
+    A list of ten thousand gmail.com addresses costs one DNS lookup instead of ten
+    thousand. Undeliverable domains (NXDOMAIN, no MX, null MX) are cached for
+    ``negative_ttl``, as are lookups that timed out or found no nameserver, which
+    email_validator lets through, so a slow resolver is not asked again for every
+    address. Threads asking for a domain that is already being resolved wait for that
+    lookup instead of starting their own. ``resolver`` is any object with dnspython's
+    ``resolve(name, rdtype)``, so tests can stub DNS out (see benchmarks/domain_cache.py);
+    by default dnspython's system resolver is used."""
+
+    def __init__(self, ttl: Optional[float] = None, negative_ttl: Optional[float] = None,
+                 resolver=None, max_workers: Optional[int] = None, max_entries: int = 10000):
+        self.ttl = ttl if ttl is not None else float(os.getenv('MX_CACHE_TTL', 3600))
+        self.negative_ttl = negative_ttl if negative_ttl is not None else float(os.getenv('MX_CACHE_NEGATIVE_TTL', 300))
+        self.resolver = resolver
+        self.max_workers = max_workers or int(os.getenv('MX_LOOKUP_WORKERS', 16))
+        self.max_entries = max_entries
+        self.lookups = 0
+        self._lock = threading.Lock()
+        # domain -> (expires_at, deliverable, error message)
+        self._entries: Dict[str, Tuple[float, bool, str]] = {}
+        # domain -> result of the lookup in progress for it
+        self._inflight: Dict[str, Future] = {}
+
+    def lookup(self, domain: str) -> Tuple[bool, str, bool]:
+        """Resolve a domain without the cache: (deliverable, error, definitive)"""
+        with self._lock:
+            self.lookups += 1
+        try:
+            info = validate_email_deliverability(domain, domain, dns_resolver=self.resolver)
+        except EmailNotValidError as e:
+            return False, str(e), True
+        return True, "", 'unknown-deliverability' not in info
+
+    def _get(self, domain: str) -> Optional[Tuple[bool, str]]:
+        with self._lock:
+            entry = self._entries.get(domain)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1], entry[2]
+
+    def _put(self, domain: str, result: Tuple[bool, str, bool]) -> Tuple[bool, str]:
+        deliverable, error, definitive = result
+        ttl = self.ttl if deliverable and definitive else self.negative_ttl
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries = {d: e for d, e in self._entries.items() if e[0] > now}
+                # Still full of live entries: drop the oldest
+                while len(self._entries) >= self.max_entries:
+                    del self._entries[next(iter(self._entries))]
+            self._entries[domain] = (now + ttl, deliverable, error)
+        return deliverable, error
+
+    def _resolve(self, domain: str) -> Tuple[bool, str]:
+        """Look a domain up and cache the answer, or wait for the lookup already in progress"""
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1], entry[2]
+            future = self._inflight.get(domain)
+            if future is None:
+                future = self._inflight[domain] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+        try:
+            result = self._put(domain, self.lookup(domain))
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[domain]
+
+    def check(self, domain: str) -> Tuple[bool, str]:
+        """Whether a domain accepts email, and why not"""
+        domain = domain.lower()
+        cached = self._get(domain)
+        if cached is not None:
+            return cached
+        return self._resolve(domain)
+
+    def check_many(self, domains: Iterable[str]) -> Dict[str, Tuple[bool, str]]:
+        """Check several domains, resolving the ones not cached concurrently"""
+        results = {}
+        missing = []
+        for domain in {domain.lower() for domain in domains}:
+            cached = self._get(domain)
+            if cached is not None:
+                results[domain] = cached
+            else:
+                missing.append(domain)
+
+        if len(missing) == 1:
+            results[missing[0]] = self._resolve(missing[0])
+        elif missing:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as pool:
+                results.update(zip(missing, pool.map(self._resolve, missing)))
+        return results
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every validation in the process
+DOMAIN_CACHE = DomainCache()
+
 
 class EmailAddressValidator:
     @staticmethod
     def _check_domain_mx(domain: str) -> bool:
         """Check if the domain has valid MX records"""
-        try:
-            dns.resolver.resolve(domain, 'MX')
-            return True
-        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers):
-            return False
+        return DOMAIN_CACHE.check(domain)[0]
 
     @staticmethod
-    def validate_single_email(email: str) -> Tuple[bool, str]:
-        """Validate a single email address with enhanced checks"""
+    def _check_syntax(email: str) -> Tuple[bool, str, str]:
+        """Validate everything but deliverability: (is_valid, error, ASCII domain)"""
         try:
             # Basic pattern check before detailed validation
             pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
             if not re.match(pattern, email):
-                return False, "Invalid email format"
+                return False, "Invalid email format", ""
 
             # Check for invalid domain patterns
             local_part, domain = email.split('@')
-            
+
             # Check for consecutive dots
             if '..' in domain:
-                return False, "Domain cannot contain consecutive dots"
-                
+                return False, "Domain cannot contain consecutive dots", ""
+
             # Check for invalid TLD (too long or has consecutive dots)
             tld = domain.split('.')[-1]
             if len(tld) > 6 or '..' in tld:
-                return False, "Invalid top-level domain"
+                return False, "Invalid top-level domain", ""
 
-            # Basic email validation
+            # Basic email validation; the domain's DNS is checked through DOMAIN_CACHE
             try:
-                validated = validate_email_address(email, check_deliverability=True)
-                email = validated.normalized
-                return True, ""
+                validated = validate_email_address(email, check_deliverability=False)
+                return True, "", validated.ascii_domain
             except EmailNotValidError as e:
-                return False, str(e)
+                return False, str(e), ""
 
         except Exception as e:
-            return False, f"Invalid email format: {str(e)}"
+            return False, f"Invalid email format: {str(e)}", ""
+
+    @staticmethod
+    def validate_single_email(email: str) -> Tuple[bool, str]:
+        """Validate a single email address with enhanced checks"""
+        is_valid, error, domain = EmailAddressValidator._check_syntax(email)
+        if not is_valid:
+            return False, error
+        return DOMAIN_CACHE.check(domain)
+
+    @staticmethod
+    def validate_many(emails: Iterable[str]) -> Dict[str, Tuple[bool, str]]:
+        """Validate many addresses at once, looking up each distinct domain once and concurrently"""
+        syntax = {email: EmailAddressValidator._check_syntax(email) for email in emails}
+        domains = DOMAIN_CACHE.check_many(domain for is_valid, _, domain in syntax.values() if is_valid)
+        return {
+            email: domains[domain.lower()] if is_valid else (False, error)
+            for email, (is_valid, error, domain) in syntax.items()
+        }
 
     @staticmethod
     def validate_email_lists(to_list: List[str], cc_list: List[str] = None, bcc_list: List[str] = None) -> Tuple[bool, Dict[str, List[str]], Dict[str, List[str]]]:
@@ -63,30 +197,14 @@ class EmailAddressValidator:
             'bcc': []
         }
 
-        # Validate TO list
-        for email in to_list:
-            is_valid, _ = EmailAddressValidator.validate_single_email(email)
-            if is_valid:
-                valid_emails['to'].append(email)
-            else:
-                invalid_emails['to'].append(email)
-
-        # Validate CC list
-        for email in cc_list:
-            is_valid, _ = EmailAddressValidator.validate_single_email(email)
-            if is_valid:
-                valid_emails['cc'].append(email)
-            else:
-                invalid_emails['cc'].append(email)
-
-        # Validate BCC list
-        for email in bcc_list:
-            is_valid, _ = EmailAddressValidator.validate_single_email(email)
-            if is_valid:
-                valid_emails['bcc'].append(email)
-            else:
-                invalid_emails['bcc'].append(email)
+        results = EmailAddressValidator.validate_many(to_list + cc_list + bcc_list)
+        for kind, emails in (('to', to_list), ('cc', cc_list), ('bcc', bcc_list)):
+            for email in emails:
+                if results[email][0]:
+                    valid_emails[kind].append(email)
+                else:
+                    invalid_emails[kind].append(email)
 
         # Return validation status, invalid emails dict, and valid emails dict
         has_invalid = any(len(emails) > 0 for emails in invalid_emails.values())
-        return (not has_invalid), invalid_emails, valid_emails
\ No newline at end of file
+        return (not has_invalid), invalid_emails, valid_emails
@@ -3,8 +3,8 @@ import os
 
 def main():
     # Email configuration
-    SMTP_SERVER = "smtp.gmail.com"
-    SMTP_PORT = 587
+    SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+    SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
     
     # Your email settings
     EMAIL = "jashwanthyerra2404@gmail.com"
@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from bulk_emailer import BulkEmailer
+from email_template import EmailTemplate
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+INTERRUPTED = 'interrupted'
+
+
+class MergeJob:
+    """Progress of one background mail-merge run, saved as JSON after every change worth keeping"""
+
+    def __init__(self, job_id: str, total: int, path: str, upload_dir: Optional[str] = None):
+        self.id = job_id
+        self.total = total
+        self.path = path
+        self.upload_dir = upload_dir
+        self.status = QUEUED
+        self.sent = 0
+        self.failed: Dict[str, str] = {}
+        self.unsent = 0
+        self.stopped: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._saved_at = 0.0
+
+    @classmethod
+    def from_dict(cls, data: dict, path: str) -> 'MergeJob':
+        job = cls(data['id'], data['total'], path)
+        for key in ('status', 'sent', 'failed', 'unsent', 'stopped', 'error',
+                    'created_at', 'started_at', 'finished_at'):
+            setattr(job, key, data.get(key, getattr(job, key)))
+        return job
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'id': self.id,
+                'status': self.status,
+                'total': self.total,
+                'sent': self.sent,
+                'failed': dict(self.failed),
+                'unsent': self.unsent,
+                'stopped': self.stopped,
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+    def progress(self) -> dict:
+        """The job as the progress endpoint reports it, with its send rate"""
+        data = self.to_dict()
+        data['failed_count'] = len(data['failed'])
+        data['done'] = data['sent'] + data['failed_count'] + data['unsent']
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        data['elapsed'] = round(elapsed, 1)
+        data['rate'] = round(self.sent / elapsed, 2) if elapsed > 0 else 0.0
+        return data
+
+    def save(self, force: bool = True) -> None:
+        """Write the job to disk; unforced saves happen at most once a second"""
+        with self._save_lock:
+            now = time.monotonic()
+            if not force and now - self._saved_at < 1.0:
+                return
+            self._saved_at = now
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def record(self, recipient: str, error: Optional[str]) -> None:
+        """Progress hook for BulkEmailer.send_merge"""
+        with self._lock:
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed[recipient] = error
+        self.save(force=False)
+
+
+class MergeJobManager:
+    """Runs mail merges on a thread pool and keeps their state under ``jobs_dir``
+
+    Job files survive a restart so their outcome can still be looked up. Runs do not:
+    the sender's password is never written to disk, so a job that was queued or running
+    when the process stopped is marked interrupted on the next start."""
+
+    def __init__(self, jobs_dir: str = 'jobs', max_workers: Optional[int] = None):
+        self.jobs_dir = jobs_dir
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers or int(os.getenv('MERGE_JOB_WORKERS', 2)),
+                                       thread_name_prefix='merge-job')
+        self.jobs: Dict[str, MergeJob] = {}
+        self._lock = threading.Lock()
+        self._load_jobs()
+
+    def _load_jobs(self) -> None:
+        """Load saved jobs, marking the ones cut off by a restart as interrupted"""
+        for filename in os.listdir(self.jobs_dir):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.jobs_dir, filename)
+            try:
+                with open(path, 'r') as f:
+                    job = MergeJob.from_dict(json.load(f), path)
+            except (OSError, ValueError, KeyError):
+                continue
+            if job.status in (QUEUED, RUNNING):
+                job.status = INTERRUPTED
+                job.error = 'The server restarted before the job finished'
+                job.finished_at = time.time()
+                job.save()
+            self.jobs[job.id] = job
+
+    def new_job_id(self) -> str:
+        return uuid.uuid4().hex
+
+    def submit(self, job_id: str, emailer_factory: Callable[[], BulkEmailer], template: EmailTemplate,
+               rows: List[Tuple[str, Dict[str, str]]], upload_dir: Optional[str] = None, **send_options) -> MergeJob:
+        """Queue a merge run; ``send_options`` go to BulkEmailer.send_merge"""
+        job = MergeJob(job_id, len(rows), os.path.join(self.jobs_dir, f"{job_id}.json"), upload_dir)
+        job.save()
+        with self._lock:
+            self.jobs[job_id] = job
+        self.pool.submit(self._run, job, emailer_factory, template, rows, send_options)
+        return job
+
+    def _run(self, job: MergeJob, emailer_factory: Callable[[], BulkEmailer], template: EmailTemplate,
+             rows: List[Tuple[str, Dict[str, str]]], send_options: dict) -> None:
+        with job._lock:
+            job.status = RUNNING
+            job.started_at = time.time()
+        job.save()
+        try:
+            result = emailer_factory().send_merge(template, rows, progress=job.record, **send_options)
+            with job._lock:
+                job.unsent = result['unsent']
+                job.stopped = result['stopped']
+                job.status = DONE
+                job.finished_at = time.time()
+        except Exception as e:
+            logger.exception(f"Merge job {job.id} failed: {str(e)}")
+            with job._lock:
+                job.unsent = job.total - job.sent - len(job.failed)
+                job.error = str(e)
+                job.status = FAILED
+                job.finished_at = time.time()
+        finally:
+            job.save()
+            if job.upload_dir:
+                shutil.rmtree(job.upload_dir, ignore_errors=True)
+
+    def get(self, job_id: str) -> Optional[MergeJob]:
+        with self._lock:
+            return self.jobs.get(job_id)
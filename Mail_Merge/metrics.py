@@ -0,0 +1,84 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, disable_created_metrics, generate_latest,
+)
+
+# Prometheus text exposition format
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Drop the *_created series, which record when each counter and histogram came to be
+disable_created_metrics()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Same names as the Bulk_email API's metrics, under the mail_merge_ prefix: kind, help and label names
+CATALOG = {
+    'recipients_total': ('counter', 'Recipients by outcome: sent, failed, or rejected by the server.', ('outcome',)),
+    'recipients_retried_total': ('counter', 'Recipients sent again after a transient failure.', ()),
+    'mime_build_seconds': ('histogram', 'Time spent building each personalized message.', ()),
+    'batch_size_recipients': ('histogram', 'Envelope recipients per message, CC and BCC included.', ()),
+    'smtp_connect_seconds': ('histogram', 'Time to open an SMTP session, including STARTTLS.', ()),
+    'smtp_login_seconds': ('histogram', 'Time to authenticate an SMTP session.', ()),
+    'smtp_data_seconds': ('histogram', 'Time from the DATA command until the server accepts the message.', ()),
+    'batches_in_flight': ('gauge', 'Messages currently being handed to the transport.', ()),
+    'smtp_connections': ('gauge', 'Open SMTP sessions.', ()),
+}
+
+
+class SendMetrics:
+    """Metrics hook for BulkEmailer and its transport, kept in a prometheus_client registry.
+
+    Every name must be listed in CATALOG. Subclass and override ``count``, ``observe`` and
+    ``adjust`` to forward the measurements elsewhere."""
+
+    def __init__(self, prefix: str = 'mail_merge'):
+        self.prefix = prefix
+        self.registry = CollectorRegistry()
+        self._metrics = {}
+        for name, (kind, documentation, labelnames) in CATALOG.items():
+            full_name = f"{prefix}_{name}"
+            if kind == 'counter':
+                metric = Counter(full_name, documentation, labelnames, registry=self.registry)
+            elif kind == 'gauge':
+                metric = Gauge(full_name, documentation, labelnames, registry=self.registry)
+            else:
+                buckets = SIZE_BUCKETS if name == 'batch_size_recipients' else LATENCY_BUCKETS
+                metric = Histogram(full_name, documentation, labelnames, buckets=buckets, registry=self.registry)
+            self._metrics[name] = metric
+
+    def _metric(self, name: str, labels: dict):
+        if name not in self._metrics:
+            raise ValueError(f"Unknown metric: {name}")
+        metric = self._metrics[name]
+        return metric.labels(**labels) if labels else metric
+
+    def count(self, name: str, amount: float = 1, **labels) -> None:
+        """Increase a counter"""
+        self._metric(name, labels).inc(amount)
+
+    def adjust(self, name: str, delta: float, **labels) -> None:
+        """Move a gauge up or down"""
+        self._metric(name, labels).inc(delta)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record one histogram observation"""
+        self._metric(name, labels).observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """Observe how long the block takes"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self) -> bytes:
+        return generate_latest(self.registry)
+
+
+# Shared by every BulkEmailer that is not given its own hook, and served at /metrics
+SEND_METRICS = SendMetrics()
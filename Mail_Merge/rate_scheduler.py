@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+class QuotaExceeded(Exception):
+    """Raised when the daily quota leaves no room for another message"""
+
+    def __init__(self, quota: int, retry_after: float):
+        self.quota = quota
+        self.retry_after = retry_after
+        super().__init__(f"Daily sending quota of {quota} messages reached; "
+                         f"the next slot frees up in {retry_after / 60:.0f} minutes")
+
+
+class RateScheduler:
+    """Hands out send slots at ``rate`` messages per second, within ``daily_quota`` per 24 hours
+
+    A reservation is made under a lock and returns how long the caller has to wait for
+    its slot, so several sessions share one limit and each waits only until its own turn
+    instead of a fixed delay after every message. ``burst`` lets that many messages go
+    out back to back after a quiet spell. A rate of 0 means no pacing and a quota of 0
+    no quota; the quota is a rolling 24-hour window, as Gmail counts it."""
+
+    def __init__(self, rate: float = 0, daily_quota: int = 0, burst: int = 1):
+        self.rate = rate
+        self.daily_quota = daily_quota
+        self.burst = max(1, burst)
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        # Wall-clock time of every reservation in the last 24 hours, when there is a quota
+        self._reserved: Deque[float] = deque()
+
+    def _expire(self, now: float) -> None:
+        while self._reserved and self._reserved[0] <= now - DAY_SECONDS:
+            self._reserved.popleft()
+
+    def reserve(self) -> float:
+        """Claim the next slot and return the seconds until it starts
+
+        Raises QuotaExceeded, without claiming anything, when the daily quota is used up."""
+        with self._lock:
+            if self.daily_quota:
+                now = time.time()
+                self._expire(now)
+                if len(self._reserved) >= self.daily_quota:
+                    raise QuotaExceeded(self.daily_quota, self._reserved[0] + DAY_SECONDS - now)
+                self._reserved.append(now)
+            if not self.rate:
+                return 0.0
+            interval = 1 / self.rate
+            now = time.monotonic()
+            slot = max(self._next_slot, now - (self.burst - 1) * interval)
+            self._next_slot = slot + interval
+            return max(0.0, slot - now)
+
+    def wait(self, stop: Optional[threading.Event] = None) -> bool:
+        """Reserve a slot and wait for it; False if ``stop`` was set while waiting"""
+        delay = self.reserve()
+        if stop is None:
+            if delay > 0:
+                time.sleep(delay)
+            return True
+        return not stop.wait(delay) if delay > 0 else not stop.is_set()
+
+    def remaining_today(self) -> Optional[int]:
+        """Messages still allowed in the current 24-hour window, or None without a quota"""
+        if not self.daily_quota:
+            return None
+        with self._lock:
+            self._expire(time.time())
+            return self.daily_quota - len(self._reserved)
+
+
+def scheduler_from_env() -> RateScheduler:
+    """Build a scheduler from SEND_RATE_PER_SECOND (default 1), SEND_DAILY_QUOTA (default 0,
+    unlimited) and SEND_RATE_BURST (default 1); e.g. 0.5 and 500 for a personal Gmail account"""
+    return RateScheduler(
+        rate=float(os.getenv('SEND_RATE_PER_SECOND', 1)),
+        daily_quota=int(os.getenv('SEND_DAILY_QUOTA', 0)),
+        burst=int(os.getenv('SEND_RATE_BURST', 1))
+    )
+
+
+# The provider's limits are per account, so every BulkEmailer sending as one account shares its scheduler
+_schedulers: Dict[str, RateScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(account: str) -> RateScheduler:
+    """The process-wide scheduler for one sending account"""
+    with _schedulers_lock:
+        if account not in _schedulers:
+            _schedulers[account] = scheduler_from_env()
+        return _schedulers[account]
@@ -14,6 +14,78 @@ document.addEventListener('DOMContentLoaded', function() {
     const cancelEditButton = document.querySelector('#cancel-edit');
     const isEditInput = document.querySelector('#is_edit');
     const templateNameField = document.querySelector('#name');
+    const sendButton = emailForm.querySelector('button[type="submit"]');
+    const progressPanel = document.querySelector('#merge-progress');
+    const progressTrack = progressPanel.querySelector('.progress');
+    const progressBar = progressPanel.querySelector('.progress-bar');
+    const progressStats = progressPanel.querySelector('.merge-progress-stats');
+
+    // Add a message to the flash area; text is inserted as text, never as HTML
+    function showAlert(message, category, autoDismiss = true) {
+        const alert = document.createElement('div');
+        alert.className = `alert alert-${category} alert-dismissible fade show`;
+        alert.textContent = message;
+        const closeButton = document.createElement('button');
+        closeButton.type = 'button';
+        closeButton.className = 'btn-close';
+        closeButton.dataset.bsDismiss = 'alert';
+        alert.appendChild(closeButton);
+        document.querySelector('.flash-messages').appendChild(alert);
+
+        if (autoDismiss) {
+            setTimeout(() => {
+                alert.classList.remove('show');
+                setTimeout(() => alert.remove(), 300);
+            }, 5000);
+        }
+    }
+
+    // Poll a merge job and draw its progress until it finishes
+    function trackJob(progressUrl) {
+        progressPanel.style.display = 'block';
+        progressBar.classList.add('progress-bar-animated');
+        sendButton.disabled = true;
+
+        const poll = () => {
+            fetch(progressUrl)
+                .then(response => response.json())
+                .then(job => {
+                    const percent = job.total ? Math.round(job.done / job.total * 100) : 100;
+                    progressBar.style.width = `${percent}%`;
+                    progressBar.textContent = `${percent}%`;
+                    progressTrack.setAttribute('aria-valuenow', percent);
+                    progressStats.textContent =
+                        `${job.sent} sent, ${job.failed_count} failed of ${job.total} (${job.rate} emails/s)`;
+
+                    if (job.status === 'queued' || job.status === 'running') {
+                        setTimeout(poll, 1000);
+                    } else {
+                        finishJob(job);
+                    }
+                })
+                .catch(() => setTimeout(poll, 3000));
+        };
+        poll();
+    }
+
+    function finishJob(job) {
+        progressBar.classList.remove('progress-bar-animated');
+        sendButton.disabled = false;
+
+        if (job.sent) {
+            showAlert(`${job.sent} emails sent successfully!`, 'success');
+        }
+        // Failures stay on screen until dismissed
+        Object.entries(job.failed).forEach(([recipient, reason]) => {
+            showAlert(`Failed to send to ${recipient}: ${reason}`, 'error', false);
+        });
+        if (job.stopped) {
+            showAlert(`${job.stopped}; ${job.unsent} emails were not sent`, 'error', false);
+        }
+        if (job.error) {
+            showAlert(`Error sending emails: ${job.error}`, 'error', false);
+        }
+    }
 
     // Template editing handler
     editButtons.forEach(button => {
@@ -69,19 +141,7 @@ document.addEventListener('DOMContentLoaded', function() {
                         }
 
                         // Show success message
-                        const alert = document.createElement('div');
-                        alert.className = 'alert alert-success alert-dismissible fade show';
-                        alert.innerHTML = `
-                            ${data.message}
-                            <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
-                        `;
-                        document.querySelector('.flash-messages').appendChild(alert);
-
-                        // Auto dismiss the message
-                        setTimeout(() => {
-                            alert.classList.remove('show');
-                            setTimeout(() => alert.remove(), 300);
-                        }, 5000);
+                        showAlert(data.message, 'success');
                     }
                 })
                 .catch(error => console.error('Error:', error));
@@ -113,9 +173,28 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
-    // Form submission handler
-    emailForm.addEventListener('submit', function() {
+    // Form submission handler: queue the merge as a background job and follow its progress
+    emailForm.addEventListener('submit', function(event) {
+        event.preventDefault();
         loadingOverlay.style.display = 'flex';
+        fetch(window.location.pathname, {
+            method: 'POST',
+            body: new FormData(emailForm),
+            headers: { 'Accept': 'application/json' }
+        })
+            .then(response => response.json().then(data => ({ ok: response.ok, data })))
+            .then(({ ok, data }) => {
+                loadingOverlay.style.display = 'none';
+                if (!ok) {
+                    (data.errors || ['Could not start sending']).forEach(error => showAlert(error, 'error', false));
+                    return;
+                }
+                trackJob(data.progress_url);
+            })
+            .catch(error => {
+                loadingOverlay.style.display = 'none';
+                showAlert(`Error sending emails: ${error}`, 'error', false);
+            });
     });
 
     // Attachment preview
@@ -0,0 +1,360 @@
+import os
+import json
+import smtplib
+import socket
+import time
+from contextlib import nullcontext
+from email.message import EmailMessage
+from email.utils import parseaddr
+from itertools import count
+from typing import Dict, List, Optional, Tuple
+
+from metrics import SendMetrics
+
+
+class Transport:
+    """Delivers email messages to their envelope recipients.
+
+    Use a transport as a context manager around a run: it opens the backend on entry and
+    flushes and closes it on exit. ``throttled`` tells the caller whether sends should be
+    spaced out, which only matters for a real mail server. ``send`` returns the recipients
+    the server refused, and ``metrics`` is the hook BulkEmailer sets to time the SMTP phases."""
+
+    name = 'transport'
+    throttled = False
+    metrics: Optional[SendMetrics] = None
+
+    def open(self) -> None:
+        pass
+
+    def send(self, message: EmailMessage, to_addrs: List[str]) -> Dict[str, Tuple[int, bytes]]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class TimedSMTP(smtplib.SMTP):
+    """smtplib client that reports how long the server takes to accept each message"""
+
+    metrics: Optional[SendMetrics] = None
+
+    def data(self, msg):
+        if self.metrics is None:
+            return super().data(msg)
+        with self.metrics.time('smtp_data_seconds'):
+            return super().data(msg)
+
+
+class SMTPTransport(Transport):
+    """Send over one authenticated SMTP session, upgraded with STARTTLS unless disabled"""
+
+    name = 'smtp'
+    throttled = True
+
+    def __init__(self, smtp_server: str, smtp_port: int, username: str, password: str,
+                 start_tls: bool = True):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.username = username
+        self.password = password
+        self.start_tls = start_tls
+        self.server: Optional[smtplib.SMTP] = None
+
+    def _timed(self, name: str):
+        return self.metrics.time(name) if self.metrics is not None else nullcontext()
+
+    def open(self) -> None:
+        try:
+            with self._timed('smtp_connect_seconds'):
+                self.server = TimedSMTP(self.smtp_server, self.smtp_port)
+                if self.start_tls:
+                    self.server.starttls()
+            self.server.metrics = self.metrics
+            with self._timed('smtp_login_seconds'):
+                self.server.login(self.username, self.password)
+            # Counted once usable, since close() only runs for sessions that opened
+            if self.metrics is not None:
+                self.metrics.adjust('smtp_connections', 1)
+        except BaseException:
+            # __exit__ never runs when opening fails, so drop the half-open session here
+            if self.server is not None:
+                self.server.close()
+                self.server = None
+            raise
+
+    def send(self, message: EmailMessage, to_addrs: List[str]) -> Dict[str, Tuple[int, bytes]]:
+        try:
+            return self.server.send_message(message, to_addrs=to_addrs)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+            # Servers close a session after a number of messages (often with a 421) or
+            # when it sits idle; log in again and resend once
+            if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code != 421:
+                raise
+            print(f"SMTP session closed by the server ({str(e)}), reconnecting")
+            self.close()
+            self.open()
+            if self.metrics is not None:
+                self.metrics.count('recipients_retried_total', len(to_addrs))
+            return self.server.send_message(message, to_addrs=to_addrs)
+
+    def close(self) -> None:
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except smtplib.SMTPException:
+                self.server.close()
+            self.server = None
+            if self.metrics is not None:
+                self.metrics.adjust('smtp_connections', -1)
+
+
+def is_relay_failure(error: Exception) -> bool:
+    """Whether an error points at the relay (connection, login, or a transient 4xx) rather than the message"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError,
+                          smtplib.SMTPAuthenticationError, OSError)):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and 400 <= error.smtp_code < 500
+
+
+class CircuitBreaker:
+    """Eject a relay after ``failure_threshold`` consecutive failures.
+
+    The relay stays out for ``reset_timeout`` seconds, after which one message is let
+    through as a probe: success brings the relay back, failure ejects it again."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allows(self) -> bool:
+        return self.state != 'open'
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class Relay:
+    """One SMTP relay with its own credentials, weight and circuit breaker"""
+
+    def __init__(self, name: str, transport: SMTPTransport, weight: float = 1.0,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.transport = transport
+        self.weight = max(weight, 0.0)
+        self.breaker = breaker or CircuitBreaker()
+        self.current_weight = 0.0
+        self.sent = 0
+        self.failed = 0
+
+
+class RelayTransport(Transport):
+    """Spread messages over several SMTP relays by weight and fail over between them.
+
+    Relays are picked by smooth weighted round-robin and connect on first use, so a relay
+    that is down does not stop the run. A relay failure counts against its circuit
+    breaker, drops its session and sends the same message through the next relay; once
+    every relay has failed the message, the last error is raised."""
+
+    name = 'smtp'
+    throttled = True
+
+    def __init__(self, relays: List[Relay]):
+        if not relays:
+            raise ValueError("RelayTransport needs at least one relay")
+        self.relays = relays
+
+    def _pick(self, exclude: List[Relay]) -> Optional[Relay]:
+        candidates = [r for r in self.relays if r not in exclude and r.weight > 0 and r.breaker.allows()]
+        if not candidates:
+            return None
+        total = sum(relay.weight for relay in candidates)
+        for relay in candidates:
+            relay.current_weight += relay.weight
+        best = max(candidates, key=lambda relay: relay.current_weight)
+        best.current_weight -= total
+        return best
+
+    def send(self, message: EmailMessage, to_addrs: List[str]) -> Dict[str, Tuple[int, bytes]]:
+        tried: List[Relay] = []
+        last_error: Optional[Exception] = None
+        while True:
+            relay = self._pick(tried)
+            if relay is None:
+                if last_error is not None:
+                    raise last_error
+                raise smtplib.SMTPServerDisconnected("No SMTP relay available")
+            if tried:
+                print(f"Relay {tried[-1].name} failed, retrying through {relay.name}")
+            tried.append(relay)
+            try:
+                if relay.transport.server is None:
+                    relay.transport.metrics = self.metrics
+                    relay.transport.open()
+                refused = relay.transport.send(message, to_addrs)
+            except Exception as e:
+                if not is_relay_failure(e):
+                    # The relay answered; the problem is the message or its recipients
+                    relay.breaker.record_success()
+                    raise
+                relay.failed += 1
+                relay.breaker.record_failure()
+                if not relay.breaker.allows():
+                    print(f"Relay {relay.name} ejected after {relay.breaker.failures} failures: {str(e)}")
+                # The session may be half-dead; reconnect on its next turn
+                try:
+                    relay.transport.close()
+                except Exception:
+                    relay.transport.server = None
+                last_error = e
+                continue
+            relay.sent += 1
+            relay.breaker.record_success()
+            return refused
+
+    def close(self) -> None:
+        for relay in self.relays:
+            relay.transport.close()
+
+
+def load_relays(username: str, password: str) -> List[Relay]:
+    """Build relays from the SMTP_RELAYS JSON list, or the file named by SMTP_RELAYS_FILE.
+
+    Entries take ``host`` and optionally ``name``, ``port``, ``username``, ``password`` (or
+    ``password_env``), ``weight`` and ``start_tls``; relays without credentials log in as
+    the sender. A relay is ejected after SMTP_RELAY_FAILURE_THRESHOLD consecutive failures
+    (default 5) for SMTP_RELAY_EJECT_SECONDS (default 30)."""
+    raw = os.getenv('SMTP_RELAYS')
+    if not raw and os.getenv('SMTP_RELAYS_FILE'):
+        with open(os.getenv('SMTP_RELAYS_FILE')) as f:
+            raw = f.read()
+    threshold = int(os.getenv('SMTP_RELAY_FAILURE_THRESHOLD', 5))
+    eject_seconds = float(os.getenv('SMTP_RELAY_EJECT_SECONDS', 30))
+    relays = []
+    for index, entry in enumerate(json.loads(raw or '[]')):
+        relay_password = entry.get('password')
+        if relay_password is None and entry.get('password_env'):
+            relay_password = os.getenv(entry['password_env'])
+        has_credentials = bool(entry.get('username'))
+        transport = SMTPTransport(
+            entry['host'],
+            int(entry.get('port', 587)),
+            entry['username'] if has_credentials else username,
+            relay_password if has_credentials else password,
+            start_tls=bool(entry.get('start_tls', True))
+        )
+        relays.append(Relay(entry.get('name') or f"relay{index}", transport,
+                            weight=float(entry.get('weight', 1)),
+                            breaker=CircuitBreaker(threshold, eject_seconds)))
+    return relays
+
+
+class FileTransport(Transport):
+    """Write messages to .eml files or a Maildir instead of sending them.
+
+    Each file starts with Return-Path and X-Envelope-To headers recording the envelope.
+    Messages are buffered and written ``batch_size`` at a time, and the rest on close."""
+
+    def __init__(self, directory: str, maildir: bool = False, batch_size: int = 100):
+        self.directory = directory
+        self.maildir = maildir
+        self.batch_size = max(1, batch_size)
+        self.name = 'maildir' if maildir else 'file'
+        self._buffer: List[Tuple[str, bytes]] = []
+        self._sequence = count()
+        self._hostname = socket.gethostname().replace('/', '_').replace(':', '_')
+
+    def open(self) -> None:
+        subfolders = ('tmp', 'new', 'cur') if self.maildir else ('',)
+        for sub in subfolders:
+            os.makedirs(os.path.join(self.directory, sub), exist_ok=True)
+
+    def send(self, message: EmailMessage, to_addrs: List[str]) -> Dict[str, Tuple[int, bytes]]:
+        envelope = f"Return-Path: <{parseaddr(message['From'])[1]}>\r\nX-Envelope-To: {', '.join(to_addrs)}\r\n"
+        filename = f"{time.time_ns()}.{os.getpid()}_{next(self._sequence)}.{self._hostname}"
+        self._buffer.append((filename, envelope.encode('utf-8') + message.as_bytes()))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+        return {}
+
+    def flush(self) -> None:
+        """Write all buffered messages to disk"""
+        batch, self._buffer = self._buffer, []
+        for filename, data in batch:
+            if self.maildir:
+                tmp_path = os.path.join(self.directory, 'tmp', filename)
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, os.path.join(self.directory, 'new', filename))
+            else:
+                with open(os.path.join(self.directory, filename + '.eml'), 'wb') as f:
+                    f.write(data)
+
+    def close(self) -> None:
+        self.flush()
+
+
+class MemoryTransport(Transport):
+    """Keep sent messages in memory, for tests and throughput measurements"""
+
+    name = 'memory'
+
+    def __init__(self, keep_messages: bool = True):
+        self.keep_messages = keep_messages
+        self.messages: List[Tuple[EmailMessage, List[str]]] = []
+        self.message_count = 0
+
+    def send(self, message: EmailMessage, to_addrs: List[str]) -> Dict[str, Tuple[int, bytes]]:
+        self.message_count += 1
+        if self.keep_messages:
+            self.messages.append((message, list(to_addrs)))
+        return {}
+
+
+def create_transport(smtp_server: str, smtp_port: int, username: str, password: str,
+                     kind: Optional[str] = None) -> Transport:
+    """Create the transport named by ``kind`` or the EMAIL_TRANSPORT environment variable.
+
+    Supported values are smtp (default), file, maildir and memory. SMTP_START_TLS=false
+    disables STARTTLS, e.g. for a local test server. When SMTP_RELAYS or SMTP_RELAYS_FILE
+    lists relays, SMTP traffic is balanced over them instead (see load_relays). File sinks
+    write under EMAIL_TRANSPORT_PATH (default ``outbox``) in batches of
+    EMAIL_TRANSPORT_BATCH_SIZE."""
+    kind = (kind or os.getenv('EMAIL_TRANSPORT', 'smtp')).lower()
+    if kind == 'smtp' and (os.getenv('SMTP_RELAYS') or os.getenv('SMTP_RELAYS_FILE')):
+        return RelayTransport(load_relays(username, password))
+    if kind == 'smtp':
+        start_tls = os.getenv('SMTP_START_TLS', 'true').lower() == 'true'
+        return SMTPTransport(smtp_server, smtp_port, username, password, start_tls=start_tls)
+    if kind in ('file', 'maildir'):
+        return FileTransport(
+            os.getenv('EMAIL_TRANSPORT_PATH', 'outbox'),
+            maildir=kind == 'maildir',
+            batch_size=int(os.getenv('EMAIL_TRANSPORT_BATCH_SIZE', 100))
+        )
+    if kind == 'memory':
+        return MemoryTransport()
+    raise ValueError(f"Unknown EMAIL_TRANSPORT: {kind}")
@@ -0,0 +1,199 @@
+"""
+Behaviour check for Mail_Merge's DomainCache against a stubbed resolver.
+
+The repo has no test suite, so this harness drives the cache directly and exits non-zero
+if any check fails. DNS never leaves the process: a scripted resolver answers MX queries
+with a delay, and the cache's own ``lookups`` counter shows how often it went to DNS.
+
+    python -m benchmarks.domain_cache
+    python -m benchmarks.domain_cache --threads 64 --delay 0.2
+
+Checks:
+  positive_ttl      a deliverable domain is looked up once, then again after ``ttl``
+  negative_ttl      NXDOMAIN, null MX and timeouts are cached for ``negative_ttl`` only
+  concurrent_check  threads calling check() on one cold domain share a single lookup
+  check_many        repeated and mixed-case domains in one call cost one lookup each
+  resolver_error    threads waiting on a failing lookup share its rejection, kept for ``negative_ttl``
+"""
+import argparse
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import dns.exception
+import dns.resolver
+
+from benchmarks.engine import MAIL_MERGE_DIR, app_path
+
+
+class ScriptedResolver:
+    """Answers MX queries from a table after ``delay`` seconds, in place of dnspython's resolver.
+
+    Table values: 'mx' for a normal MX record, 'null' for a null MX, 'nxdomain',
+    'timeout', or 'error' to raise a RuntimeError dnspython itself would never raise."""
+
+    def __init__(self, answers: Dict[str, str], delay: float = 0.0):
+        self.answers = answers
+        self.delay = delay
+
+    def resolve(self, name, rdtype):
+        time.sleep(self.delay)
+        answer = self.answers.get(name, 'mx')
+        if answer == 'nxdomain':
+            raise dns.resolver.NXDOMAIN()
+        if answer == 'timeout':
+            raise dns.exception.Timeout()
+        if answer == 'error':
+            raise RuntimeError(f"resolver failure for {name}")
+        if answer == 'null':
+            return [SimpleNamespace(preference=0, exchange='.')]
+        return [SimpleNamespace(preference=10, exchange=f"mx.{name}.")]
+
+
+def in_threads(count: int, target: Callable[[], object]) -> List[object]:
+    """Run ``target`` on ``count`` threads released together; return results or exceptions."""
+    barrier = threading.Barrier(count)
+    results: List[object] = [None] * count
+
+    def run(index: int) -> None:
+        barrier.wait()
+        try:
+            results[index] = target()
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check_positive_ttl(DomainCache, args) -> List[str]:
+    resolver = ScriptedResolver({})
+    cache = DomainCache(ttl=args.ttl, negative_ttl=60, resolver=resolver)
+    problems = []
+    for _ in range(3):
+        if cache.check('Example.com') != (True, ''):
+            problems.append('example.com was not reported deliverable')
+    if cache.lookups != 1:
+        problems.append(f"expected 1 lookup within the TTL, got {cache.lookups}")
+    time.sleep(args.ttl * 1.5)
+    cache.check('example.com')
+    if cache.lookups != 2:
+        problems.append(f"expected a second lookup after the TTL, got {cache.lookups} in total")
+    return problems
+
+
+def check_negative_ttl(DomainCache, args) -> List[str]:
+    resolver = ScriptedResolver({'gone.test': 'nxdomain', 'null.test': 'null', 'slow.test': 'timeout'})
+    # The positive TTL is long, so only the negative one can explain a second lookup
+    cache = DomainCache(ttl=3600, negative_ttl=args.ttl, resolver=resolver)
+    problems = []
+    for domain in ('gone.test', 'null.test'):
+        deliverable, error = cache.check(domain)
+        if deliverable or not error:
+            problems.append(f"{domain} should be undeliverable with a reason, got {(deliverable, error)}")
+    # email_validator lets timeouts through; the cache keeps them only briefly
+    if cache.check('slow.test') != (True, ''):
+        problems.append('a timed-out lookup should not reject the domain')
+    for domain in ('gone.test', 'null.test', 'slow.test'):
+        cache.check(domain)
+    if cache.lookups != 3:
+        problems.append(f"expected 3 lookups within the negative TTL, got {cache.lookups}")
+    time.sleep(args.ttl * 1.5)
+    for domain in ('gone.test', 'null.test', 'slow.test'):
+        cache.check(domain)
+    if cache.lookups != 6:
+        problems.append(f"expected every negative entry to expire, got {cache.lookups} lookups in total")
+    return problems
+
+
+def check_concurrent_check(DomainCache, args) -> List[str]:
+    resolver = ScriptedResolver({}, delay=args.delay)
+    cache = DomainCache(ttl=3600, negative_ttl=60, resolver=resolver)
+    results = in_threads(args.threads, lambda: cache.check('busy.test'))
+    problems = []
+    if any(result != (True, '') for result in results):
+        problems.append(f"not every thread got the answer: {set(map(repr, results))}")
+    if cache.lookups != 1:
+        problems.append(f"{args.threads} threads on one cold domain made {cache.lookups} lookups, expected 1")
+    return problems
+
+
+def check_check_many(DomainCache, args) -> List[str]:
+    resolver = ScriptedResolver({'gone.test': 'nxdomain'}, delay=args.delay)
+    cache = DomainCache(ttl=3600, negative_ttl=60, resolver=resolver, max_workers=8)
+    domains = [f"d{i % 10}.test" for i in range(200)] + ['D1.TEST', 'gone.test', 'Gone.Test']
+    started = time.perf_counter()
+    results = cache.check_many(domains)
+    elapsed = time.perf_counter() - started
+    problems = []
+    if set(results) != {f"d{i}.test" for i in range(10)} | {'gone.test'}:
+        problems.append(f"unexpected result keys: {sorted(results)}")
+    if results.get('gone.test', (True,))[0]:
+        problems.append('gone.test should be undeliverable')
+    if cache.lookups != 11:
+        problems.append(f"expected one lookup per distinct domain (11), got {cache.lookups}")
+    # Eleven lookups on eight workers take two rounds, not eleven
+    if elapsed > args.delay * 4:
+        problems.append(f"lookups did not run concurrently: {elapsed:.2f}s for 11 domains")
+    # Threads validating overlapping lists at the same time still share lookups
+    in_threads(args.threads, lambda: cache.check_many(f"shared{i}.test" for i in range(5)))
+    if cache.lookups != 16:
+        problems.append(f"overlapping check_many calls made {cache.lookups - 11} lookups for 5 domains")
+    return problems
+
+
+def check_resolver_error(DomainCache, args) -> List[str]:
+    resolver = ScriptedResolver({'broken.test': 'error'}, delay=args.delay)
+    cache = DomainCache(ttl=3600, negative_ttl=args.ttl, resolver=resolver)
+    results = in_threads(args.threads, lambda: cache.check('broken.test'))
+    problems = []
+    # email_validator reports unexpected resolver errors as an undeliverable domain
+    if len(set(map(repr, results))) != 1 or not isinstance(results[0], tuple) or results[0][0]:
+        problems.append(f"every thread should get the same rejection, got {set(map(repr, results))}")
+    if cache.lookups != 1:
+        problems.append(f"threads waiting on a failing lookup made {cache.lookups} lookups, expected 1")
+    resolver.answers['broken.test'] = 'mx'
+    time.sleep(args.ttl * 1.5)
+    if cache.check('broken.test') != (True, '') or cache.lookups != 2:
+        problems.append('a failed lookup should only be cached for the negative TTL')
+    return problems
+
+
+CHECKS = {
+    'positive_ttl': check_positive_ttl,
+    'negative_ttl': check_negative_ttl,
+    'concurrent_check': check_concurrent_check,
+    'check_many': check_check_many,
+    'resolver_error': check_resolver_error,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checks', default=','.join(CHECKS), help='comma-separated checks to run')
+    parser.add_argument('--ttl', type=float, default=0.3, help='TTL given to the cache under test, in seconds')
+    parser.add_argument('--delay', type=float, default=0.1, help='seconds the stub resolver takes per query')
+    parser.add_argument('--threads', type=int, default=32, help='threads racing for one domain')
+    args = parser.parse_args()
+
+    with app_path(MAIL_MERGE_DIR):
+        from email_validation import DomainCache
+
+    failed = 0
+    for name in args.checks.split(','):
+        problems = CHECKS[name](DomainCache, args)
+        print(f"{'FAIL' if problems else 'ok  '} {name}")
+        for problem in problems:
+            print(f"     {problem}")
+        failed += bool(problems)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
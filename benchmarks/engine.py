@@ -0,0 +1,452 @@
+"""
+Micro-benchmarks for the sending engines of Mail_Merge and Bulk_email.
+
+Each case runs in a fresh subprocess so its peak RSS is its own, and SMTP cases send to
+a local aiosmtpd sink started by the runner. Results are written as JSON; pass a
+previous results file with ``--compare`` to print the throughput change per case.
+
+    python -m benchmarks.engine --recipients 100,1000,10000,100000 --attachment-kb 0,256,4096
+    python -m benchmarks.engine --quick --output before.json
+    python -m benchmarks.engine --quick --compare before.json
+
+Cases:
+  template_render     EmailTemplate.render for one recipient (Mail_Merge)
+  validate_lists      EmailAddressValidator.validate_email_lists, latency per 100-address call (Mail_Merge)
+  mime_build          MessagePrototype build and per-batch render as in send_batch (Bulk_email)
+  merge_message_build MessageFactory.build for one recipient of a merge run (Mail_Merge)
+  send_email          email_utils.send_email through the SMTP pool, latency per transaction (Bulk_email)
+  send_bulk_emails    BulkEmailer.send_bulk_emails over one SMTP session, latency per message (Mail_Merge)
+
+DNS is answered by a local stub during validation unless ``--dns`` is given, so the
+numbers measure this code rather than the resolver.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterator, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BULK_EMAIL_DIR = os.path.join(ROOT, 'Bulk_email')
+MAIL_MERGE_DIR = os.path.join(ROOT, 'Mail_Merge')
+
+CASES = ['template_render', 'validate_lists', 'mime_build', 'merge_message_build', 'send_email', 'send_bulk_emails']
+# Cases whose cost depends on the message size
+ATTACHMENT_CASES = {'mime_build', 'merge_message_build', 'send_email', 'send_bulk_emails'}
+SMTP_CASES = {'send_email', 'send_bulk_emails'}
+
+SENDER = 'bench@example.com'
+HTML_BODY = '<p>Benchmark body</p>\n' * 50
+
+
+def recipients(count: int) -> List[str]:
+    # Spread over a few domains so per-domain batching in Bulk_email behaves as in production
+    return [f"user{i}@example{i % 7}.com" for i in range(count)]
+
+
+def peak_rss_kb() -> int:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Timer:
+    """Collects per-operation latencies; ``timed`` wraps a callable to record each call."""
+
+    def __init__(self):
+        self.samples: List[float] = []
+
+    def timed(self, func: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.samples.append(time.perf_counter() - started)
+        return wrapper
+
+
+@contextmanager
+def app_path(directory: str) -> Iterator[None]:
+    sys.path.insert(0, directory)
+    try:
+        yield
+    finally:
+        sys.path.remove(directory)
+
+
+def attachment_file(size_kb: int) -> str:
+    fd, path = tempfile.mkstemp(suffix='.bin', prefix='bench-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(os.urandom(size_kb * 1024))
+    return path
+
+
+class OfflineResolver:
+    """Answers every MX query with mx.<domain>, in place of dnspython's resolver."""
+
+    def resolve(self, name, rdtype):
+        return [SimpleNamespace(preference=10, exchange=f"mx.{name}.")]
+
+
+def disable_dns() -> None:
+    """Keep email_validator syntax checks and the domain cache but answer MX lookups locally."""
+    import email_validation
+    email_validation.DOMAIN_CACHE = email_validation.DomainCache(resolver=OfflineResolver())
+
+
+# --- cases -----------------------------------------------------------------------------
+
+def bench_template_render(count: int, size_kb: int, args) -> Dict:
+    with app_path(MAIL_MERGE_DIR):
+        from email_template import EmailTemplate
+
+    template = EmailTemplate(
+        name='bench',
+        subject='Welcome to {company}, {name}!',
+        body='Dear {name},\n\n' + 'Thanks for joining {company} as our {role}. ' * 20 + '\n\n{signature}',
+    )
+    rows = [
+        {'name': f'User {i}', 'company': f'Company {i % 50}', 'role': 'member', 'signature': 'The team'}
+        for i in range(count)
+    ]
+    timer = Timer()
+    render = timer.timed(template.render)
+    started = time.perf_counter()
+    for row in rows:
+        render(row)
+    return {'operations': count, 'messages': count, 'elapsed': time.perf_counter() - started, 'latencies': timer.samples}
+
+
+def bench_validate_lists(count: int, size_kb: int, args) -> Dict:
+    with app_path(MAIL_MERGE_DIR):
+        import email_validation
+        from email_validation import EmailAddressValidator
+    if not args.dns:
+        disable_dns()
+
+    addresses = recipients(count)
+    timer = Timer()
+    validate = timer.timed(EmailAddressValidator.validate_email_lists)
+    started = time.perf_counter()
+    # Lists go through in chunks, as from several form submissions sharing the domain cache
+    for offset in range(0, count, 100):
+        is_valid, invalid, _ = validate(addresses[offset:offset + 100])
+        if not is_valid:
+            raise RuntimeError(f"Benchmark addresses failed validation: {invalid['to'][:5]}")
+    elapsed = time.perf_counter() - started
+    return {'operations': len(timer.samples), 'messages': count, 'elapsed': elapsed,
+            'latencies': timer.samples, 'dns_lookups': email_validation.DOMAIN_CACHE.lookups}
+
+
+def bench_mime_build(count: int, size_kb: int, args) -> Dict:
+    with app_path(BULK_EMAIL_DIR):
+        from app.email_schema import EmailAttachment
+        from app.mime_builder import MessagePrototype
+
+    attachments = []
+    if size_kb:
+        content = base64.b64encode(os.urandom(size_kb * 1024))
+        attachments.append(EmailAttachment(filename='bench.bin', content=content, mime_type='application/octet-stream'))
+
+    batch_size = 10
+    addresses = recipients(count)
+    started = time.perf_counter()
+    prototype = MessagePrototype(
+        sender=SENDER,
+        subject='Benchmark',
+        body=HTML_BODY,
+        attachments=attachments,
+        embedded_links=['https://example.com'],
+    )
+    build_seconds = time.perf_counter() - started
+
+    timer = Timer()
+    render = timer.timed(prototype.render)
+    wire_bytes = 0
+    for offset in range(0, count, batch_size):
+        wire_bytes += len(render(addresses[offset:offset + batch_size]))
+    return {
+        'operations': len(timer.samples),
+        'messages': len(timer.samples),
+        'elapsed': time.perf_counter() - started,
+        'latencies': timer.samples,
+        'prototype_build_seconds': build_seconds,
+        'wire_bytes': wire_bytes,
+    }
+
+
+def bench_merge_message_build(count: int, size_kb: int, args) -> Dict:
+    with app_path(MAIL_MERGE_DIR):
+        from attachments import load_attachments
+        from bulk_emailer import MessageFactory
+
+    paths = [attachment_file(size_kb)] if size_kb else []
+    try:
+        started = time.perf_counter()
+        factory = MessageFactory(SENDER, ['cc@example.com'], load_attachments(paths))
+        build_seconds = time.perf_counter() - started
+
+        timer = Timer()
+        build = timer.timed(factory.build)
+        body = 'Dear {name},\n\n' + 'Thanks for joining our team as a member. ' * 20 + '\n\nThe team'
+        for i, address in enumerate(recipients(count)):
+            build(address, f'Welcome, User {i}!', body.format(name=f'User {i}'))
+        elapsed = time.perf_counter() - started
+    finally:
+        for path in paths:
+            os.remove(path)
+    return {'operations': count, 'messages': count, 'elapsed': elapsed,
+            'latencies': timer.samples, 'factory_build_seconds': build_seconds}
+
+
+def bench_send_email(count: int, size_kb: int, args) -> Dict:
+    os.environ.update(
+        SMTP_SERVER=args.smtp_host,
+        SMTP_PORT=str(args.smtp_port),
+        SMTP_USER=SENDER,
+        SMTP_PASSWORD='bench',
+        SMTP_START_TLS='false',
+        EMAIL_TRANSPORT='smtp',
+        SEND_MESSAGES_PER_SECOND='0',
+        SEND_RECIPIENTS_PER_MINUTE='0',
+        SEND_MAX_CONCURRENT_BATCHES=str(args.concurrency),
+        SMTP_POOL_SIZE=str(args.concurrency),
+    )
+    with app_path(BULK_EMAIL_DIR):
+        from app.email_schema import EmailAttachment
+        from app.email_utils import send_email
+        from app.transport import SMTPTransport, close_transport, get_transport
+    import logging
+    logging.disable(logging.INFO)
+
+    attachments = None
+    if size_kb:
+        content = base64.b64encode(os.urandom(size_kb * 1024))
+        attachments = [EmailAttachment(filename='bench.bin', content=content, mime_type='application/octet-stream')]
+
+    latencies: List[float] = []
+
+    class TimedTransport(SMTPTransport):
+        async def send(self, sender, to, message):
+            started = time.perf_counter()
+            try:
+                return await super().send(sender, to, message)
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+    async def run():
+        transport = TimedTransport(get_transport().pool)
+        try:
+            started = time.perf_counter()
+            summary = await send_email(
+                subject='Benchmark',
+                body=HTML_BODY,
+                recipients=recipients(count),
+                attachments=attachments,
+                transport=transport,
+            )
+            return summary, time.perf_counter() - started
+        finally:
+            await close_transport()
+
+    summary, elapsed = asyncio.run(run())
+    if summary['sent'] != count:
+        raise RuntimeError(f"Only {summary['sent']} of {count} recipients were accepted: {summary}")
+    return {'operations': len(latencies), 'messages': len(latencies), 'recipients': count,
+            'elapsed': elapsed, 'latencies': latencies}
+
+
+def bench_send_bulk_emails(count: int, size_kb: int, args) -> Dict:
+    with app_path(MAIL_MERGE_DIR):
+        from bulk_emailer import BulkEmailer
+        from transport import SMTPTransport
+    if not args.dns:
+        disable_dns()
+
+    timer = Timer()
+    transport = SMTPTransport(args.smtp_host, args.smtp_port, SENDER, 'bench', start_tls=False)
+    transport.send = timer.timed(transport.send)
+    emailer = BulkEmailer(args.smtp_host, args.smtp_port, SENDER, 'bench', transport=transport)
+
+    paths = [attachment_file(size_kb)] if size_kb else []
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    try:
+        # send_bulk_emails prints a line per message
+        sys.stdout = devnull
+        started = time.perf_counter()
+        emailer.send_bulk_emails('Benchmark', 'Benchmark body\n' * 50, recipients(count), attachments=paths, delay=0)
+        elapsed = time.perf_counter() - started
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        for path in paths:
+            os.remove(path)
+    return {'operations': count, 'messages': count, 'elapsed': elapsed, 'latencies': timer.samples}
+
+
+BENCHMARKS = {
+    'template_render': bench_template_render,
+    'validate_lists': bench_validate_lists,
+    'mime_build': bench_mime_build,
+    'merge_message_build': bench_merge_message_build,
+    'send_email': bench_send_email,
+    'send_bulk_emails': bench_send_bulk_emails,
+}
+
+
+def run_case(case: str, count: int, size_kb: int, args) -> Dict:
+    """Run one case in this process and summarize it."""
+    baseline_kb = peak_rss_kb()
+    raw = BENCHMARKS[case](count, size_kb, args)
+    latencies = raw.pop('latencies')
+    elapsed = raw['elapsed']
+    return {
+        'case': case,
+        'recipients': count,
+        'attachment_kb': size_kb,
+        **raw,
+        'messages_per_second': raw['messages'] / elapsed if elapsed else None,
+        'recipients_per_second': count / elapsed if elapsed else None,
+        'latency_p50_ms': _ms(percentile(latencies, 50)),
+        'latency_p99_ms': _ms(percentile(latencies, 99)),
+        'latency_mean_ms': _ms(statistics.fmean(latencies)) if latencies else None,
+        'peak_rss_kb': peak_rss_kb(),
+        'rss_growth_kb': peak_rss_kb() - baseline_kb,
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 4) if seconds is not None else None
+
+
+def run_isolated(case: str, count: int, size_kb: int, args) -> Dict:
+    command = [
+        sys.executable, '-m', 'benchmarks.engine', '--single', case,
+        '--recipients', str(count), '--attachment-kb', str(size_kb),
+        '--smtp-host', args.smtp_host, '--smtp-port', str(args.smtp_port),
+        '--concurrency', str(args.concurrency),
+    ]
+    if args.dns:
+        command.append('--dns')
+    completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, timeout=args.timeout)
+    if completed.returncode != 0:
+        return {'case': case, 'recipients': count, 'attachment_kb': size_kb,
+                'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result: Dict) -> tuple:
+    return result['case'], result['recipients'], result['attachment_kb']
+
+
+def compare(results: List[Dict], baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    print(f"{'case':<18}{'recipients':>11}{'att KB':>8}{'msg/s':>12}{'baseline':>12}{'change':>9}", file=sys.stderr)
+    for result in results:
+        before = baseline.get(result_key(result))
+        now = result.get('messages_per_second')
+        then = before.get('messages_per_second') if before else None
+        change = f"{(now / then - 1) * 100:+.1f}%" if now and then else '-'
+        print(f"{result['case']:<18}{result['recipients']:>11}{result['attachment_kb']:>8}"
+              f"{now or 0:>12.1f}{then or 0:>12.1f}{change:>9}", file=sys.stderr)
+
+
+def parse_sizes(value: str) -> List[int]:
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the Mail_Merge and Bulk_email sending engines.')
+    parser.add_argument('--cases', default=','.join(CASES), help='comma-separated cases to run')
+    parser.add_argument('--recipients', type=parse_sizes, default=[100, 1000, 10000, 100000])
+    parser.add_argument('--attachment-kb', type=parse_sizes, default=[0, 256, 4096])
+    parser.add_argument('--smtp-recipient-limit', type=int, default=10000,
+                        help='skip SMTP cases above this many recipients (they take minutes)')
+    parser.add_argument('--quick', action='store_true', help='small matrix for a fast regression check')
+    parser.add_argument('--concurrency', type=int, default=5, help='batches in flight for send_email')
+    parser.add_argument('--dns', action='store_true', help='include MX lookups in validation')
+    parser.add_argument('--smtp-host', default='127.0.0.1')
+    parser.add_argument('--smtp-port', type=int, default=8025)
+    parser.add_argument('--timeout', type=float, default=1800, help='seconds allowed per case')
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    parser.add_argument('--compare', help='previous results file to compare throughput against')
+    parser.add_argument('--single', choices=CASES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Child process: one case, one JSON line
+        print(json.dumps(run_case(args.single, args.recipients[0], args.attachment_kb[0], args)))
+        return
+
+    if args.quick:
+        args.recipients = [100, 1000]
+        args.attachment_kb = [0, 256]
+
+    from benchmarks.smtp_sink import SMTPSink
+
+    cases = [case.strip() for case in args.cases.split(',') if case.strip()]
+    results = []
+    with SMTPSink(args.smtp_host, args.smtp_port):
+        for case in cases:
+            sizes = args.attachment_kb if case in ATTACHMENT_CASES else [0]
+            for count in args.recipients:
+                if case in SMTP_CASES and count > args.smtp_recipient_limit:
+                    continue
+                for size_kb in sizes:
+                    result = run_isolated(case, count, size_kb, args)
+                    results.append(result)
+                    summary = result.get('error') or (
+                        f"{result['messages_per_second']:.1f} msg/s, p50 {result['latency_p50_ms']} ms, "
+                        f"p99 {result['latency_p99_ms']} ms, peak RSS {result['peak_rss_kb'] // 1024} MiB"
+                    )
+                    print(f"{case} recipients={count} attachment={size_kb}KB: {summary}", file=sys.stderr)
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
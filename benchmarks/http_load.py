@@ -0,0 +1,373 @@
+"""
+HTTP load test for the Bulk_email API.
+
+By default the harness starts a local SMTP sink and the FastAPI app under uvicorn, wired
+to the sink with throwaway job and attachment stores, then drives it with concurrent
+clients. Pass ``--url`` to target a server that is already running instead; add
+``--server-pid`` to still sample its memory.
+
+    python -m benchmarks.http_load --scenario send --requests 200 --concurrency 20 --recipients 50
+    python -m benchmarks.http_load --scenario send --inline-kb 2048 --requests 50
+    python -m benchmarks.http_load --scenario stored --attachment-kb 4096 --recipients-file Bulk_email/small.txt
+    python -m benchmarks.http_load --scenario upload --attachment-kb 10240 --concurrency 4
+
+Scenarios:
+  send     POST /send-email/, optionally with an inline base64 attachment of --inline-kb
+  stored   upload one attachment of --attachment-kb, then POST /send-email/ referencing its ID
+  upload   POST /upload-attachments/ with a file of --attachment-kb
+
+Reported: per-endpoint request latency percentiles and status codes, end-to-end delivery
+latency per job (job created to finished, as recorded by the server, once the job is
+polled to completion) and the server's RSS sampled over the run. The managed server
+runs without sending quotas unless QUOTA_* variables are set in the environment;
+requests carry ``--api-key`` as X-API-Key so per-key quotas can be exercised.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.engine import BULK_EMAIL_DIR, git_revision, percentile
+from benchmarks.smtp_sink import SMTPSink
+
+TERMINAL_JOB_STATUSES = {'completed', 'failed'}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_kb(pid: int) -> Optional[int]:
+    """Resident set size of a process from /proc (Linux only)."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def summarize_latencies(samples: List[float]) -> Dict[str, Optional[float]]:
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+    return {
+        'count': len(samples),
+        'p50_ms': ms(percentile(samples, 50)),
+        'p90_ms': ms(percentile(samples, 90)),
+        'p99_ms': ms(percentile(samples, 99)),
+        'max_ms': ms(max(samples)) if samples else None,
+        'mean_ms': ms(statistics.fmean(samples)) if samples else None,
+    }
+
+
+class ManagedServer:
+    """The Bulk_email app under uvicorn, wired to a local SMTP sink."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix='bulk-email-load-')
+        self.port = free_port()
+        self.sink = SMTPSink(port=free_port())
+        self.process: Optional[subprocess.Popen] = None
+        self.workers: Optional[subprocess.Popen] = None
+        self.log_path = os.path.join(self.workdir, 'server.log')
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self) -> None:
+        self.sink.start()
+        self.log = open(self.log_path, 'w')
+        env = dict(
+            os.environ,
+            SMTP_SERVER=self.sink.hostname,
+            SMTP_PORT=str(self.sink.port),
+            SMTP_USER='loadtest@example.com',
+            SMTP_PASSWORD='loadtest',
+            SMTP_START_TLS='false',
+            EMAIL_TRANSPORT='smtp',
+            JOB_DB_PATH=os.path.join(self.workdir, 'jobs.db'),
+            ATTACHMENT_STORE_PATH=os.path.join(self.workdir, 'attachments'),
+            QUOTA_DB_PATH=os.path.join(self.workdir, 'quotas.db'),
+            SEND_MESSAGES_PER_SECOND=str(self.args.smtp_rate),
+            SEND_WORKER_MODE='external' if self.args.workers else 'inline',
+            JOB_WORKER_POLL_SECONDS='0.5',
+        )
+        if self.args.workers:
+            self.workers = subprocess.Popen(
+                [sys.executable, '-m', 'app.worker', '--processes', str(self.args.workers)],
+                cwd=BULK_EMAIL_DIR,
+                env=env,
+                stdout=self.log,
+                stderr=subprocess.STDOUT,
+            )
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', str(self.port), '--log-level', 'warning'],
+            cwd=BULK_EMAIL_DIR,
+            env=env,
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                if httpx.get(f'{self.url}/delivery/throttle', timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server exited during startup, see {self.log_path}')
+            time.sleep(0.2)
+        raise RuntimeError('Server did not start within 30 seconds')
+
+    def stop(self) -> None:
+        for process in (self.process, self.workers):
+            if process is None:
+                continue
+            process.terminate()
+            try:
+                process.wait(timeout=45)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.process is not None:
+            self.log.close()
+        self.sink.stop()
+
+
+class LoadTest:
+    def __init__(self, args, base_url: str, server_pid: Optional[int]):
+        self.args = args
+        self.base_url = base_url
+        self.server_pid = server_pid
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.errors: Counter = Counter()
+        self.job_ids: List[str] = []
+        self.memory: List[Dict[str, float]] = []
+        self.started = 0.0
+        self.attachment_id: Optional[str] = None
+        self.recipient_pool = self._load_recipients()
+
+    def _load_recipients(self) -> Optional[List[str]]:
+        if not self.args.recipients_file:
+            return None
+        with open(self.args.recipients_file) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def recipients_for(self, request_number: int) -> List[str]:
+        if self.recipient_pool:
+            return self.recipient_pool[:self.args.recipients] if self.args.recipients else self.recipient_pool
+        return [f'load{request_number}-{i}@example{i % 7}.com' for i in range(self.args.recipients)]
+
+    async def timed(self, endpoint: str, call) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await call()
+        except httpx.HTTPError as e:
+            self.errors[type(e).__name__] += 1
+            return None
+        finally:
+            self.latencies[endpoint].append(time.perf_counter() - started)
+        self.statuses[endpoint][response.status_code] += 1
+        return response
+
+    async def upload(self, client: httpx.AsyncClient, size_kb: int) -> Optional[str]:
+        files = [('files', ('load.bin', os.urandom(size_kb * 1024), 'application/octet-stream'))]
+        response = await self.timed('upload-attachments', lambda: client.post('/upload-attachments/', files=files))
+        if response is not None and response.status_code == 200:
+            return response.json()['attachments'][0]['id']
+        return None
+
+    async def send(self, client: httpx.AsyncClient, request_number: int, inline: Optional[str]) -> None:
+        payload = {
+            'subject': f'Load test {request_number}',
+            'body': '<p>Load test body</p>\n' * 20,
+            'recipients': self.recipients_for(request_number),
+            'embedded_links': ['https://example.com'],
+        }
+        if inline:
+            payload['attachments'] = [{'filename': 'inline.bin', 'content': inline, 'mime_type': 'application/octet-stream'}]
+        if self.attachment_id:
+            payload['attachment_ids'] = [self.attachment_id]
+        response = await self.timed('send-email', lambda: client.post('/send-email/', json=payload))
+        if response is not None and response.status_code == 200:
+            self.job_ids.append(response.json()['job_id'])
+
+    async def sample_memory(self, stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            rss = rss_kb(self.server_pid) if self.server_pid else None
+            if rss is not None:
+                self.memory.append({'t': round(time.perf_counter() - self.started, 2), 'rss_kb': rss})
+            try:
+                await asyncio.wait_for(stop.wait(), self.args.sample_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_for_jobs(self, client: httpx.AsyncClient) -> List[Dict]:
+        """Poll every submitted job until it finishes or the delivery timeout passes."""
+        outstanding = list(self.job_ids)
+        finished: List[Dict] = []
+        deadline = time.monotonic() + self.args.delivery_timeout
+        while outstanding and time.monotonic() < deadline:
+            still_running = []
+            for job_id in outstanding:
+                response = await client.get(f'/jobs/{job_id}')
+                job = response.json() if response.status_code == 200 else None
+                if job and job['status'] in TERMINAL_JOB_STATUSES:
+                    finished.append(job)
+                else:
+                    still_running.append(job_id)
+            outstanding = still_running
+            if outstanding:
+                await asyncio.sleep(self.args.poll_interval)
+        return finished
+
+    async def run(self) -> Dict:
+        args = self.args
+        limits = httpx.Limits(max_connections=args.concurrency)
+        headers = {'X-API-Key': args.api_key} if args.api_key else None
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, headers=headers,
+                                     timeout=args.request_timeout) as client:
+            if args.scenario == 'stored':
+                self.attachment_id = await self.upload(client, args.attachment_kb)
+                if self.attachment_id is None:
+                    raise RuntimeError('Attachment upload failed')
+            # Encode once: the cost under test is the server parsing it, not the client building it
+            inline = base64.b64encode(os.urandom(args.inline_kb * 1024)).decode('ascii') if args.inline_kb else None
+
+            stop = asyncio.Event()
+            self.started = time.perf_counter()
+            sampler = asyncio.create_task(self.sample_memory(stop))
+            queue: asyncio.Queue = asyncio.Queue()
+            for request_number in range(args.requests):
+                queue.put_nowait(request_number)
+
+            async def client_loop():
+                while True:
+                    try:
+                        request_number = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    if args.scenario == 'upload':
+                        await self.upload(client, args.attachment_kb)
+                    else:
+                        await self.send(client, request_number, inline)
+
+            await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+            load_seconds = time.perf_counter() - self.started
+
+            jobs = await self.wait_for_jobs(client) if self.job_ids else []
+            drain_seconds = time.perf_counter() - self.started
+            stop.set()
+            await sampler
+
+        return self.report(load_seconds, drain_seconds, jobs)
+
+    def report(self, load_seconds: float, drain_seconds: float, jobs: List[Dict]) -> Dict:
+        delivery = [job['finished_at'] - job['created_at'] for job in jobs if job['finished_at']]
+        rss_values = [sample['rss_kb'] for sample in self.memory]
+        total_requests = sum(len(samples) for samples in self.latencies.values())
+        return {
+            'revision': git_revision(),
+            'config': {key: value for key, value in vars(self.args).items() if key != 'url'},
+            'load_seconds': round(load_seconds, 3),
+            'drain_seconds': round(drain_seconds, 3),
+            'requests_per_second': round(total_requests / load_seconds, 2) if load_seconds else None,
+            'requests': {
+                endpoint: {
+                    **summarize_latencies(samples),
+                    'status_codes': {str(code): count for code, count in sorted(self.statuses[endpoint].items())},
+                }
+                for endpoint, samples in self.latencies.items()
+            },
+            'client_errors': dict(self.errors),
+            'delivery': {
+                'jobs_submitted': len(self.job_ids),
+                'jobs_finished': len(jobs),
+                'jobs_failed': sum(1 for job in jobs if job['status'] == 'failed'),
+                'recipients_sent': sum(job['recipients']['sent'] for job in jobs),
+                'recipients_failed': sum(job['recipients']['failed'] for job in jobs),
+                **summarize_latencies(delivery),
+            },
+            'memory': {
+                'start_rss_kb': rss_values[0] if rss_values else None,
+                'peak_rss_kb': max(rss_values) if rss_values else None,
+                'end_rss_kb': rss_values[-1] if rss_values else None,
+                'samples': self.memory,
+            },
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Load test the Bulk_email HTTP API.')
+    parser.add_argument('--scenario', choices=['send', 'stored', 'upload'], default='send')
+    parser.add_argument('--requests', type=int, default=100, help='total requests to issue')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests in flight at once')
+    parser.add_argument('--recipients', type=int, default=10, help='recipients per send request')
+    parser.add_argument('--recipients-file', help='send to the addresses in this file (one per line)')
+    parser.add_argument('--inline-kb', type=int, default=0, help='inline base64 attachment size for send')
+    parser.add_argument('--attachment-kb', type=int, default=1024, help='file size for stored and upload')
+    parser.add_argument('--url', help='target an already running server instead of starting one')
+    parser.add_argument('--server-pid', type=int, help='sample the memory of this server process')
+    parser.add_argument('--api-key', help='X-API-Key to send, selecting a per-key quota')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='send from this many app.worker processes instead of the API process')
+    parser.add_argument('--smtp-rate', type=float, default=0, help='SEND_MESSAGES_PER_SECOND for the managed server')
+    parser.add_argument('--sample-interval', type=float, default=0.5, help='seconds between memory samples')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='seconds between job status polls')
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--delivery-timeout', type=float, default=600, help='seconds to wait for jobs to finish')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        base_url, server_pid = args.url.rstrip('/'), args.server_pid
+    else:
+        server = ManagedServer(args)
+        server.start()
+        base_url, server_pid = server.url, server.process.pid
+
+    try:
+        report = asyncio.run(LoadTest(args, base_url, server_pid).run())
+    finally:
+        if server is not None:
+            server.stop()
+            print(f"server log: {server.log_path}", file=sys.stderr)
+
+    requests = report['requests']
+    for endpoint, stats in requests.items():
+        print(f"{endpoint}: {stats['count']} requests, p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms, "
+              f"status {stats['status_codes']}", file=sys.stderr)
+    delivery = report['delivery']
+    print(f"delivery: {delivery['jobs_finished']}/{delivery['jobs_submitted']} jobs, "
+          f"p50 {delivery['p50_ms']} ms, p99 {delivery['p99_ms']} ms", file=sys.stderr)
+    memory = report['memory']
+    print(f"server RSS: start {memory['start_rss_kb']} KB, peak {memory['peak_rss_kb']} KB, "
+          f"end {memory['end_rss_kb']} KB", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Local aiosmtpd stand-in for a real relay.
+
+The sink accepts any AUTH credentials without TLS, counts what it receives and
+discards the message data, so it costs the client little more than the SMTP dialogue
+itself. Like many real relays it can cap the messages per session, answering 421
+once the cap is reached. Run it on its own with ``python -m benchmarks.smtp_sink --port 8025``.
+"""
+import argparse
+import logging
+import threading
+import time
+from typing import List, Optional
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+# aiosmtpd logs a deprecation warning about its own attribute on every AUTH
+logging.getLogger('mail.log').setLevel(logging.ERROR)
+
+
+class SinkHandler:
+    def __init__(self, keep_timestamps: bool = False, messages_per_session: Optional[int] = None):
+        self.keep_timestamps = keep_timestamps
+        self.messages_per_session = messages_per_session
+        self.messages = 0
+        self.recipients = 0
+        self.bytes_received = 0
+        self.received_at: List[float] = []
+        self._lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.messages_per_session is not None:
+            session.messages_sent = getattr(session, 'messages_sent', 0) + 1
+            if session.messages_sent > self.messages_per_session:
+                return '421 Too many messages in this session'
+        with self._lock:
+            self.messages += 1
+            self.recipients += len(envelope.rcpt_tos)
+            self.bytes_received += len(envelope.content)
+            if self.keep_timestamps:
+                self.received_at.append(time.time())
+        return '250 OK'
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'messages': self.messages,
+                'recipients': self.recipients,
+                'bytes_received': self.bytes_received,
+            }
+
+
+def accept_any(server, session, envelope, mechanism, auth_data) -> AuthResult:
+    return AuthResult(success=True)
+
+
+class SMTPSink:
+    """Run a SinkHandler behind aiosmtpd in a background thread; usable as a context manager."""
+
+    def __init__(self, hostname: str = '127.0.0.1', port: int = 8025, keep_timestamps: bool = False,
+                 messages_per_session: Optional[int] = None):
+        self.handler = SinkHandler(keep_timestamps, messages_per_session)
+        self.hostname = hostname
+        self.port = port
+        self.controller = Controller(
+            self.handler,
+            hostname=hostname,
+            port=port,
+            authenticator=accept_any,
+            auth_require_tls=False,
+            data_size_limit=None,
+        )
+
+    def start(self) -> 'SMTPSink':
+        self.controller.start()
+        return self
+
+    def stop(self) -> None:
+        self.controller.stop()
+
+    def __enter__(self) -> 'SMTPSink':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--messages-per-session', type=int, default=None,
+                        help='answer 421 after this many messages on one connection')
+    args = parser.parse_args()
+
+    with SMTPSink(args.host, args.port, messages_per_session=args.messages_per_session) as sink:
+        print(f"SMTP sink listening on {args.host}:{args.port}, Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(5)
+                print(sink.handler.snapshot())
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()